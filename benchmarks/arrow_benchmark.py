@@ -0,0 +1,113 @@
+"""
+Arrow benchmark: measures the per-row overhead of reading a large check result through Row objects, the way
+execute_query_and_log and the tests do, against reading it as a pyarrow Table and asserting on its columns.
+
+Usage:
+    python benchmarks/arrow_benchmark.py [--rows 10m] [--output test_results/arrow_benchmark.json]
+
+Each path runs in a fresh interpreter so that its peak memory is its own. The row path converts every row to a dict
+for the JSON attachment and to a tuple for the assertion, page by page; execute_query_and_log additionally keeps all
+of them in memory, so its numbers are a lower bound. The columnar path reads the result with to_arrow and checks the
+same condition with NumPy. The backend is selected with BIGQUERY_BACKEND like for the tests (default local here);
+on BigQuery the columnar path reads through the Storage Read API when google-cloud-bigquery-storage is installed.
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic_data import parse_rows
+
+
+PROJECT_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Reads the generated result through one path and prints its timing as JSON
+PATH_SNIPPET = """
+import sys
+import json
+import time
+import resource
+from environment import Environment
+from test_helpers.client_pool import client_pool
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+path, rows = sys.argv[1], int(sys.argv[2])
+env = Environment()
+client = client_pool.get(env)
+if env.is_local:
+    # rows rows of check-like columns generated by SQLite
+    query = f'''
+    WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i < {rows - 1})
+    SELECT DATE('2020-01-01', '+' || (i % 365) || ' days') AS install_date, 'app_' || (i % 50) AS app_name,
+        i % 1000 AS installs
+    FROM n
+    '''
+else:
+    query = f'''
+    SELECT DATE_ADD(DATE '2020-01-01', INTERVAL MOD(i, 365) DAY) AS install_date,
+        CONCAT('app_', CAST(MOD(i, 50) AS STRING)) AS app_name, MOD(i, 1000) AS installs
+    FROM (SELECT high * 1000 + low AS i
+          FROM UNNEST(GENERATE_ARRAY(0, {rows // 1000 - 1})) AS high, UNNEST(GENERATE_ARRAY(0, 999)) AS low)
+    '''
+
+start = time.perf_counter()
+results = client.query(query).result()
+if path == "rows":
+    from test_helpers.helpers import default_serializer
+    invalid = 0
+    for page in results.pages:
+        for row in page:
+            json.dumps(dict(row.items()), default=default_serializer)  # The SQL Results attachment
+            install_date, app_name, installs = row.install_date, row.app_name, row.installs
+            invalid += installs < 0
+    assert invalid == 0, f"{invalid} negative installs"
+else:
+    from test_helpers import columnar
+    table = results.to_arrow(create_bqstorage_client=True)
+    columnar.attach_arrow_results(table)
+    installs = columnar.column_values(table, "installs")
+    columnar.assert_all(table, installs >= 0, "Negative installs")
+seconds = time.perf_counter() - start
+peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT
+print(json.dumps({"seconds": seconds, "ns_per_row": seconds / rows * 1e9, "peak_rss": peak_rss}))
+client_pool.close()
+"""
+
+PATHS = ("rows", "arrow")
+
+
+def run_path(path, rows):
+    """Runs one path in a fresh interpreter and returns the timing it reports."""
+    env = dict(os.environ, BIGQUERY_BACKEND=os.getenv("BIGQUERY_BACKEND", "local"))
+    completed = subprocess.run([sys.executable, "-c", PATH_SNIPPET, path, str(rows)], cwd=PROJECT_ROOT, env=env,
+                               capture_output=True, text=True, check=True)
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", default="10m", help="Number of result rows or a scale name such as 1m")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    rows = parse_rows(args.rows)
+    results = {path: run_path(path, rows) for path in PATHS}
+    print(f"backend: {os.getenv('BIGQUERY_BACKEND', 'local')}, rows: {rows}")
+    print(f"{'path':<8}{'seconds':>10}{'ns/row':>10}{'peak MB':>10}")
+    for path, stats in results.items():
+        print(f"{path:<8}{stats['seconds']:>10.2f}{stats['ns_per_row']:>10.0f}{stats['peak_rss'] / 1024 ** 2:>10.1f}")
+    print(f"speedup: {results['rows']['seconds'] / results['arrow']['seconds']:.1f}x")
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as file:
+            json.dump({"rows": rows, "paths": results}, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+Check benchmark: generates synthetic datasets at several scales with benchmarks/synthetic_data.py, runs every check
+against each of them on the local backend in a fresh interpreter, and records per check the wall time, the peak
+memory of the session when the check finished and the agg_data rows checked per second.
+
+Usage:
+    python benchmarks/check_benchmark.py [--scales 10k,100k,1m] [--output test_results/check_benchmark.json]
+        [--baseline previous.json --tolerance 0.2]
+
+The datasets are kept in .benchmark_data/<scale> (or --data-dir) and reused while their manifest matches.
+Prefetching, the check result cache and the dry run are disabled so that each check's time is its own query.
+With --baseline, checks that got slower than the baseline by more than the tolerance are listed and the script
+exits with status 1, so a regression in a check shows up as a number.
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic_data import SyntheticDataset, parse_defects, parse_rows
+
+
+PROJECT_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+DEFAULT_DATA_DIR = os.path.join(PROJECT_ROOT, '.benchmark_data')
+
+# Runs the suite with a plugin recording the call duration and the peak RSS after every test, then prints them as JSON
+SESSION_SNIPPET = """
+import sys
+import json
+import time
+import resource
+import pytest
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT
+
+
+class Recorder:
+    def __init__(self):
+        self.checks = {}
+
+    def pytest_runtest_logreport(self, report):
+        if report.when == "call":
+            self.checks[report.nodeid] = {"seconds": report.duration, "outcome": report.outcome,
+                                          "peak_rss": peak_rss()}
+
+
+recorder = Recorder()
+start = time.perf_counter()
+pytest.main(["-q", "-o", "addopts=", "-p", "no:cacheprovider", "--no-check-cache", "--no-prefetch-checks",
+             "--no-dry-run", "tests"], plugins=[recorder])
+print(json.dumps({"seconds": time.perf_counter() - start, "peak_rss": peak_rss(), "checks": recorder.checks}))
+"""
+
+
+def prepare_dataset(data_dir, rows, seed, defects):
+    """Generates the dataset of a scale unless data_dir already holds one with the same parameters."""
+    manifest_path = os.path.join(data_dir, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as file:
+            manifest = json.load(file)
+        if (manifest["rows"], manifest["seed"], manifest["defects"], manifest["format"]) == (rows, seed, defects,
+                                                                                             "ndjson"):
+            return manifest
+    return SyntheticDataset(rows, seed=seed, defects=defects).write(data_dir)
+
+
+def run_checks(data_dir):
+    """Runs the suite against the dataset on the local backend and returns the timings it reports."""
+    env = dict(os.environ, BIGQUERY_BACKEND="local", LOCAL_BACKEND_DATA_DIR=os.path.abspath(data_dir))
+    completed = subprocess.run([sys.executable, "-c", SESSION_SNIPPET], cwd=PROJECT_ROOT, env=env,
+                               capture_output=True, text=True)
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def find_regressions(results, baseline, tolerance):
+    """Returns (scale, check, baseline seconds, seconds) for every check slower than the baseline by more than tolerance."""
+    regressions = []
+    for scale, result in results.items():
+        baseline_checks = baseline.get(scale, {}).get("checks", {})
+        for check, stats in result["checks"].items():
+            previous = baseline_checks.get(check)
+            if previous is not None and stats["seconds"] > previous["seconds"] * (1 + tolerance):
+                regressions.append((scale, check, previous["seconds"], stats["seconds"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", default="10k,100k,1m", help="Comma-separated agg_data row counts or scale names")
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR, help="Directory the datasets are generated in")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the generated datasets")
+    parser.add_argument("--defect", action="append", metavar="NAME=RATE", help="Defect injected into every dataset")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", help="Results JSON of an earlier run to compare the check times with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    defects = parse_defects(args.defect)
+    results = {}
+    print(f"{'scale':<8}{'check':<72}{'outcome':>9}{'seconds':>10}{'rows/s':>14}{'peak MB':>10}")
+    for scale in args.scales.split(","):
+        rows = parse_rows(scale)
+        manifest = prepare_dataset(os.path.join(args.data_dir, scale), rows, args.seed, defects)
+        result = run_checks(os.path.join(args.data_dir, scale))
+        for check, stats in result["checks"].items():
+            stats["rows_per_second"] = manifest["row_counts"]["agg_data"] / stats["seconds"] if stats["seconds"] else None
+            rows_per_second = f"{stats['rows_per_second']:.0f}" if stats["rows_per_second"] else "n/a"
+            print(f"{scale:<8}{check:<72}{stats['outcome']:>9}{stats['seconds']:>10.3f}{rows_per_second:>14}"
+                  f"{stats['peak_rss'] / 1024 ** 2:>10.1f}")
+        result["manifest"] = manifest
+        results[scale] = result
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=4)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            regressions = find_regressions(results, json.load(file), args.tolerance)
+        for scale, check, previous, seconds in regressions:
+            print(f"REGRESSION {scale} {check}: {previous:.3f} s -> {seconds:.3f} s")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
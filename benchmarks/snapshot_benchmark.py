@@ -0,0 +1,84 @@
+"""
+Snapshot benchmark: runs the test suite in fresh interpreters with v_agg_data queried as a view and with
+--snapshot-views, and compares the wall time of the session and the bytes processed by all of its queries
+(including the statement creating the snapshot). The check result cache is disabled so every query runs.
+
+Usage:
+    python benchmarks/snapshot_benchmark.py [--repeat 3]
+
+The backend is selected with BIGQUERY_BACKEND like for the tests. The local backend reports no bytes processed.
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+
+PROJECT_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Runs the suite with the pooled clients wrapped to record every query job, then prints the totals as JSON
+SESSION_SNIPPET = """
+import sys
+import json
+import time
+import pytest
+from test_helpers.client_pool import BigQueryClientPool
+
+jobs = []
+pooled_get = BigQueryClientPool.get
+
+def recording_get(pool, env):
+    client = pooled_get(pool, env)
+    if not getattr(client, "_benchmark_recorded", False):
+        client_query = client.query
+        def query(*args, **kwargs):
+            job = client_query(*args, **kwargs)
+            jobs.append(job)
+            return job
+        client.query = query
+        client._benchmark_recorded = True
+    return client
+
+BigQueryClientPool.get = recording_get
+start = time.perf_counter()
+pytest.main(["-q", "-o", "addopts=", "-p", "no:cacheprovider", "--no-check-cache", *sys.argv[1:], "tests"])
+elapsed = time.perf_counter() - start
+processed = [getattr(job, "total_bytes_processed", None) for job in jobs]
+print(json.dumps({"seconds": elapsed, "queries": len(jobs),
+                  "bytes": sum(processed) if processed and None not in processed else None}))
+"""
+
+MODES = {
+    "view": [],
+    "snapshot": ["--snapshot-views"],
+}
+
+
+def measure(pytest_args):
+    """Runs one test session in a fresh interpreter and returns the totals it reports."""
+    completed = subprocess.run([sys.executable, "-c", SESSION_SNIPPET, *pytest_args], cwd=PROJECT_ROOT,
+                               capture_output=True, text=True)
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def format_bytes(value):
+    return "n/a" if value is None else f"{value / 1024 ** 2:.1f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3, help="Number of test sessions per mode")
+    args = parser.parse_args()
+
+    print(f"backend: {os.getenv('BIGQUERY_BACKEND', 'bigquery')}, repeat: {args.repeat}")
+    print(f"{'mode':<12}{'queries':>9}{'median wall, s':>16}{'processed, MB':>15}")
+    for mode, pytest_args in MODES.items():
+        runs = [measure(pytest_args) for _ in range(args.repeat)]
+        print(f"{mode:<12}{runs[0]['queries']:>9}{statistics.median(run['seconds'] for run in runs):>16.2f}"
+              f"{format_bytes(runs[0]['bytes']):>15}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Startup benchmark: measures, in fresh interpreters, how long it takes to import the test suite,
+to collect a filtered subset of it and to get the first query result from the pooled client.
+
+Usage:
+    python benchmarks/startup_benchmark.py [--repeat 5]
+
+The backend is selected with BIGQUERY_BACKEND like for the tests (BIGQUERY_BACKEND=local needs no credentials).
+"""
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+
+
+PROJECT_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Each snippet runs in a new interpreter and prints the elapsed seconds of the measured phase
+# Every test module pytest collects (test_*.py) is imported, so new modules are measured without editing the list
+IMPORT_SNIPPET = """
+import os
+import glob
+import time
+import importlib
+modules = ["tests.conftest"] + sorted(f"tests.{os.path.basename(path)[:-3]}" for path in glob.glob("tests/test_*.py"))
+start = time.perf_counter()
+for module in modules:
+    importlib.import_module(module)
+print(time.perf_counter() - start)
+"""
+
+COLLECT_SNIPPET = """
+import time
+import pytest
+start = time.perf_counter()
+pytest.main(["--collect-only", "-q", "-o", "addopts=", "-p", "no:cacheprovider", "-k", "date_range", "tests"])
+print(time.perf_counter() - start)
+"""
+
+FIRST_QUERY_SNIPPET = """
+import time
+start = time.perf_counter()
+from environment import Environment
+from test_helpers.client_pool import client_pool
+client = client_pool.get(Environment())
+list(client.query("SELECT 1 AS one").result())
+print(time.perf_counter() - start)
+client_pool.close()
+"""
+
+PHASES = {
+    "import test modules": IMPORT_SNIPPET,
+    "collect -k date_range": COLLECT_SNIPPET,
+    "time to first query": FIRST_QUERY_SNIPPET,
+}
+
+
+def measure(snippet):
+    """Runs the snippet in a fresh interpreter and returns the elapsed seconds it reports."""
+    completed = subprocess.run([sys.executable, "-c", snippet], cwd=PROJECT_ROOT, capture_output=True,
+                               text=True, check=True)
+    return float(completed.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="Number of fresh interpreters per phase")
+    args = parser.parse_args()
+
+    print(f"backend: {os.getenv('BIGQUERY_BACKEND', 'bigquery')}, repeat: {args.repeat}")
+    print(f"{'phase':<24}{'min, ms':>10}{'median, ms':>12}")
+    for phase, snippet in PHASES.items():
+        timings = [measure(snippet) * 1000 for _ in range(args.repeat)]
+        print(f"{phase:<24}{min(timings):>10.1f}{statistics.median(timings):>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+"""
+Synthetic data generator: writes referentially consistent agg_data, app_names, device_segments and geo_segments
+tables at any scale, with skewed app and device-model popularity and optionally injected defects.
+
+Usage:
+    python benchmarks/synthetic_data.py --rows 1m --output .benchmark_data/1m [--format parquet]
+        [--defect unknown_device_model=0.001 --defect duplicate_rows=0.0005] [--seed 42]
+
+Every table is written as <table>.json (newline-delimited JSON, loadable by src/db_table_creation.py and the local
+backend) or <table>.parquet. agg_data is generated one install date at a time, so memory stays flat at every scale.
+Without defects the data passes the checks, except test_unrealistic_high_installs once an app sums more than
+1M installs, which happens from about 1M rows on. A manifest.json records the parameters and the injected defects.
+"""
+import os
+import sys
+import json
+import argparse
+from datetime import date, timedelta
+import numpy as np
+
+
+# Row counts accepted by --rows by name
+SCALES = {
+    "10k": 10_000,
+    "100k": 100_000,
+    "1m": 1_000_000,
+    "10m": 10_000_000,
+    "100m": 100_000_000,
+}
+
+# Install dates of the generated agg_data rows; v_agg_data keeps the rows from 2020-02-01 on
+FIRST_INSTALL_DATE = date(2020, 2, 1)
+LAST_INSTALL_DATE = date(2023, 12, 31)
+# Device models per platform and the families their names are built from
+MODELS_PER_PLATFORM = 400
+MODEL_FAMILIES = {
+    "as": ["IPHONE", "IPHONE PLUS", "IPHONE PRO", "IPHONE PRO MAX", "IPHONE MINI", "IPAD", "IPAD AIR", "IPAD MINI",
+           "IPAD PRO", "IPOD TOUCH"],
+    "gp": ["GALAXY S", "GALAXY A", "GALAXY NOTE", "REDMI", "REDMI NOTE", "PIXEL", "MOTO G", "ONEPLUS", "MI", "POCO"],
+}
+PLATFORMS = list(MODEL_FAMILIES)
+# Segments by share of the most popular models; each app has its own segment names so that
+# (device_model, segment) stays unique across apps, as device_segments_uniqueness requires
+SEGMENT_TIERS = [("01_Top", 0.05), ("02_Mid1", 0.15), ("03_Mid2", 0.30), ("04_Low", 0.60), ("05_Other", 1.0)]
+GEOS = ["US", "GB", "DE", "FR", "JP", "BR", "IN", "AR", "LT", "CL", "BG", "GU"]
+# Zipf exponents of the app and device-model popularity
+APP_SKEW = 1.1
+MODEL_SKEW = 1.2
+# Average number of candidate (app, device model) pairs per agg_data row of a day; more pairs mean more skew
+PAIRS_PER_DAILY_ROW = 4
+FIRST_APP_ID = 30000
+
+# Defects that can be injected into agg_data, as a share of its rows
+DEFECTS = (
+    "null_device_model",      # device_model is NULL
+    "empty_device_model",     # device_model is ''
+    "unknown_device_model",   # device_model missing from device_segments
+    "unknown_app_id",         # app_id missing from app_names
+    "non_positive_installs",  # installs <= 0
+    "high_installs",          # installs far above any realistic value
+    "early_install_date",     # install_date before 2020-01-01
+    "duplicate_rows",         # the row appears twice
+)
+
+
+def parse_rows(value):
+    """Returns the number of rows of a scale name such as 1m or of a plain number."""
+    return SCALES.get(value.lower()) or int(value)
+
+
+def zipf_weights(count, skew, rng):
+    """Returns normalized Zipf weights over count items, assigned to the items in random order."""
+    weights = 1.0 / np.arange(1, count + 1) ** skew
+    rng.shuffle(weights)
+    return weights / weights.sum()
+
+
+class NdjsonWriter:
+    """Writes the rows of one table as newline-delimited JSON."""
+
+    extension = "json"
+
+    def __init__(self, path, field_names):
+        self.field_names = field_names
+        self._file = open(path, 'w', encoding='utf-8')
+
+    def write(self, columns):
+        names = [json.dumps(name) for name in self.field_names]
+        values = [columns[name] for name in self.field_names]
+        self._file.writelines(
+            "{" + ", ".join(f"{name}: {json.dumps(value)}" for name, value in zip(names, row)) + "}\n"
+            for row in zip(*values))
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetWriter:
+    """Writes the rows of one table as Parquet, one row group per write."""
+
+    extension = "parquet"
+
+    def __init__(self, path, field_names):
+        # pyarrow is only needed for Parquet output
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("Parquet output needs pyarrow: pip install pyarrow")
+        self._pyarrow = pyarrow
+        self._path = path
+        self.field_names = field_names
+        self._writer = None
+
+    def write(self, columns):
+        table = self._pyarrow.table({name: list(columns[name]) for name in self.field_names})
+        if self._writer is None:
+            self._writer = self._pyarrow.parquet.ParquetWriter(self._path, table.schema)
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+WRITERS = {"ndjson": NdjsonWriter, "parquet": ParquetWriter}
+
+
+class SyntheticDataset:
+    """
+    Synthetic tables sized by the number of agg_data rows. Apps and device models follow Zipf distributions;
+    every day the (app, device model) pairs with installs are drawn by popularity without replacement,
+    so (app_id, install_date, device_model) is unique and popular pairs appear on most days with more installs.
+    """
+
+    def __init__(self, rows, seed=42, defects=None, apps=None):
+        unknown = set(defects or {}) - set(DEFECTS)
+        if unknown:
+            raise ValueError(f"Unknown defects: {', '.join(sorted(unknown))}")
+        self.rows = rows
+        self.seed = seed
+        self.defects = dict(defects or {})
+        self.days = (LAST_INSTALL_DATE - FIRST_INSTALL_DATE).days + 1
+        self.rng = np.random.default_rng(seed)
+
+        daily_rows = -(-rows // self.days)
+        self.apps = apps or max(4, -(-daily_rows * PAIRS_PER_DAILY_ROW // MODELS_PER_PLATFORM))
+        self.app_ids = np.arange(FIRST_APP_ID, FIRST_APP_ID + self.apps)
+        self.app_platforms = [PLATFORMS[index % len(PLATFORMS)] for index in range(self.apps)]
+        self.app_names = [f"app{index:04d}_{platform}" for index, platform in enumerate(self.app_platforms)]
+        generations = -(-MODELS_PER_PLATFORM // len(MODEL_FAMILIES[PLATFORMS[0]]))
+        self.models = {platform: [f"{family} {generation}" for generation in range(1, generations + 1)
+                                  for family in families][:MODELS_PER_PLATFORM]
+                       for platform, families in MODEL_FAMILIES.items()}
+
+        # Every (app, device model rank) pair and its share of the installs
+        app_weights = zipf_weights(self.apps, APP_SKEW, self.rng)
+        model_weights = zipf_weights(MODELS_PER_PLATFORM, MODEL_SKEW, self.rng)
+        self.model_ranks = np.argsort(np.argsort(-model_weights))  # 0 for the most popular model
+        self.pair_apps = np.repeat(np.arange(self.apps), MODELS_PER_PLATFORM)
+        self.pair_models = np.tile(np.arange(MODELS_PER_PLATFORM), self.apps)
+        pair_weights = app_weights[self.pair_apps] * model_weights[self.pair_models]
+        self.pair_log_weights = np.log(pair_weights)
+        self.pair_mean_installs = np.clip(2 * pair_weights / pair_weights.mean(), 0.5, 20)
+        self.pair_model_names = np.array(
+            [self.models[self.app_platforms[app]][model] for app, model in zip(self.pair_apps, self.pair_models)],
+            dtype=object)
+        if rows > len(self.pair_apps) * self.days:
+            raise ValueError(f"{rows} rows do not fit in {self.apps} apps over {self.days} days")
+        self.injected = {name: 0 for name in self.defects}
+
+    def segment(self, app, model):
+        """Segment of a device model for an app, by the model's popularity rank."""
+        share = (self.model_ranks[model] + 1) / MODELS_PER_PLATFORM
+        tier = next(name for name, upper in SEGMENT_TIERS if share <= upper)
+        return f"{tier}_{self.app_names[app]}"
+
+    def app_names_columns(self):
+        return {"app_id": self.app_ids.tolist(), "app_name": self.app_names, "platform": self.app_platforms}
+
+    def device_segments_columns(self):
+        apps, models = self.pair_apps.tolist(), self.pair_models.tolist()
+        return {
+            "device_model": self.pair_model_names.tolist(),
+            "segment": [self.segment(app, model) for app, model in zip(apps, models)],
+            "app_short": [self.app_names[app] for app in apps],
+            "platform": [self.app_platforms[app] for app in apps],
+            "ua_team": ["network"] * len(apps),  # v_agg_data joins the segments of ua_team = 'network'
+        }
+
+    def geo_segments_columns(self):
+        # v_agg_data joins every 'Network' geo row of the app's platform, so only one per platform is 'Network'
+        rows = [(geo, f"{index % 6 + 1:02d}_{geo}", platform, "Network" if index == 0 else "Organic")
+                for platform in PLATFORMS for index, geo in enumerate(GEOS)]
+        return dict(zip(("geo", "segment", "platform", "ua_team"), (list(column) for column in zip(*rows))))
+
+    def agg_data_batches(self):
+        """Yields the agg_data rows of one install date at a time as a dict of columns."""
+        base_rows, extra_rows = divmod(self.rows, self.days)
+        for day in range(self.days):
+            size = base_rows + (1 if day < extra_rows else 0)
+            if not size:
+                continue
+            # Weighted sampling without replacement: the size pairs with the largest Gumbel-perturbed log weights
+            keys = self.pair_log_weights + self.rng.gumbel(size=len(self.pair_log_weights))
+            pairs = np.argpartition(-keys, size - 1)[:size] if size < len(keys) else np.arange(len(keys))
+            install_date = (FIRST_INSTALL_DATE + timedelta(days=day)).isoformat()
+            columns = {
+                "app_id": self.app_ids[self.pair_apps[pairs]].tolist(),
+                "install_date": [install_date] * size,
+                "device_model": self.pair_model_names[pairs].tolist(),
+                "installs": (1 + self.rng.poisson(self.pair_mean_installs[pairs])).tolist(),
+            }
+            yield self.inject_defects(columns)
+
+    def inject_defects(self, columns):
+        """Applies each configured defect to a binomially drawn number of rows of the batch."""
+        size = len(columns["app_id"])
+        for name, rate in self.defects.items():
+            count = int(self.rng.binomial(size, rate))
+            if not count:
+                continue
+            self.injected[name] += count
+            positions = self.rng.choice(size, count, replace=False).tolist()
+            if name == "duplicate_rows":
+                for column in columns.values():
+                    column.extend(column[position] for position in positions)
+                continue
+            for position in positions:
+                if name == "null_device_model":
+                    columns["device_model"][position] = None
+                elif name == "empty_device_model":
+                    columns["device_model"][position] = ""
+                elif name == "unknown_device_model":
+                    columns["device_model"][position] = f"UNKNOWN {position}"
+                elif name == "unknown_app_id":
+                    columns["app_id"][position] = 1 + position % (FIRST_APP_ID - 1)
+                elif name == "non_positive_installs":
+                    columns["installs"][position] = -int(self.rng.integers(0, 10))
+                elif name == "high_installs":
+                    columns["installs"][position] = 2_000_000
+                elif name == "early_install_date":
+                    columns["install_date"][position] = (date(2019, 12, 31) - timedelta(
+                        days=int(self.rng.integers(0, 365)))).isoformat()
+        return columns
+
+    def write(self, output_dir, output_format="ndjson"):
+        """Writes every table to output_dir and returns the manifest, which is also written as manifest.json."""
+        os.makedirs(output_dir, exist_ok=True)
+        writer_class = WRITERS[output_format]
+        row_counts = {}
+        tables = {
+            "app_names": [self.app_names_columns()],
+            "device_segments": [self.device_segments_columns()],
+            "geo_segments": [self.geo_segments_columns()],
+            "agg_data": self.agg_data_batches(),
+        }
+        for table_name, batches in tables.items():
+            writer = None
+            row_counts[table_name] = 0
+            for columns in batches:
+                if writer is None:
+                    writer = writer_class(os.path.join(output_dir, f"{table_name}.{writer_class.extension}"),
+                                          list(columns))
+                writer.write(columns)
+                row_counts[table_name] += len(next(iter(columns.values())))
+            if writer is not None:
+                writer.close()
+
+        manifest = {
+            "rows": self.rows,
+            "seed": self.seed,
+            "format": output_format,
+            "apps": self.apps,
+            "defects": self.defects,
+            "injected_defects": self.injected,
+            "row_counts": row_counts,
+        }
+        with open(os.path.join(output_dir, "manifest.json"), 'w') as file:
+            json.dump(manifest, file, indent=4)
+        return manifest
+
+
+def parse_defects(values):
+    """Parses name=rate pairs given with --defect."""
+    defects = {}
+    for value in values or []:
+        name, _, rate = value.partition("=")
+        defects[name] = float(rate)
+    return defects
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", default="10k", help=f"agg_data rows: a number or one of {', '.join(SCALES)}")
+    parser.add_argument("--output", required=True, help="Directory the tables are written to")
+    parser.add_argument("--format", choices=list(WRITERS), default="ndjson", help="Output file format")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the random generator")
+    parser.add_argument("--apps", type=int, default=None, help="Number of apps; sized by the row count by default")
+    parser.add_argument("--defect", action="append", metavar="NAME=RATE",
+                        help=f"Inject a defect into a share of the agg_data rows; one of {', '.join(DEFECTS)}")
+    args = parser.parse_args(argv)
+
+    dataset = SyntheticDataset(parse_rows(args.rows), seed=args.seed, defects=parse_defects(args.defect),
+                               apps=args.apps)
+    manifest = dataset.write(args.output, args.format)
+    json.dump(manifest, sys.stdout, indent=4)
+    print()
+
+
+if __name__ == "__main__":
+    main()
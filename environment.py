@@ -1,14 +1,37 @@
 import os
-from google.cloud import bigquery
-from google.oauth2.service_account import Credentials
+
+
+# Backends that create_bq_client can return a client for
+BIGQUERY_BACKEND = "bigquery"
+LOCAL_BACKEND = "local"
 
 
 class Environment:
+    # Table names resolved to another table for the rest of the session, e.g. a view to its materialized snapshot
+    _table_overrides = {}
+
     def __init__(self):
-        # Retrieve required environment variables, raise an exception if they are not set
-        self.google_application_credentials = self._get_env_variable("GOOGLE_APPLICATION_CREDENTIALS")
-        self.gcp_project_id = self._get_env_variable("GCP_PROJECT_ID")
-        self.bigquery_dataset_id = self._get_env_variable("BIGQUERY_DATASET_ID")
+        # Select the query backend: the real BigQuery service (default) or the in-process local stand-in
+        self.backend = os.getenv("BIGQUERY_BACKEND", BIGQUERY_BACKEND).lower()
+        if self.backend not in (BIGQUERY_BACKEND, LOCAL_BACKEND):
+            raise ValueError(f"Unsupported BIGQUERY_BACKEND: {self.backend}")
+
+        if self.backend == LOCAL_BACKEND:
+            # The local backend needs no credentials; project and dataset only name the local tables
+            self.google_application_credentials = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
+            self.gcp_project_id = os.getenv("GCP_PROJECT_ID", "local-project")
+            self.bigquery_dataset_id = os.getenv("BIGQUERY_DATASET_ID", "local_dataset")
+            self.local_data_dir = os.getenv("LOCAL_BACKEND_DATA_DIR")
+        else:
+            # Retrieve required environment variables, raise an exception if they are not set
+            self.google_application_credentials = self._get_env_variable("GOOGLE_APPLICATION_CREDENTIALS")
+            self.gcp_project_id = self._get_env_variable("GCP_PROJECT_ID")
+            self.bigquery_dataset_id = self._get_env_variable("BIGQUERY_DATASET_ID")
+
+    @property
+    def is_local(self):
+        """True when the checks run against the local backend."""
+        return self.backend == LOCAL_BACKEND
 
     def _get_env_variable(self, var_name):
         """Fetches the environment variable, raises an exception if it is not set."""
@@ -17,12 +40,47 @@ class Environment:
             raise ValueError(f"Environment variable {var_name} is not set")
         return value
 
-    def create_bq_client(self):
-        """Creates and returns a BigQuery client using credentials from the service account file."""
-        credentials = Credentials.from_service_account_file(
-            self.google_application_credentials)
-        return bigquery.Client(credentials=credentials, project=self.gcp_project_id)
+    def load_credentials(self):
+        """Loads the credentials from the service account file."""
+        # The google libraries are imported on first use to keep test collection fast
+        from google.oauth2.service_account import Credentials
+        return Credentials.from_service_account_file(self.google_application_credentials)
+
+    def create_bq_client(self, credentials=None, http=None):
+        """
+        Creates and returns a BigQuery client using credentials from the service account file,
+        or a client-compatible local stand-in preloaded from data/*.json when BIGQUERY_BACKEND=local.
+        Already loaded credentials and an authorized HTTP session can be passed in to share them between clients.
+        """
+        if self.is_local:
+            from test_helpers.local_backend import LocalBigQueryClient
+            return LocalBigQueryClient(self.gcp_project_id, self.bigquery_dataset_id, data_dir=self.local_data_dir)
+
+        from google.cloud import bigquery
+        if credentials is None:
+            credentials = self.load_credentials()
+        return bigquery.Client(credentials=credentials, project=self.gcp_project_id, _http=http)
+
+    def get_full_table_id(self, table_name, override=True):
+        """
+        Returns the full table identifier in the format 'project.dataset.table'.
+        The table overriding table_name is returned instead unless override is False.
+        """
+        full_table_id = f"{self.gcp_project_id}.{self.bigquery_dataset_id}.{table_name}"
+        return Environment._table_overrides.get(full_table_id, full_table_id) if override else full_table_id
+
+    @staticmethod
+    def override_table(full_table_id, replacement_id):
+        """Makes every Environment resolve full_table_id to replacement_id until the overrides are cleared."""
+        Environment._table_overrides[full_table_id] = replacement_id
+
+    @staticmethod
+    def overridden_table(full_table_id):
+        """Returns the table that full_table_id overrides, or full_table_id itself if it overrides none."""
+        sources = {replacement_id: source_id for source_id, replacement_id in Environment._table_overrides.items()}
+        return sources.get(full_table_id, full_table_id)
 
-    def get_full_table_id(self, table_name):
-        """Returns the full table identifier in the format 'project.dataset.table'."""
-        return f"{self.gcp_project_id}.{self.bigquery_dataset_id}.{table_name}"
+    @staticmethod
+    def clear_table_overrides():
+        """Resolves every table to itself again."""
+        Environment._table_overrides.clear()
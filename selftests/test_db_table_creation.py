@@ -0,0 +1,175 @@
+import os
+import json
+import pytest
+from google.api_core.exceptions import NotFound
+from src.db_table_creation import (build_merge_query, changed_keys, key_fingerprints, staging_records,
+                                   upsert_json_to_bigquery)
+from src.definitions import schema_agg_data, natural_keys
+
+
+KEYS = natural_keys["agg_data"]
+ROWS = [
+    {"app_id": 1, "install_date": "2024-01-01", "device_model": "A", "installs": 10},
+    {"app_id": 1, "install_date": "2024-01-01", "device_model": None, "installs": 3},
+    {"app_id": 2, "install_date": "2024-01-02", "device_model": "B", "installs": 5},
+    {"app_id": 3, "install_date": "2024-01-03", "device_model": "C", "installs": 7},
+]
+
+
+class _Job:
+    num_dml_affected_rows = None
+
+    def result(self):
+        return []
+
+
+class FakeClient:
+    """Records the load jobs, queries and deletions of the loader instead of sending them to BigQuery."""
+
+    def __init__(self, project="project"):
+        self.project = project
+        self.tables = {}  # table id -> rows of its last load job
+        self.loads = []  # (table id, write disposition, rows) of every load job
+        self.queries = []
+        self.deleted = []
+
+    def get_table(self, table_id):
+        if table_id not in self.tables:
+            raise NotFound(table_id)
+        return table_id
+
+    def load_table_from_file(self, file, table_id, job_config=None, rewind=False):
+        file.seek(0)
+        rows = [json.loads(line) for line in file.read().decode('utf-8').splitlines()]
+        self.loads.append((table_id, job_config.write_disposition, rows))
+        self.tables[table_id] = rows
+        return _Job()
+
+    def query(self, query, **kwargs):
+        self.queries.append(query)
+        return _Job()
+
+    def delete_table(self, table_id, not_found_ok=False):
+        self.deleted.append(table_id)
+        self.tables.pop(table_id, None)
+
+
+def write_rows(path, rows):
+    with open(path, 'w') as file:
+        json.dump(rows, file)
+
+
+@pytest.fixture()
+def source(tmp_path):
+    path = tmp_path / "agg_data.json"
+    write_rows(path, ROWS)
+    return str(path)
+
+
+def upsert(client, source, tmp_path, **kwargs):
+    return upsert_json_to_bigquery(client, "dataset", source, "agg_data", schema_agg_data, KEYS,
+                                   state_dir=str(tmp_path / "state"), **kwargs)
+
+
+def load_state(tmp_path):
+    with open(tmp_path / "state" / "project.dataset.agg_data.json") as file:
+        return json.load(file)
+
+
+def test_merge_query_matches_keys_null_safely():
+    """Checks that the MERGE deletes on the delete markers of the natural key and inserts the other staging rows."""
+    query = build_merge_query("p.d.agg_data", "p.d.agg_data_staging", schema_agg_data, KEYS)
+
+    assert "MERGE `p.d.agg_data` AS target" in query and "USING `p.d.agg_data_staging` AS staging" in query
+    assert ("ON staging._op = 'delete' AND target.app_id IS NOT DISTINCT FROM staging.app_id AND "
+            "target.install_date IS NOT DISTINCT FROM staging.install_date AND "
+            "target.device_model IS NOT DISTINCT FROM staging.device_model") in query
+    assert "WHEN NOT MATCHED BY TARGET AND staging._op = 'insert' THEN" in query
+    assert ("INSERT (app_id, install_date, device_model, installs) VALUES "
+            "(staging.app_id, staging.install_date, staging.device_model, staging.installs)") in query
+
+
+def test_key_fingerprints_group_rows_of_a_key():
+    """Checks that the rows sharing a key are fingerprinted together, in any order."""
+    shared_key = [dict(ROWS[0], installs=1), dict(ROWS[0], installs=2)]
+
+    fingerprints = key_fingerprints(shared_key, schema_agg_data, KEYS)
+
+    assert list(fingerprints) == [json.dumps([1, "2024-01-01", "A"])]
+    assert fingerprints == key_fingerprints(shared_key[::-1], schema_agg_data, KEYS)
+    assert fingerprints != key_fingerprints(shared_key[:1], schema_agg_data, KEYS)
+
+
+def test_changed_keys():
+    previous = {"a": "1", "b": "2", "c": "3"}
+    current = {"a": "1", "b": "9", "d": "4"}
+
+    assert changed_keys(previous, current) == ({"d"}, {"b"}, {"c"})
+
+
+def test_staging_records_hold_only_the_changed_keys(source):
+    """Checks that the staging rows are delete markers of the removed keys and the source rows of the added keys."""
+    removed = {json.dumps([2, "2024-01-02", "B"])}
+    added = {json.dumps([1, "2024-01-01", None])}
+
+    records = list(staging_records(source, schema_agg_data, KEYS, removed, added))
+
+    assert records == [{"app_id": 2, "install_date": "2024-01-02", "device_model": "B", "_op": "delete"},
+                       {**ROWS[1], "_op": "insert"}]
+
+
+def test_first_load_replaces_the_table_and_stores_fingerprints(tmp_path, source):
+    client = FakeClient()
+
+    upsert(client, source, tmp_path)
+
+    assert client.loads == [("project.dataset.agg_data", "WRITE_TRUNCATE", ROWS)]
+    assert len(load_state(tmp_path)["keys"]) == len(ROWS)
+
+
+def test_unchanged_file_is_skipped(tmp_path, source):
+    client = FakeClient()
+    upsert(client, source, tmp_path)
+    client.loads.clear()
+
+    upsert(client, source, tmp_path)
+
+    assert client.loads == [] and client.queries == []
+
+
+def test_upsert_stages_only_the_changed_keys(tmp_path, source):
+    """Checks that an inserted, a changed and a deleted key are the only rows staged and merged."""
+    client = FakeClient()
+    upsert(client, source, tmp_path)
+    client.loads.clear()
+    inserted = {"app_id": 4, "install_date": "2024-01-04", "device_model": "D", "installs": 1}
+    changed = dict(ROWS[2], installs=50)
+    write_rows(source, [ROWS[0], ROWS[1], changed, inserted])
+
+    upsert(client, source, tmp_path)
+
+    [(staging_id, disposition, staged)] = client.loads
+    assert staging_id == "project.dataset.agg_data_staging" and disposition == "WRITE_TRUNCATE"
+    deleted_markers = sorted((row["app_id"], row["_op"]) for row in staged if row["_op"] == "delete")
+    assert deleted_markers == [(2, "delete"), (3, "delete")]
+    assert [row for row in staged if row["_op"] == "insert"] == [{**changed, "_op": "insert"},
+                                                                 {**inserted, "_op": "insert"}]
+    assert client.queries == [build_merge_query("project.dataset.agg_data", staging_id, schema_agg_data, KEYS)]
+    assert client.deleted == [staging_id]
+    assert len(load_state(tmp_path)["keys"]) == 4
+
+
+def test_full_reload_stores_fingerprints(tmp_path, source):
+    """Checks that a full reload replaces the table even when nothing changed, and keeps the state for the next run."""
+    client = FakeClient()
+    upsert(client, source, tmp_path)
+    os.remove(tmp_path / "state" / "project.dataset.agg_data.json")
+
+    upsert(client, source, tmp_path, full_reload=True)
+    upsert(client, source, tmp_path, full_reload=True)
+
+    assert [table_id for table_id, _, _ in client.loads] == ["project.dataset.agg_data"] * 3
+    assert len(load_state(tmp_path)["keys"]) == len(ROWS)
+    client.loads.clear()
+    upsert(client, source, tmp_path)
+    assert client.loads == []
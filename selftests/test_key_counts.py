@@ -0,0 +1,85 @@
+import pytest
+from environment import Environment
+from test_helpers.incremental import CheckWindow
+from test_helpers.key_counts import KeyCountStore
+
+
+# Rows of the generated table: one per app_id and install_date, 1000 apps over 200 days
+TABLE_NAME = "key_count_installs"
+ROWS = 200_000
+
+
+class RecordingClient:
+    """Passes the queries on to the backend and keeps their text."""
+
+    def __init__(self, bq_client):
+        self.bq_client = bq_client
+        self.queries = []
+
+    def query(self, query, **kwargs):
+        self.queries.append(query)
+        return self.bq_client.query(query, **kwargs)
+
+
+@pytest.fixture(scope="module")
+def env():
+    if not Environment().is_local:
+        pytest.skip("Key counts are checked on a generated table of the local backend")
+    return Environment()
+
+
+@pytest.fixture()
+def client(env):
+    bq_client = env.create_bq_client()
+    bq_client.query(f"""
+    CREATE TABLE `{env.get_full_table_id(TABLE_NAME)}` AS
+    WITH RECURSIVE numbers(n) AS (SELECT 0 UNION ALL SELECT n + 1 FROM numbers WHERE n + 1 < {ROWS})
+    SELECT n % 1000 AS app_id, DATE('2024-01-01', '+' || (n / 1000) || ' days') AS install_date, n AS installs
+    FROM numbers
+    """).result()
+    return RecordingClient(bq_client)
+
+
+def add_duplicate(env, client, install_date):
+    client.query(f"""
+    INSERT INTO `{env.get_full_table_id(TABLE_NAME)}` (app_id, install_date, installs)
+    SELECT app_id, install_date, installs FROM `{env.get_full_table_id(TABLE_NAME)}`
+    WHERE install_date = '{install_date}' LIMIT 1
+    """).result()
+
+
+def test_unique_keys_skip_the_exact_query(env, client):
+    """Checks that a table of unique keys agrees from one aggregate, without the exact GROUP BY query."""
+    comparison = KeyCountStore(client, env).compare_with_rows("unique_installs", TABLE_NAME, ["app_id", "install_date"])
+
+    assert comparison.agrees
+    assert (comparison.distinct_keys, comparison.expected) == (ROWS, ROWS)
+    assert len(client.queries) == 1 and "GROUP BY" not in client.queries[0]
+
+
+def test_one_duplicate_disagrees(env, client):
+    """Checks that a single duplicate among the rows is found, so the exact query runs."""
+    add_duplicate(env, client, "2024-03-01")
+
+    comparison = KeyCountStore(client, env).compare_with_rows("unique_installs", TABLE_NAME, ["app_id", "install_date"])
+
+    assert not comparison.agrees and comparison.duplicates == 1
+
+
+def test_incremental_window_recounts_only_its_partitions(env, client):
+    """Checks that an incremental window recounts its own partitions and reads the others from the store."""
+    store = KeyCountStore(client, env)
+    columns = ["app_id", "install_date"]
+    full_window = CheckWindow(upper="2024-07-18")
+    assert store.compare_with_rows("unique_installs", TABLE_NAME, columns, window=full_window).agrees
+
+    # A duplicate outside the window goes unnoticed until the next full count, one inside it is found
+    add_duplicate(env, client, "2024-02-01")
+    add_duplicate(env, client, "2024-07-10")
+    client.queries.clear()
+    window = CheckWindow(lower="2024-07-01", upper="2024-07-18", full=False)
+    comparison = store.compare_with_rows("unique_installs", TABLE_NAME, columns, window=window)
+
+    assert comparison.duplicates == 1 and comparison.expected == ROWS + 1
+    recount = next(query for query in client.queries if "COUNT(DISTINCT" in query)
+    assert window.predicate in recount
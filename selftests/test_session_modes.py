@@ -0,0 +1,36 @@
+import os
+import sys
+import subprocess
+import pytest
+from environment import Environment
+from src.fan_out import read_junit_report
+
+
+PROJECT_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Session options whose combinations must evaluate the same checks as a plain run
+SESSION_MODES = [
+    ["--snapshot-views", "--shard-checks"],
+    ["--share-intermediates", "--shard-checks"],
+]
+
+
+def run_checks(tmp_path, name, options):
+    """Runs the data checks in a separate session on the local backend and returns its outcomes and output."""
+    junit_path = tmp_path / f"{name}.xml"
+    command = [sys.executable, "-m", "pytest", "-q", "-o", "addopts=", "-p", "no:cacheprovider", "--no-check-cache",
+               f"--junitxml={junit_path}", *options, "tests/"]
+    completed = subprocess.run(command, cwd=PROJECT_ROOT, capture_output=True, text=True,
+                               env=dict(os.environ, BIGQUERY_BACKEND="local"))
+    return read_junit_report(str(junit_path)), completed.stdout + completed.stderr
+
+
+@pytest.mark.skipif(not Environment().is_local, reason="Session modes are compared on the local backend")
+@pytest.mark.parametrize("options", SESSION_MODES, ids=" ".join)
+def test_session_mode_outcomes(tmp_path, options):
+    """Checks that combined session options neither break nor change the outcome of any check."""
+    (expected_counts, expected_failed), _ = run_checks(tmp_path, "plain", [])
+    (counts, failed), output = run_checks(tmp_path, "combined", options)
+
+    assert "OperationalError" not in output, output
+    assert counts == expected_counts and sorted(failed) == sorted(expected_failed), output
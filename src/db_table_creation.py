@@ -1,9 +1,21 @@
+import io
 import os
+import sys
 import json
+import time
+import hashlib
+import argparse
+from datetime import date
 from google.cloud import bigquery
+from google.api_core.exceptions import NotFound
 from google.oauth2 import service_account
 from dotenv import load_dotenv
 
+# Allow running the module as a script from the project root
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from src.definitions import READ_SIZE, Field, base_path, iter_json_records, json_files_schemas, natural_keys
+
 # Load environment variables from a file located at the project root
 dotenv_path = os.path.join(os.path.dirname(__file__), '..', '.env')
 load_dotenv(dotenv_path=dotenv_path)
@@ -13,54 +25,258 @@ service_account_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
 project_id = os.getenv("GCP_PROJECT_ID")
 dataset_id = os.getenv("BIGQUERY_DATASET_ID")
 
-# Create a BigQuery client
-credentials = service_account.Credentials.from_service_account_file(service_account_path)
-client = bigquery.Client(credentials=credentials, project=project_id)
-
-# Table schemas
-schema_agg_data = [
-    bigquery.SchemaField("app_id", "INTEGER"),
-    bigquery.SchemaField("install_date", "DATE"),
-    bigquery.SchemaField("device_model", "STRING", mode="NULLABLE"),
-    bigquery.SchemaField("installs", "INTEGER"),
-]
-
-schema_app_names = [
-    bigquery.SchemaField("app_id", "INTEGER"),
-    bigquery.SchemaField("app_name", "STRING"),
-    bigquery.SchemaField("platform", "STRING"),
-]
-
-schema_device_segments = [
-    bigquery.SchemaField("device_model", "STRING"),
-    bigquery.SchemaField("segment", "STRING"),
-    bigquery.SchemaField("app_short", "STRING"),
-    bigquery.SchemaField("platform", "STRING"),
-    bigquery.SchemaField("ua_team", "STRING"),
-]
-
-schema_geo_segments = [
-    bigquery.SchemaField("geo", "STRING"),
-    bigquery.SchemaField("segment", "STRING"),
-    bigquery.SchemaField("platform", "STRING"),
-    bigquery.SchemaField("ua_team", "STRING"),
-]
+# Number of rows uploaded per load job
+DEFAULT_CHUNK_ROWS = int(os.getenv("LOAD_CHUNK_ROWS", "100000"))
+
+# Directory keeping the fingerprints of the last load of every table
+DEFAULT_LOAD_STATE_DIR = os.getenv("LOAD_STATE_DIR", os.path.join(os.path.dirname(__file__), '..', '.load_state'))
+
+# Python types accepted for each BigQuery column type
+_FIELD_TYPES = {
+    "INTEGER": (int,),
+    "INT64": (int,),
+    "FLOAT": (int, float),
+    "FLOAT64": (int, float),
+    "NUMERIC": (int, float),
+    "BOOLEAN": (bool,),
+    "BOOL": (bool,),
+    "STRING": (str,),
+    "DATE": (str,),
+    "DATETIME": (str,),
+    "TIMESTAMP": (str,),
+}
+
+
+def validate_record(record, schema, record_number=None):
+    """Checks a record against the table schema: no unknown fields, REQUIRED fields set, values of the column type."""
+    where = f"record {record_number}" if record_number is not None else "record"
+    if not isinstance(record, dict):
+        raise ValueError(f"{where} is not a JSON object: {record!r}")
+    fields = {field.name: field for field in schema}
+    unknown = set(record) - set(fields)
+    if unknown:
+        raise ValueError(f"{where} has fields missing in the schema: {', '.join(sorted(unknown))}")
+    for name, field in fields.items():
+        value = record.get(name)
+        if value is None:
+            if field.mode == "REQUIRED":
+                raise ValueError(f"{where} has no value for the REQUIRED field {name}")
+            continue
+        accepted = _FIELD_TYPES.get(field.field_type)
+        # bool is a subclass of int, but BigQuery does not accept true/false in INTEGER columns
+        if accepted is not None and (not isinstance(value, accepted) or
+                                     (isinstance(value, bool) and bool not in accepted)):
+            raise ValueError(f"{where} has a {type(value).__name__} in the {field.field_type} field {name}: {value!r}")
+        if field.field_type == "DATE":
+            try:
+                date.fromisoformat(value)
+            except ValueError:
+                raise ValueError(f"{where} has an invalid DATE in the field {name}: {value!r}")
+
+
+def schema_fields(schema):
+    """Returns the bigquery.SchemaFields of a schema declared in src/definitions.py."""
+    return [bigquery.SchemaField(field.name, field.field_type, mode=field.mode) for field in schema]
+
+
+def upload_records(client, table_id, schema, records, write_disposition, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Uploads the records as newline-delimited JSON in load jobs of at most chunk_rows rows. The first job uses
+    write_disposition and the following ones append. Returns the number of rows and bytes uploaded.
+    """
+    uploaded_rows = 0
+    uploaded_bytes = 0
+    chunk = io.BytesIO()
+    chunk_size = 0
+
+    def upload(disposition):
+        job_config = bigquery.LoadJobConfig(
+            schema=schema_fields(schema),
+            source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+            write_disposition=disposition,
+        )
+        client.load_table_from_file(chunk, table_id, job_config=job_config, rewind=True).result()
+
+    for record in records:
+        chunk.write(json.dumps(record).encode('utf-8') + b"\n")
+        chunk_size += 1
+        if chunk_size == chunk_rows:
+            upload(write_disposition if uploaded_rows == 0 else bigquery.WriteDisposition.WRITE_APPEND)
+            uploaded_rows += chunk_size
+            uploaded_bytes += chunk.tell()
+            chunk, chunk_size = io.BytesIO(), 0
+
+    if chunk_size or uploaded_rows == 0:
+        # The last partial chunk; an empty source still applies the write disposition
+        upload(write_disposition if uploaded_rows == 0 else bigquery.WriteDisposition.WRITE_APPEND)
+        uploaded_rows += chunk_size
+        uploaded_bytes += chunk.tell()
+    return uploaded_rows, uploaded_bytes
+
+
+def iter_valid_records(json_filepath, schema):
+    """Yields the records of the JSON source after validating each of them against the schema."""
+    for record_number, record in enumerate(iter_json_records(json_filepath), start=1):
+        validate_record(record, schema, record_number)
+        yield record
+
 
 # Function to load data from a JSON file into BigQuery with a specified schema
-def load_json_to_bigquery(client, dataset_id, json_filepath, table_name, schema):
+def load_json_to_bigquery(client, dataset_id, json_filepath, table_name, schema, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Streams the JSON source into the table: records are validated as they are read and uploaded as
+    newline-delimited JSON in load jobs of at most chunk_rows rows. The first job replaces the table's
+    contents and the following ones append to it.
+    """
     table_id = f"{client.project}.{dataset_id}.{table_name}"
-    job_config = bigquery.LoadJobConfig(
-        schema=schema,
-        source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
-        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
-    )
-
-    with open(json_filepath, 'rb') as file:
-        job = client.load_table_from_json(json.load(file), table_id, job_config=job_config)
-    job.result()  # Wait for the job to complete
-    print(f"Data loaded into {table_id}")
+    started = time.monotonic()
+    loaded_rows, _ = upload_records(client, table_id, schema, iter_valid_records(json_filepath, schema),
+                                    bigquery.WriteDisposition.WRITE_TRUNCATE, chunk_rows=chunk_rows)
+
+    elapsed = time.monotonic() - started
+    print(f"Data loaded into {table_id}: {loaded_rows} rows in {elapsed:.1f}s "
+          f"({loaded_rows / elapsed if elapsed else 0:.0f} rows/s)")
     return table_id
 
+
+def file_fingerprint(path):
+    """Returns the SHA-256 of the file's contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(READ_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _row_fingerprint(record, schema):
+    """Hash of a record's values in schema order; missing fields count as NULL."""
+    values = [record.get(field.name) for field in schema]
+    return hashlib.sha256(json.dumps(values).encode('utf-8')).hexdigest()
+
+
+def key_fingerprints(records, schema, keys):
+    """
+    Maps the natural key of every record (as a JSON list) to one fingerprint of all the records sharing it.
+    Keys are not required to be unique: a key's rows are compared, deleted and inserted as one group.
+    """
+    row_hashes = {}
+    for record in records:
+        key = json.dumps([record.get(name) for name in keys])
+        row_hashes.setdefault(key, []).append(_row_fingerprint(record, schema))
+    return {key: hashlib.sha256("".join(sorted(hashes)).encode('utf-8')).hexdigest()[:32]
+            for key, hashes in row_hashes.items()}
+
+
+def changed_keys(previous, current):
+    """Returns the keys inserted, changed and deleted between two key fingerprint maps, as three sets."""
+    inserted = current.keys() - previous.keys()
+    deleted = previous.keys() - current.keys()
+    changed = {key for key in current.keys() & previous.keys() if current[key] != previous[key]}
+    return inserted, changed, deleted
+
+
+def staging_records(json_filepath, schema, keys, removed_keys, added_keys):
+    """
+    Yields the staging rows of a merge: one 'delete' row per removed key, which removes its old rows, then the
+    current rows of the added keys, read from the source file, as 'insert' rows.
+    """
+    for key in sorted(removed_keys):
+        yield {**dict(zip(keys, json.loads(key))), "_op": "delete"}
+    if added_keys:
+        for record in iter_valid_records(json_filepath, schema):
+            if json.dumps([record.get(name) for name in keys]) in added_keys:
+                yield {**record, "_op": "insert"}
+
+
+def build_merge_query(table_id, staging_id, schema, keys):
+    """
+    Builds the MERGE applying a staging table to the target. The staging table holds one 'delete' row per changed
+    natural key, which removes every target row with that key, and the new rows of those keys as 'insert' rows.
+    Keys are compared with IS NOT DISTINCT FROM so that NULL key columns match.
+    """
+    key_match = " AND ".join(f"target.{key} IS NOT DISTINCT FROM staging.{key}" for key in keys)
+    columns = ", ".join(field.name for field in schema)
+    values = ", ".join(f"staging.{field.name}" for field in schema)
+    return f"""
+MERGE `{table_id}` AS target
+USING `{staging_id}` AS staging
+ON staging._op = 'delete' AND {key_match}
+WHEN MATCHED THEN
+    DELETE
+WHEN NOT MATCHED BY TARGET AND staging._op = 'insert' THEN
+    INSERT ({columns}) VALUES ({values})
+"""
+
+
+def _table_exists(client, table_id):
+    try:
+        client.get_table(table_id)
+        return True
+    except NotFound:
+        return False
+
+
+def _save_load_state(state_path, state):
+    """Writes the load state through a temporary file so an interrupted run never leaves a partial state."""
+    os.makedirs(os.path.dirname(os.path.abspath(state_path)), exist_ok=True)
+    with open(state_path + ".tmp", 'w') as file:
+        json.dump(state, file)
+    os.replace(state_path + ".tmp", state_path)
+
+
+def upsert_json_to_bigquery(client, dataset_id, json_filepath, table_name, schema, keys,
+                            state_dir=DEFAULT_LOAD_STATE_DIR, chunk_rows=DEFAULT_CHUNK_ROWS, full_reload=False):
+    """
+    Applies only what changed in the JSON source since the last load. An unchanged file is skipped without being
+    parsed. Otherwise the file is fingerprinted per natural key and compared with the fingerprints of the last load
+    kept in state_dir, and only the rows of the inserted, changed and deleted keys are uploaded to a staging table
+    and merged into the target. A full reload, the first load of a table or a load without a stored state replaces
+    the table and stores the fingerprints the next load is compared with.
+    """
+    table_id = f"{client.project}.{dataset_id}.{table_name}"
+    state_path = os.path.join(state_dir, f"{table_id}.json")
+    state = None
+    if os.path.exists(state_path) and not full_reload:
+        with open(state_path, 'r') as file:
+            state = json.load(file)
+    started = time.monotonic()
+
+    fingerprint = file_fingerprint(json_filepath)
+    table_exists = _table_exists(client, table_id)
+    if state is not None and table_exists and state["file_sha256"] == fingerprint:
+        print(f"{table_id} is up to date, {json_filepath} did not change")
+        return table_id
+
+    # A state written before the key fingerprints were kept cannot be diffed against
+    if state is None or "keys" not in state or not table_exists:
+        load_json_to_bigquery(client, dataset_id, json_filepath, table_name, schema, chunk_rows=chunk_rows)
+        keys_state = key_fingerprints(iter_valid_records(json_filepath, schema), schema, keys)
+        _save_load_state(state_path, {"file_sha256": fingerprint, "keys": keys_state})
+        return table_id
+
+    keys_state = key_fingerprints(iter_valid_records(json_filepath, schema), schema, keys)
+    inserted, changed, deleted = changed_keys(state["keys"], keys_state)
+
+    uploaded_bytes = 0
+    if inserted or changed or deleted:
+        staging_id = f"{table_id}_staging"
+        staging_schema = schema + [Field("_op", "STRING")]
+        # A changed key's old rows are deleted and its new rows inserted
+        records = staging_records(json_filepath, schema, keys, changed | deleted, inserted | changed)
+        _, uploaded_bytes = upload_records(client, staging_id, staging_schema, records,
+                                           bigquery.WriteDisposition.WRITE_TRUNCATE, chunk_rows=chunk_rows)
+        try:
+            client.query(build_merge_query(table_id, staging_id, schema, keys)).result()
+        finally:
+            client.delete_table(staging_id, not_found_ok=True)
+
+    _save_load_state(state_path, {"file_sha256": fingerprint, "keys": keys_state})
+    elapsed = time.monotonic() - started
+    print(f"Data merged into {table_id}: {len(inserted)} keys inserted, {len(changed)} changed, {len(deleted)} "
+          f"deleted, {uploaded_bytes} bytes uploaded in {elapsed:.1f}s")
+    return table_id
+
+
 # Function to update the .env file
 def update_env_file(env_path, updates):
     with open(env_path, 'r') as file:
@@ -79,20 +295,42 @@ def update_env_file(env_path, updates):
         file.writelines(new_lines)
 
 
-# Define paths and load data with explicit schema
-base_path = os.path.join(os.path.dirname(__file__), '..', 'data')
-json_files_schemas = {
-    "agg_data.json": ("agg_data", schema_agg_data),
-    "app_names.json": ("app_names", schema_app_names),
-    "device_segments.json": ("device_segments", schema_device_segments),
-    "geo_segments.json": ("geo_segments", schema_geo_segments),
-}
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Loads the JSON sources in data/ into BigQuery")
+    parser.add_argument("--full-reload", action="store_true",
+                        help="Replace every table instead of merging only the rows that changed since the last load")
+    parser.add_argument("--skip-preflight", action="store_true",
+                        help="Upload without evaluating the declarative rules on the source files first")
+    parser.add_argument("--allow-failing-data", action="store_true",
+                        help="Upload even when a rule fails on the source files, such as the repository's own data "
+                             "whose defects the tests exist to find")
+    parser.add_argument("--datasets", default=dataset_id,
+                        help="Comma-separated datasets of the project to load the tables into "
+                             "(default: BIGQUERY_DATASET_ID)")
+    args = parser.parse_args()
+    datasets = args.datasets.split(",")
+
+    # Refuse to upload files that already violate a rule; evaluating them locally costs no BigQuery bytes
+    if not args.skip_preflight:
+        from src.preflight import run_preflight, print_report
+        if not print_report(*run_preflight(base_path)):
+            if not args.allow_failing_data:
+                sys.exit("Pre-flight checks failed, nothing was uploaded (use --allow-failing-data to upload anyway)")
+            print("Pre-flight checks failed, uploading anyway as --allow-failing-data is set")
+
+    # Create a BigQuery client
+    credentials = service_account.Credentials.from_service_account_file(service_account_path)
+    client = bigquery.Client(credentials=credentials, project=project_id)
 
-env_updates = {}
-for json_file, (table_name, schema) in json_files_schemas.items():
-    json_filepath = os.path.join(base_path, json_file)
-    full_table_id = load_json_to_bigquery(client, dataset_id, json_filepath, table_name, schema)
-    env_var = f"BIGQUERY_TABLE_{table_name.upper()}_ID"
-    env_updates[env_var] = full_table_id
+    env_updates = {}
+    for dataset in datasets:
+        for json_file, (table_name, schema) in json_files_schemas.items():
+            json_filepath = os.path.join(base_path, json_file)
+            full_table_id = upsert_json_to_bigquery(client, dataset, json_filepath, table_name, schema,
+                                                    natural_keys[table_name], full_reload=args.full_reload)
+            env_var = f"BIGQUERY_TABLE_{table_name.upper()}_ID"
+            env_updates[env_var] = full_table_id
 
-update_env_file(dotenv_path, env_updates)
+    # The .env file names the tables of a single dataset
+    if len(datasets) == 1:
+        update_env_file(dotenv_path, env_updates)
@@ -0,0 +1,157 @@
+"""
+Definitions of the dataset: the table schemas with their JSON sources and natural keys, and the v_agg_data view.
+They are plain data without google imports, so the local backend and the pre-flight checks can read them without
+loading the BigQuery client library; src/db_table_creation.py turns the schemas into SchemaFields when it uploads.
+"""
+import os
+import re
+import json
+from collections import namedtuple
+
+
+# A column of a table schema, with the attributes of bigquery.SchemaField that the loaders read
+Field = namedtuple("Field", ["name", "field_type", "mode"], defaults=["NULLABLE"])
+
+# Table schemas
+schema_agg_data = [
+    Field("app_id", "INTEGER"),
+    Field("install_date", "DATE"),
+    Field("device_model", "STRING", mode="NULLABLE"),
+    Field("installs", "INTEGER"),
+]
+
+schema_app_names = [
+    Field("app_id", "INTEGER"),
+    Field("app_name", "STRING"),
+    Field("platform", "STRING"),
+]
+
+schema_device_segments = [
+    Field("device_model", "STRING"),
+    Field("segment", "STRING"),
+    Field("app_short", "STRING"),
+    Field("platform", "STRING"),
+    Field("ua_team", "STRING"),
+]
+
+schema_geo_segments = [
+    Field("geo", "STRING"),
+    Field("segment", "STRING"),
+    Field("platform", "STRING"),
+    Field("ua_team", "STRING"),
+]
+
+# Define paths and load data with explicit schema
+base_path = os.path.join(os.path.dirname(__file__), '..', 'data')
+json_files_schemas = {
+    "agg_data.json": ("agg_data", schema_agg_data),
+    "app_names.json": ("app_names", schema_app_names),
+    "device_segments.json": ("device_segments", schema_device_segments),
+    "geo_segments.json": ("geo_segments", schema_geo_segments),
+}
+
+# Natural key of each table, used to find the rows that changed since the last load
+natural_keys = {
+    "agg_data": ("app_id", "install_date", "device_model"),
+    "app_names": ("app_id",),
+    "device_segments": ("device_model", "app_short", "platform"),
+    "geo_segments": ("geo", "platform", "ua_team"),
+}
+
+# Number of characters read from a JSON source at a time
+READ_SIZE = 1024 * 1024
+
+# Whitespace and commas between the elements of a JSON array
+_SEPARATOR_PATTERN = re.compile(r"[\s,]*")
+
+
+def iter_json_records(json_filepath):
+    """
+    Yields the records of a JSON source one at a time, reading it in READ_SIZE pieces so memory stays flat.
+    Accepts a JSON array of objects as well as newline-delimited JSON (one object per line).
+    """
+    decoder = json.JSONDecoder()
+    with open(json_filepath, 'r', encoding='utf-8') as file:
+        buffer = file.read(READ_SIZE).lstrip()
+        if not buffer.startswith('['):
+            # Newline-delimited JSON: decode line by line
+            file.seek(0)
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        position = 1  # Skip the opening bracket
+        eof = False
+        while True:
+            # Skip the whitespace and the comma separating the elements
+            while True:
+                position = _SEPARATOR_PATTERN.match(buffer, position).end()
+                if position < len(buffer) or eof:
+                    break
+                chunk = file.read(READ_SIZE)
+                eof = not chunk
+                buffer, position = buffer[position:] + chunk, 0
+
+            if position >= len(buffer):
+                raise ValueError(f"{json_filepath}: unexpected end of the JSON array")
+            if buffer[position] == ']':
+                return
+
+            try:
+                record, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # The element continues past the buffer: read more and decode it again
+                chunk = file.read(READ_SIZE)
+                eof = not chunk
+                buffer, position = buffer[position:] + chunk, 0
+                continue
+            yield record
+            position = end
+            if position > READ_SIZE:
+                buffer, position = buffer[position:], 0  # Drop the consumed part of the buffer
+
+
+# SQL code for creating a view with explicit full table names
+def build_view_query(project_id, dataset_id):
+    """Returns the CREATE OR REPLACE VIEW statement for v_agg_data in the given dataset."""
+    return f"""
+CREATE OR REPLACE VIEW `{project_id}.{dataset_id}.v_agg_data` AS
+WITH agg AS (
+    SELECT
+        app_id,
+        install_date,
+        device_model,
+        installs
+    FROM `{project_id}.{dataset_id}.agg_data`
+    WHERE install_date >= '2020-02-01'
+),
+
+dev_seg AS (
+    SELECT
+        segment,
+        app_short,
+        platform,
+        UPPER(device_model) AS device_model
+    FROM `{project_id}.{dataset_id}.device_segments`
+    WHERE ua_team = 'network'
+)
+
+SELECT
+    agg.install_date,
+    agg.device_model,
+    `{project_id}.{dataset_id}.app_names`.app_name,
+    COALESCE(ds.segment, 'non_target_device') AS device_segment,
+    agg.installs
+FROM agg
+INNER JOIN `{project_id}.{dataset_id}.app_names` ON agg.app_id = `{project_id}.{dataset_id}.app_names`.app_id
+LEFT JOIN
+    dev_seg AS ds ON
+    agg.device_model IS NOT NULL AND `{project_id}.{dataset_id}.app_names`.platform = ds.platform
+    AND `{project_id}.{dataset_id}.app_names`.app_name = ds.app_short AND ds.device_model = agg.device_model
+LEFT JOIN
+    `{project_id}.{dataset_id}.geo_segments`
+    ON `{project_id}.{dataset_id}.app_names`.platform = `{project_id}.{dataset_id}.geo_segments`.platform AND `{project_id}.{dataset_id}.geo_segments`.ua_team = 'Network';
+"""
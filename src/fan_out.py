@@ -0,0 +1,175 @@
+"""
+Fan-out: runs the checks against several datasets with the same schema at once, one pytest session per dataset,
+and consolidates their outcomes into one pass/fail report per dataset.
+
+Usage:
+    python src/fan_out.py --datasets "dq_eu,dq_us,other-project.dq_*" [--max-concurrent-per-project 4]
+        [--output test_results/fan_out] [-- <pytest arguments>]
+
+Datasets are given as dataset or project.dataset, and either part may be a glob. Globs are resolved by listing
+the projects and datasets the service account can see. Sessions run concurrently, but at most
+--max-concurrent-per-project of them per project, since the sessions of one project share its slots and quotas.
+Every session writes its Allure results to the shared results directory, labelled with its dataset, so one Allure
+report covers all datasets. Its JUnit XML, log and query profile go to <output>/<project>.<dataset>/, and
+<output>/report.json holds the consolidated report. The script exits with status 1 unless every dataset passed.
+"""
+import os
+import sys
+import json
+import time
+import fnmatch
+import argparse
+import threading
+import subprocess
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+# Load environment variables from a file located at the project root
+dotenv_path = os.path.join(os.path.dirname(__file__), '..', '.env')
+load_dotenv(dotenv_path=dotenv_path)
+
+PROJECT_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+DEFAULT_OUTPUT_DIR = os.path.join(PROJECT_ROOT, 'test_results', 'fan_out')
+# Sessions running against the datasets of one project at the same time
+DEFAULT_MAX_CONCURRENT_PER_PROJECT = int(os.getenv("MAX_CONCURRENT_DATASETS_PER_PROJECT", "4"))
+
+# Initialize environment variables
+service_account_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
+project_id = os.getenv("GCP_PROJECT_ID")
+is_local = os.getenv("BIGQUERY_BACKEND", "bigquery").lower() == "local"
+
+# pytest exit codes of a session whose checks all ran, passed or not
+_EXIT_PASSED, _EXIT_FAILED = 0, 1
+
+
+def _is_glob(pattern):
+    return any(character in pattern for character in "*?[")
+
+
+def parse_datasets(spec, default_project):
+    """Returns the (project pattern, dataset pattern) pairs of a comma-separated list of [project.]dataset globs."""
+    patterns = []
+    for entry in filter(None, (entry.strip() for entry in spec.split(","))):
+        project, _, dataset = entry.rpartition(".")
+        if not project and not default_project:
+            raise ValueError(f"{entry} names no project and GCP_PROJECT_ID is not set")
+        patterns.append((project or default_project, dataset))
+    return patterns
+
+
+def _bigquery_client():
+    # The google libraries are only needed to resolve globs
+    from google.cloud import bigquery
+    from google.oauth2 import service_account
+    credentials = service_account.Credentials.from_service_account_file(service_account_path)
+    return bigquery.Client(credentials=credentials, project=project_id)
+
+
+def resolve_datasets(patterns):
+    """Returns the sorted (project, dataset) pairs matching the patterns; globs are listed on BigQuery."""
+    targets = set()
+    client = None
+    for project_pattern, dataset_pattern in patterns:
+        if not _is_glob(project_pattern) and not _is_glob(dataset_pattern):
+            targets.add((project_pattern, dataset_pattern))
+            continue
+        if is_local:
+            raise ValueError(f"{project_pattern}.{dataset_pattern}: the local backend cannot list datasets, "
+                             f"name them explicitly")
+        client = client or _bigquery_client()
+        projects = ([project.project_id for project in client.list_projects()
+                     if fnmatch.fnmatchcase(project.project_id, project_pattern)]
+                    if _is_glob(project_pattern) else [project_pattern])
+        for project in projects:
+            targets.update((project, dataset.dataset_id) for dataset in client.list_datasets(project)
+                           if fnmatch.fnmatchcase(dataset.dataset_id, dataset_pattern))
+    return sorted(targets)
+
+
+def read_junit_report(path):
+    """Returns the test counts and the failed test ids of a JUnit XML report."""
+    counts = {"tests": 0, "failures": 0, "errors": 0, "skipped": 0}
+    failed = []
+    if not os.path.exists(path):
+        return counts, failed
+    for suite in ElementTree.parse(path).getroot().iter("testsuite"):
+        for name in counts:
+            counts[name] += int(suite.get(name, 0))
+        for case in suite.iter("testcase"):
+            if case.find("failure") is not None or case.find("error") is not None:
+                failed.append(f"{case.get('classname')}::{case.get('name')}")
+    return counts, failed
+
+
+def run_dataset(project, dataset, pytest_args, output_dir, semaphore):
+    """Runs one pytest session against the dataset once its project has a free slot and returns its report."""
+    label = f"{project}.{dataset}"
+    dataset_dir = os.path.join(output_dir, label)
+    os.makedirs(dataset_dir, exist_ok=True)
+    junit_path = os.path.join(dataset_dir, "junit.xml")
+    env = dict(os.environ, GCP_PROJECT_ID=project, BIGQUERY_DATASET_ID=dataset,
+               QUERY_PROFILE_PATH=os.path.join(dataset_dir, "query_profile.json"))
+    command = [sys.executable, "-m", "pytest", "--label-dataset", f"--junitxml={junit_path}", *pytest_args]
+    with semaphore:
+        print(f"{label}: started")
+        started = time.monotonic()
+        with open(os.path.join(dataset_dir, "pytest.log"), 'w') as log:
+            completed = subprocess.run(command, cwd=PROJECT_ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+        seconds = time.monotonic() - started
+
+    counts, failed = read_junit_report(junit_path)
+    # Any other exit code means the session stopped before its checks ran, e.g. a rejected dry run
+    status = {_EXIT_PASSED: "passed", _EXIT_FAILED: "failed"}.get(completed.returncode, "error")
+    print(f"{label}: {status} in {seconds:.1f} s")
+    return {"project": project, "dataset": dataset, "status": status, "exit_code": completed.returncode,
+            "seconds": round(seconds, 3), **counts, "failed_checks": failed}
+
+
+def fan_out(targets, pytest_args, output_dir, max_concurrent_per_project=DEFAULT_MAX_CONCURRENT_PER_PROJECT):
+    """Runs the sessions of all datasets concurrently, bounded per project, and returns their reports in order."""
+    semaphores = {project: threading.Semaphore(max_concurrent_per_project) for project, _ in targets}
+    with ThreadPoolExecutor(max_workers=len(targets), thread_name_prefix="fan-out") as executor:
+        futures = [executor.submit(run_dataset, project, dataset, pytest_args, output_dir, semaphores[project])
+                   for project, dataset in targets]
+        return [future.result() for future in futures]
+
+
+def print_report(reports):
+    print(f"{'dataset':<48}{'status':>8}{'tests':>7}{'failed':>8}{'errors':>8}{'skipped':>9}{'seconds':>10}")
+    for report in reports:
+        print(f"{report['project'] + '.' + report['dataset']:<48}{report['status']:>8}{report['tests']:>7}"
+              f"{report['failures']:>8}{report['errors']:>8}{report['skipped']:>9}{report['seconds']:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--datasets", default=os.getenv("BIGQUERY_DATASETS"),
+                        help="Comma-separated [project.]dataset names or globs (default: BIGQUERY_DATASETS)")
+    parser.add_argument("--max-concurrent-per-project", type=int, default=DEFAULT_MAX_CONCURRENT_PER_PROJECT,
+                        help="Maximum number of sessions running against the datasets of one project at once")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT_DIR, help="Directory of the per-dataset and overall reports")
+    parser.add_argument("pytest_args", nargs="*", help="Arguments of every pytest session, after --")
+    args = parser.parse_args()
+    if not args.datasets:
+        parser.error("--datasets or BIGQUERY_DATASETS is required")
+
+    default_project = project_id or ("local-project" if is_local else None)
+    try:
+        targets = resolve_datasets(parse_datasets(args.datasets, default_project))
+    except ValueError as e:
+        parser.error(str(e))
+    if not targets:
+        sys.exit(f"No dataset matches {args.datasets}")
+
+    started = time.monotonic()
+    reports = fan_out(targets, args.pytest_args or ["tests/"], args.output, args.max_concurrent_per_project)
+    print_report(reports)
+    os.makedirs(args.output, exist_ok=True)
+    with open(os.path.join(args.output, "report.json"), 'w') as file:
+        json.dump({"seconds": round(time.monotonic() - started, 3), "datasets": reports}, file, indent=4)
+    sys.exit(0 if all(report["status"] == "passed" for report in reports) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+import os
+import sys
+import time
+import numpy as np
+
+# Allow running the module as a script from the project root
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from src.definitions import base_path, json_files_schemas, iter_json_records
+from src.rule_specs import load_rule_specs
+
+
+# Maximum number of offending rows printed per failed rule
+MAX_REPORTED_FAILURES = 10
+
+# NumPy dtypes of the BigQuery column types; other types are compared as strings
+_NUMPY_TYPES = {
+    "INTEGER": np.int64,
+    "INT64": np.int64,
+    "FLOAT": np.float64,
+    "FLOAT64": np.float64,
+    "NUMERIC": np.float64,
+    "BOOLEAN": np.bool_,
+    "BOOL": np.bool_,
+    "DATE": "datetime64[D]",
+}
+# Value standing in for NULL in the value array; rows are told apart by the column's null mask
+_NULL_FILLERS = {np.int64: 0, np.float64: 0.0, np.bool_: False, "datetime64[D]": "NaT"}
+
+
+class Column:
+    """
+    One column of a source file as a NumPy array and a boolean mask of the NULL rows. String columns are
+    dictionary-encoded: values holds int codes into the sorted array of distinct strings, so comparisons and set
+    operations run on integers and string functions only touch the distinct values.
+    """
+
+    def __init__(self, values, null, dictionary=None):
+        self.values = values
+        self.null = null
+        self.dictionary = dictionary
+
+    @classmethod
+    def from_list(cls, values, field_type):
+        null = np.fromiter((value is None for value in values), dtype=bool, count=len(values))
+        dtype = _NUMPY_TYPES.get(field_type)
+        if dtype is not None:
+            filler = _NULL_FILLERS[dtype]
+            return cls(np.array([filler if value is None else value for value in values], dtype=dtype), null)
+
+        index = {}
+        codes = np.fromiter((index.setdefault("" if value is None else str(value), len(index)) for value in values),
+                            dtype=np.int64, count=len(values))
+        dictionary = np.array(list(index), dtype=str)
+        # Sort the dictionary so that the order of the codes is the order of the strings
+        order = np.argsort(dictionary)
+        ranks = np.empty_like(order)
+        ranks[order] = np.arange(len(order))
+        return cls(ranks[codes] if len(codes) else codes, null, dictionary[order])
+
+    def __len__(self):
+        return len(self.null)
+
+    def value(self, index):
+        """Returns the Python value of one row, None for NULL."""
+        if self.null[index]:
+            return None
+        if self.dictionary is not None:
+            return str(self.dictionary[self.values[index]])
+        return self.values[index].item()
+
+    def test(self, predicate):
+        """Evaluates a vectorized predicate on the values; for strings only on the distinct values."""
+        if self.dictionary is None:
+            return predicate(self.values)
+        return predicate(self.dictionary)[self.values] if len(self.values) else np.zeros(0, dtype=bool)
+
+    def literal(self, value):
+        """Converts a rule value to the column's dtype for vectorized comparisons."""
+        return np.array(value, dtype=self.values.dtype if self.dictionary is None else str)
+
+    def key_codes(self, other=None, case_insensitive=False):
+        """
+        Returns int64 codes of the values such that equal values get equal codes; with other, codes for both
+        columns from one shared numbering, so that keys of two tables can be compared.
+        """
+        columns = [self] if other is None else [self, other]
+        if self.dictionary is None:
+            return [column.values.astype(self.values.dtype).view(np.int64) if column.values.dtype.kind == "M"
+                    else column.values.astype(np.int64) for column in columns]
+        dictionaries = [np.char.upper(column.dictionary) if case_insensitive else column.dictionary
+                        for column in columns]
+        shared = np.unique(np.concatenate(dictionaries))
+        return [np.searchsorted(shared, dictionary)[column.values] if len(column.values) else column.values
+                for column, dictionary in zip(columns, dictionaries)]
+
+
+def load_columns(json_filepath, schema):
+    """Reads a JSON source into one Column per schema field."""
+    lists = {field.name: [] for field in schema}
+    for record in iter_json_records(json_filepath):
+        for name, values in lists.items():
+            values.append(record.get(name))
+    return {field.name: Column.from_list(lists[field.name], field.field_type) for field in schema}
+
+
+def combine_codes(code_arrays):
+    """Combines per-column key codes into one int64 code per row, equal exactly for rows with equal keys."""
+    combined = np.zeros(len(code_arrays[0]), dtype=np.int64)
+    bound = 1
+    for codes in code_arrays:
+        codes = codes - codes.min() if len(codes) else codes
+        width = int(codes.max()) + 1 if len(codes) else 1
+        if bound * width >= 2 ** 62:
+            # Renumber densely before the mixed-radix code could overflow
+            _, combined = np.unique(combined, return_inverse=True)
+            combined = combined.reshape(-1).astype(np.int64)
+            bound = int(combined.max()) + 1 if len(combined) else 1
+        combined = combined * width + codes
+        bound *= width
+    return combined
+
+
+class PreflightResult:
+    """Outcome of one rule on the source files: the number and positions of the offending rows."""
+
+    def __init__(self, rule, failing=None, skipped=None, passed=None, count=None):
+        self.rule = rule
+        self.failing = failing  # Row indexes of the offending rows
+        self.skipped = skipped  # Reason the rule cannot be evaluated before upload
+        self.count = count if count is not None else (len(failing) if failing is not None else 0)
+        self.passed = passed if passed is not None else self.skipped is not None or self.count == 0
+
+
+def evaluate_rule(rule, tables):
+    """Evaluates one declarative rule against the columns of the source tables with vectorized operations."""
+    spec = rule.spec
+    if rule.table not in tables:
+        return PreflightResult(rule, skipped=f"{rule.table} is not loaded from a source file")
+    if rule.where:
+        return PreflightResult(rule, skipped="the where filter is SQL")
+    if any(isinstance(spec.get(bound), dict) for bound in ("min", "max")):
+        return PreflightResult(rule, skipped="the bounds are SQL expressions")
+
+    columns = tables[rule.table]
+    row_count = len(next(iter(columns.values())))
+    if rule.type == "row_count":
+        return PreflightResult(rule, passed=rule.passed(row_count), count=row_count)
+
+    if rule.type == "not_null":
+        failing = columns[spec["column"]].null
+    elif rule.type == "positive":
+        column = columns[spec["column"]]
+        failing = ~column.null & column.test(lambda values: values <= 0)
+    elif rule.type == "range":
+        column = columns[spec["column"]]
+        out_of_range = np.zeros(row_count, dtype=bool)
+        if "min" in spec:
+            out_of_range |= column.test(lambda values: values < column.literal(spec["min"]))
+        if "max" in spec:
+            out_of_range |= column.test(lambda values: values > column.literal(spec["max"]))
+        failing = ~column.null & out_of_range
+    elif rule.type in ("accepted_values", "rejected_values"):
+        column = columns[spec["column"]]
+        listed = column.test(lambda values: np.isin(values, column.literal(spec["values"])))
+        failing = ~column.null & (~listed if rule.type == "accepted_values" else listed)
+        if not spec.get("allow_null", True):
+            failing |= column.null
+    elif rule.type == "unique":
+        keys = [columns[key] for key in spec["keys"]]
+        # NULLs form one group, as in GROUP BY: the null masks are part of the key
+        codes = combine_codes([key.key_codes()[0] for key in keys] + [key.null.astype(np.int64) for key in keys])
+        _, inverse, counts = np.unique(codes, return_inverse=True, return_counts=True)
+        failing = counts[inverse.reshape(-1)] > 1
+    elif rule.type == "foreign_key":
+        if rule.parent_table not in tables:
+            return PreflightResult(rule, skipped=f"{rule.parent_table} is not loaded from a source file")
+        children = [columns[column] for column in rule.columns]
+        parents = [tables[rule.parent_table][column] for column in rule.parent_columns]
+        child_null = np.any([child.null for child in children], axis=0)
+        parent_null = np.any([parent.null for parent in parents], axis=0)
+        # Child and parent keys are numbered together so that equal keys get equal codes
+        pairs = [child.key_codes(parent, case_insensitive=spec.get("case_insensitive", False))
+                 for child, parent in zip(children, parents)]
+        codes = combine_codes([np.concatenate(pair) for pair in pairs])
+        child_codes, parent_codes = codes[:row_count], codes[row_count:]
+        missing = ~np.isin(child_codes, parent_codes[~parent_null])
+        failing = missing & ~child_null if spec.get("allow_null", True) else missing | child_null
+    else:
+        return PreflightResult(rule, skipped=f"no pre-flight implementation for {rule.type}")
+    failing = np.flatnonzero(failing)
+    # A tolerated defect rate only applies to sampled estimates; every row of the files is checked here
+    return PreflightResult(rule, failing=failing, passed=rule.passed(len(failing)))
+
+
+def run_preflight(data_dir=base_path, rules=None):
+    """Loads every source file into columns and evaluates the rules of the tables they fill."""
+    rules = rules if rules is not None else load_rule_specs()
+    started = time.monotonic()
+    tables = {}
+    for json_file, (table_name, schema) in json_files_schemas.items():
+        tables[table_name] = load_columns(os.path.join(data_dir, json_file), schema)
+    loaded = time.monotonic()
+    results = [evaluate_rule(rule, tables) for rule in rules]
+
+    rows = sum(len(next(iter(columns.values()))) for columns in tables.values())
+    print(f"Pre-flight loaded {rows} rows in {loaded - started:.2f}s "
+          f"and evaluated {len(rules)} rules in {time.monotonic() - loaded:.2f}s")
+    return tables, results
+
+
+def print_report(tables, results):
+    """Prints the outcome of every rule with a sample of the offending rows; returns True if all rules passed."""
+    for result in results:
+        rule = result.rule
+        if result.skipped:
+            print(f"SKIPPED {rule.name}: {result.skipped}")
+        elif result.passed:
+            print(f"PASSED  {rule.name}")
+        else:
+            print(f"FAILED  {rule.name}: {result.count} rows of {rule.table} violate: {rule.summary()}")
+            columns = tables[rule.table]
+            for index in (result.failing if result.failing is not None else [])[:MAX_REPORTED_FAILURES]:
+                row = {name: column.value(index) for name, column in columns.items()}
+                print(f"          {row}")
+    return all(result.passed for result in results)
+
+
+if __name__ == "__main__":
+    tables, results = run_preflight()
+    sys.exit(0 if print_report(tables, results) else 1)
@@ -0,0 +1,336 @@
+"""
+The declarative rules of tests/rules/*.json as plain data: each rule type parses and validates its spec, renders the
+predicate of its violating rows and states what it requires. The model has no BigQuery, Allure or test-session
+imports, so the pre-flight checks evaluate the same rules the tests compile; test_helpers/rules.py extends every rule
+type with the queries it runs during a session.
+"""
+import os
+import re
+import json
+from datetime import date
+
+
+# Directory with the declarative rule files
+DEFAULT_RULES_DIR = os.path.join(os.path.dirname(__file__), '..', 'tests', 'rules')
+# Rule names are used as column aliases in the compiled queries
+_IDENTIFIER_PATTERN = re.compile(r"^[A-Za-z_]\w*$")
+# Severity levels a rule can declare, the names of the Allure severity levels
+SEVERITY_NAMES = ("blocker", "critical", "normal", "minor", "trivial")
+# Identifiers and string literals of a where filter, matched together so that words inside strings are skipped
+_WHERE_TOKEN_PATTERN = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|([A-Za-z_]\w*)")
+# SQL words of a where filter that are not columns; any other word, a function name included, counts as a column
+_WHERE_KEYWORDS = {"AND", "OR", "NOT", "IN", "IS", "NULL", "TRUE", "FALSE", "LIKE", "BETWEEN"}
+# Rule values written as ISO dates are sent as DATE parameters, which BigQuery compares with DATE columns
+_DATE_VALUE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+def sql_value(value):
+    """Renders a rule value as an SQL literal for the rule's summary; {"expression": ...} is used as is."""
+    if isinstance(value, dict):
+        return value["expression"]
+    if isinstance(value, bool) or value is None:
+        raise ValueError(f"Unsupported rule value: {value!r}")
+    if isinstance(value, (int, float)):
+        return str(value)
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def parameter_value(value):
+    """Returns the query parameter value of a rule value: ISO date strings become dates, lists an array."""
+    if isinstance(value, list):
+        if not value:
+            raise ValueError("Rule value lists cannot be empty")
+        return [parameter_value(element) for element in value]
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(f"Unsupported rule value: {value!r}")
+    if isinstance(value, str) and _DATE_VALUE_PATTERN.match(value):
+        return date.fromisoformat(value)
+    return value
+
+
+def where_columns(where):
+    """Returns the columns a where filter reads, counting every word that is not an SQL keyword or in a string."""
+    if not where:
+        return set()
+    words = (match.group(1) for match in _WHERE_TOKEN_PATTERN.finditer(where))
+    return {word for word in words if word is not None and word.upper() not in _WHERE_KEYWORDS}
+
+
+class RuleSpec:
+    """
+    A declarative check on one table, as declared in its rule file. The rule passes when the number of rows it counts
+    is 0 (see passed for rules with other bounds).
+    """
+
+    type = None
+    required = ()
+    bounds = ()  # Fields of the spec holding values the rule compares with, sent as query parameters
+    samplable = False  # Whether the rule can be estimated from a sample of its table
+    key_countable = False  # Whether the rule can first be checked on exact counts of its keys
+    groupable = True  # Whether the rule's count is a sum over rows, so it can be read from rows grouped with counts
+
+    def __init__(self, spec, story=None, source=None):
+        missing = [field for field in ("name", "table", *self.required) if field not in spec]
+        if missing:
+            raise ValueError(f"Rule {spec.get('name', '?')} in {source} is missing {', '.join(missing)}")
+        if not _IDENTIFIER_PATTERN.match(spec["name"]):
+            raise ValueError(f"Rule name {spec['name']!r} in {source} is not a valid identifier")
+        self.spec = spec
+        self.source = source
+        self.name = spec["name"]
+        self.table = spec["table"]
+        self.description = spec.get("description", "").strip()
+        self.story = spec.get("story", story)
+        self.severity_name = spec.get("severity", "normal")
+        if self.severity_name not in SEVERITY_NAMES:
+            raise ValueError(f"Rule {self.name} in {source} has an unknown severity {self.severity_name!r}")
+        self.where = spec.get("where")  # Optional filter restricting the rows the rule applies to
+        self.incremental = spec.get("incremental", False)
+        self.max_bytes_processed = spec.get("max_bytes_processed")  # Optional byte budget of the rule's scan
+        self.timeout_seconds = spec.get("timeout_seconds")  # Optional time the rule may wait for its queries
+        # Share of the rule's rows a sampled estimate may find violating it; every full evaluation requires zero
+        self.max_defect_rate = spec.get("max_defect_rate", 0)
+        # Columns the violations of a failed rule are broken down by in its failure message
+        self.group_by = spec.get("group_by", [])
+        # Column sharding mode splits the rule's scan by: install_date ranges, or the fingerprint of any other column
+        self.shard_by = spec.get("shard_by")
+        # {"confidence": ...} (or true) lets sampling mode estimate the defect rate from a sample of the table
+        self.sample = spec.get("sample")
+        if self.sample is True:
+            self.sample = {}
+        if self.sample is not None and not self.samplable:
+            raise ValueError(f"Rule {self.name} in {source} cannot be sampled: only row predicates can")
+        # Lets key count mode compare the distinct keys of the rule with its rows first and run the exact query only
+        # when they differ
+        self.key_counts = spec.get("key_counts", False)
+        if self.key_counts and not self.key_countable:
+            raise ValueError(f"Rule {self.name} in {source} cannot be checked on key counts: only unique rules can")
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.name!r}, table={self.table!r})"
+
+    def bound(self, field, inline=False):
+        """
+        SQL of one of the rule's bounds: an {"expression": ...} as is, otherwise its @parameter (UNNEST(@parameter)
+        for a list of values), or its literal when inline.
+        """
+        value = self.spec[field]
+        if isinstance(value, dict):
+            return value["expression"]
+        if inline:
+            return f"({', '.join(sql_value(element) for element in value)})" if isinstance(value, list) \
+                else sql_value(value)
+        return f"UNNEST(@{self.name}_{field})" if isinstance(value, list) else f"@{self.name}_{field}"
+
+    def parameters(self):
+        """Query parameters of the rule's bounds by name; bounds given as expressions are compiled inline."""
+        return {f"{self.name}_{field}": parameter_value(self.spec[field]) for field in self.bounds
+                if field in self.spec and not isinstance(self.spec[field], dict)}
+
+    def checked_columns(self):
+        """Columns of its table the rule checks, besides those of its where filter."""
+        return [self.spec["column"]] if "column" in self.spec else []
+
+    def read_columns(self):
+        """Columns of its table the rule's count reads, outside of its incremental window."""
+        return set(self.checked_columns()) | where_columns(self.where)
+
+    def passed(self, count):
+        return count == 0
+
+    def shardable(self, column):
+        """Whether the rule's count is the sum of its counts over shards of its table split by column."""
+        return True
+
+    def summary(self):
+        """One-line statement of what the rule requires."""
+        raise NotImplementedError
+
+    def failure_message(self, count, failures):
+        """failures is the ViolationSummary of the rule, or None for rules without a violations query."""
+        message = f"{self.name}: {count} rows of {self.table} violate the rule: {self.summary()}"
+        if failures:
+            message += "\n" + failures.describe()
+        return message
+
+    def sample_failure_message(self, estimate, failures):
+        message = f"{self.name}: {estimate.defects} sampled rows of {self.table} violate the rule: {self.summary()}, " \
+                  f"{estimate}"
+        if failures:
+            message += "\n" + failures.describe()
+        return message
+
+
+class ScalarRuleSpec(RuleSpec):
+    """A rule that flags single rows by a predicate on their own columns."""
+
+    samplable = True
+
+    def failing_predicate(self, inline=False):
+        """Predicate of the rows violating the rule; inline renders its bounds as literals instead of parameters."""
+        raise NotImplementedError
+
+    def summary(self):
+        return f"no rows where {self.failing_predicate(inline=True)}"
+
+
+class NotNullRuleSpec(ScalarRuleSpec):
+    type = "not_null"
+    required = ("column",)
+
+    def failing_predicate(self, inline=False):
+        return f"{self.spec['column']} IS NULL"
+
+
+class PositiveRuleSpec(ScalarRuleSpec):
+    type = "positive"
+    required = ("column",)
+
+    def failing_predicate(self, inline=False):
+        return f"{self.spec['column']} <= 0"
+
+
+class RangeRuleSpec(ScalarRuleSpec):
+    type = "range"
+    required = ("column",)
+    bounds = ("min", "max")
+
+    def failing_predicate(self, inline=False):
+        column = self.spec["column"]
+        conditions = []
+        if "min" in self.spec:
+            conditions.append(f"{column} < {self.bound('min', inline)}")
+        if "max" in self.spec:
+            conditions.append(f"{column} > {self.bound('max', inline)}")
+        if not conditions:
+            raise ValueError(f"Range rule {self.name} in {self.source} needs a min or a max")
+        return " OR ".join(conditions)
+
+
+class AcceptedValuesRuleSpec(ScalarRuleSpec):
+    """Values outside the list fail; NULL fails only with "allow_null": false."""
+
+    type = "accepted_values"
+    required = ("column", "values")
+    bounds = ("values",)
+
+    def failing_predicate(self, inline=False):
+        column = self.spec["column"]
+        predicate = f"{column} NOT IN {self.bound('values', inline)}"
+        if not self.spec.get("allow_null", True):
+            predicate += f" OR {column} IS NULL"
+        return predicate
+
+
+class RejectedValuesRuleSpec(ScalarRuleSpec):
+    """Values in the list fail; NULL fails only with "allow_null": false."""
+
+    type = "rejected_values"
+    required = ("column", "values")
+    bounds = ("values",)
+
+    def failing_predicate(self, inline=False):
+        column = self.spec["column"]
+        predicate = f"{column} IN {self.bound('values', inline)}"
+        if not self.spec.get("allow_null", True):
+            predicate += f" OR {column} IS NULL"
+        return predicate
+
+
+class RowCountRuleSpec(RuleSpec):
+    """The number of rows (after the where filter) must lie within min_rows and max_rows."""
+
+    type = "row_count"
+
+    def passed(self, count):
+        return self.spec.get("min_rows", 0) <= count <= self.spec.get("max_rows", float("inf"))
+
+    def summary(self):
+        return f"between {self.spec.get('min_rows', 0)} and {self.spec.get('max_rows', 'any number of')} rows"
+
+    def failure_message(self, count, failures):
+        return f"{self.name}: {self.table} has {count} rows, expected {self.summary()}"
+
+
+class UniqueRuleSpec(RuleSpec):
+    """Rows sharing the same values of keys are duplicates; every row of a duplicated group is counted."""
+
+    type = "unique"
+    required = ("keys",)
+    key_countable = True
+    groupable = False  # Duplicates are counted over the rows of a key, which a grouped result no longer has
+
+    def checked_columns(self):
+        return self.spec["keys"]
+
+    def shardable(self, column):
+        # Duplicates share the values of every key, so they only all land in one shard when the shard column is a key
+        return column in self.spec["keys"]
+
+    def summary(self):
+        return f"({', '.join(self.spec['keys'])}) is unique"
+
+
+class ForeignKeyRuleSpec(RuleSpec):
+    """
+    Every value of columns must exist in the referenced table, given as "table.column" or as
+    {"table": ..., "columns": [...]}. Rows with a NULL key are skipped unless "allow_null" is false,
+    and "case_insensitive" compares the keys in upper case.
+    """
+
+    type = "foreign_key"
+    required = ("references",)
+
+    def __init__(self, spec, story=None, source=None):
+        super().__init__(spec, story=story, source=source)
+        self.columns = spec.get("columns") or [spec["column"]]
+        references = spec["references"]
+        if isinstance(references, str):
+            self.parent_table, parent_column = references.rsplit(".", 1)
+            self.parent_columns = [parent_column]
+        else:
+            self.parent_table, self.parent_columns = references["table"], references["columns"]
+        if len(self.columns) != len(self.parent_columns):
+            raise ValueError(f"Foreign key rule {self.name} in {source} references a different number of columns")
+        # Missing keys are reported with the number of rows carrying each of them
+        self.group_by = spec.get("group_by", self.columns)
+
+    def checked_columns(self):
+        return self.columns
+
+    def summary(self):
+        return f"({', '.join(self.columns)}) exists in {self.parent_table}({', '.join(self.parent_columns)})"
+
+
+# Rule spec classes by the type used in the rule files
+RULE_SPEC_TYPES = {rule_class.type: rule_class for rule_class in
+                   (NotNullRuleSpec, PositiveRuleSpec, RangeRuleSpec, AcceptedValuesRuleSpec, RejectedValuesRuleSpec,
+                    RowCountRuleSpec, UniqueRuleSpec, ForeignKeyRuleSpec)}
+
+
+def load_rule_file(path, rule_types=RULE_SPEC_TYPES):
+    """
+    Parses one rule file: {"story": ..., "rules": [{"name": ..., "table": ..., "type": ..., ...}, ...]}, into
+    instances of the rule_types classes.
+    """
+    with open(path, 'r') as file:
+        content = json.load(file)
+    rules = []
+    for spec in content["rules"]:
+        if spec.get("type") not in rule_types:
+            raise ValueError(f"Unknown rule type {spec.get('type')!r} in {path}")
+        rules.append(rule_types[spec["type"]](spec, story=content.get("story"), source=path))
+    return rules
+
+
+def load_rule_specs(rules_dir=DEFAULT_RULES_DIR, rule_types=RULE_SPEC_TYPES):
+    """Loads every *.json rule file of the directory; rule names must be unique across the files."""
+    rules = []
+    for file_name in sorted(os.listdir(rules_dir)):
+        if file_name.endswith(".json"):
+            rules.extend(load_rule_file(os.path.join(rules_dir, file_name), rule_types))
+    names = [rule.name for rule in rules]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate rule names: {', '.join(duplicates)}")
+    return rules
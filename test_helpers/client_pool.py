@@ -0,0 +1,60 @@
+import threading
+
+
+class BigQueryClientPool:
+    """
+    Session-wide pool of BigQuery clients, one per backend, project, dataset and credentials file.
+    Clients created from the same service-account file share one set of credentials and one authorized
+    HTTP session, so the key file is read once and the access token is fetched once and reused until it expires.
+    """
+
+    def __init__(self):
+        self._clients = {}  # client key -> client
+        self._sessions = {}  # credentials file -> AuthorizedSession
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _client_key(env):
+        return env.backend, env.gcp_project_id, env.bigquery_dataset_id, env.google_application_credentials
+
+    def _authorized_session(self, env):
+        """Returns the authorized session shared by the clients using env's service-account file."""
+        session = self._sessions.get(env.google_application_credentials)
+        if session is None:
+            # Imported here so that collecting the tests does not pay for the google-auth transport imports
+            from google.auth.credentials import with_scopes_if_required
+            from google.auth.transport.requests import AuthorizedSession
+            from google.cloud import bigquery
+
+            credentials = with_scopes_if_required(env.load_credentials(), bigquery.Client.SCOPE)
+            session = AuthorizedSession(credentials)
+            self._sessions[env.google_application_credentials] = session
+        return session
+
+    def get(self, env):
+        """Returns the pooled client for the environment, creating it on first use."""
+        key = self._client_key(env)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                if env.is_local:
+                    client = env.create_bq_client()
+                else:
+                    session = self._authorized_session(env)
+                    client = env.create_bq_client(credentials=session.credentials, http=session)
+                self._clients[key] = client
+        return client
+
+    def close(self):
+        """Closes every pooled client and shared session."""
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            for session in self._sessions.values():
+                session.close()
+            self._clients.clear()
+            self._sessions.clear()
+
+
+# Pool shared by the fixtures of a test session
+client_pool = BigQueryClientPool()
@@ -0,0 +1,108 @@
+import time
+import json
+import allure
+from test_helpers import prefetch, query_profile, scheduling, templates
+from test_helpers.helpers import (STREAM_ATTACHMENT_ROW_CAP, attach_worker_reuse, default_serializer,
+                                  is_google_cloud_error)
+from test_helpers.violations import MAX_REPORTED_FAILURES
+
+
+def execute_query_to_arrow(bq_client, query, description="Executing query", attachment_row_cap=None):
+    """
+    Executes an SQL query and returns its result as a pyarrow Table, logging it in Allure like execute_query_and_log.
+    On BigQuery the result is read through the BigQuery Storage Read API as Arrow record batches, so no Row object is
+    created per row; checks with large results assert on its columns with the vectorized helpers below.
+    Columnar results bypass the check result cache, which stores rows.
+    """
+    with allure.step(description):
+        try:
+            allure.attach(query, name="SQL Query", attachment_type=allure.attachment_type.TEXT)
+            templates.attach_parameters(query)
+
+            prefetched = prefetch.take_prefetched(query)
+            started = time.monotonic()
+            if prefetched is not None:
+                # Wait for the result submitted when the session started
+                query_job, results = scheduling.wait_future(prefetched, query)
+            else:
+                query_job = scheduling.submit(bq_client, query)
+                results = scheduling.wait(query_job, query)
+            if isinstance(results, list):
+                # Rows of a prefetched query that went through the pytest-xdist coordinator, read by another worker
+                # or materialized by this one to share them
+                table = rows_to_arrow(results)
+            else:
+                table = results.to_arrow(create_bqstorage_client=True)
+
+            # Record what the query cost, attributed to the running check
+            stats = query_profile.QueryStats(query, query_job, wall_ms=round((time.monotonic() - started) * 1000))
+            if query_job is None:
+                attach_worker_reuse(stats)
+            query_profile.record(stats)
+            allure.attach(json.dumps(stats.to_dict(), indent=4, default=default_serializer), name="Query Cost",
+                          attachment_type=allure.attachment_type.JSON)
+
+            attach_arrow_results(table, attachment_row_cap)
+            return table
+
+        except scheduling.CheckTimeout:
+            raise
+        except Exception as e:
+            if is_google_cloud_error(e):
+                allure.attach(str(e), name="Query Error", attachment_type=allure.attachment_type.TEXT)
+                raise RuntimeError(f"Query execution failed: {e}")
+            allure.attach(str(e), name="General Error", attachment_type=allure.attachment_type.TEXT)
+            raise RuntimeError(f"An error occurred: {e}")
+
+
+def rows_to_arrow(rows):
+    """Builds a pyarrow Table from rows that were already read; an empty result has no columns."""
+    import pyarrow
+
+    return pyarrow.Table.from_pylist([dict(row.items()) for row in rows])
+
+
+def attach_arrow_results(table, attachment_row_cap=None):
+    """Attaches the first attachment_row_cap rows of a pyarrow Table to Allure as CSV written from its columns."""
+    import pyarrow
+    import pyarrow.csv
+
+    row_cap = STREAM_ATTACHMENT_ROW_CAP if attachment_row_cap is None else attachment_row_cap
+    buffer = pyarrow.BufferOutputStream()
+    pyarrow.csv.write_csv(table.slice(0, row_cap), buffer)
+    if table.num_rows > row_cap:
+        allure.attach(f"{table.num_rows} rows returned, the first {row_cap} are attached",
+                      name="SQL Results Truncated", attachment_type=allure.attachment_type.TEXT)
+    allure.attach(buffer.getvalue().to_pybytes(), name="SQL Results", attachment_type=allure.attachment_type.CSV)
+
+
+def column_values(table, name):
+    """Returns a column of a pyarrow Table as a NumPy array; integer columns with NULLs become float with NaN."""
+    return table.column(name).to_numpy()
+
+
+def describe_rows(table, max_listed=MAX_REPORTED_FAILURES):
+    """Lists the first max_listed rows of a pyarrow Table for an assertion message; only those become Python objects."""
+    lines = [", ".join(f"{field}: {value}" for field, value in row.items())
+             for row in table.slice(0, max_listed).to_pylist()]
+    if table.num_rows > max_listed:
+        lines.append(f"... and {table.num_rows - max_listed} more rows")
+    return "\n".join(lines)
+
+
+def assert_no_rows(table, message, max_listed=MAX_REPORTED_FAILURES):
+    """Asserts that a query selecting offending rows returned none, listing the first of them otherwise."""
+    assert table.num_rows == 0, f"{message} ({table.num_rows} rows):\n{describe_rows(table, max_listed)}"
+
+
+def assert_all(table, mask, message, max_listed=MAX_REPORTED_FAILURES):
+    """
+    Asserts that a boolean NumPy mask computed over the columns of a table holds for every row,
+    listing the first rows where it does not otherwise.
+    """
+    import numpy
+    import pyarrow
+
+    if numpy.all(mask):
+        return
+    assert_no_rows(table.filter(pyarrow.array(~numpy.asarray(mask, dtype=bool))), message, max_listed)
@@ -0,0 +1,211 @@
+import os
+import json
+import fcntl
+import pickle
+import shutil
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+from test_helpers import scheduling, templates
+from test_helpers.local_backend import LocalRow
+from test_helpers.result_cache import normalize_sql
+
+
+# Durations of the checks in earlier runs, read to schedule the longest checks first under pytest-xdist
+DEFAULT_DURATIONS_PATH = os.getenv("CHECK_DURATIONS_PATH",
+                                   os.path.join(os.path.dirname(__file__), '..', '.check_cache', 'durations.json'))
+# Subdirectory of the Allure results directory each xdist worker writes its results to until they are merged
+WORKER_RESULTS_DIR = ".workers"
+# xdist worker prefetching the check queries of the whole session; the other workers read its results
+PREFETCH_WORKER = "gw0"
+
+# Coordinator shared by the xdist workers of the current session, None in a single-process run
+_active_coordinator = None
+
+
+def worker_id():
+    """Returns the id of the current xdist worker (gw0, gw1, ...), or None in the controller or a serial run."""
+    return os.getenv("PYTEST_XDIST_WORKER")
+
+
+def is_controller(config):
+    """Checks whether this process distributes the tests to xdist workers."""
+    return worker_id() is None and bool(getattr(config.option, "numprocesses", None))
+
+
+def is_distributed(config):
+    """Checks whether the tests run under pytest-xdist, in the controller or in a worker."""
+    return worker_id() is not None or is_controller(config)
+
+
+def prefetches():
+    """Checks whether this process prefetches the check queries: in a serial run, or as the prefetching xdist worker."""
+    return worker_id() in (None, PREFETCH_WORKER)
+
+
+def worker_path(path):
+    """Returns the per-worker variant of a path written at the end of the session: profile.json -> profile.gw0.json."""
+    worker = worker_id()
+    if worker is None:
+        return path
+    root, extension = os.path.splitext(path)
+    return f"{root}.{worker}{extension}"
+
+
+@contextmanager
+def file_lock(path):
+    """Holds an exclusive lock on path, shared by every process of the machine, for the duration of the block."""
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class QueryCoordinator:
+    """
+    Runs every distinct check query once for all xdist workers of a session. The controller creates the directory,
+    and each worker takes a lock per normalized query in it: the first worker to take it runs the query and writes its
+    rows next to the lock, the others wait for the lock and read the rows instead of running the query again.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.ran = 0
+        self.reused = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def create_directory():
+        """Creates the directory shared by the workers; called by the controller."""
+        return tempfile.mkdtemp(prefix="check-coordinator-")
+
+    @staticmethod
+    def remove_directory(directory):
+        shutil.rmtree(directory, ignore_errors=True)
+
+    def _paths(self, query):
+        # Runs of the same template with other parameter values are other queries
+        parameters = "".join(f"\n@{name}={value!r}" for name, _, value in templates.parameters_of(query))
+        key = hashlib.sha256((normalize_sql(query) + parameters).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{key}.lock"), os.path.join(self.directory, f"{key}.pickle")
+
+    def run_once(self, query, run):
+        """
+        Returns (query_job, rows) for the query: run() -> (QueryJob, RowIterator) is called only if no worker ran the
+        query yet. query_job is None when the rows were read from the worker that ran it, which paid for the query.
+        """
+        lock_path, result_path = self._paths(query)
+        with file_lock(lock_path):
+            if os.path.exists(result_path):
+                with open(result_path, 'rb') as file:
+                    field_names, values = pickle.load(file)
+                with self._lock:
+                    self.reused += 1
+                field_to_index = {name: index for index, name in enumerate(field_names)}
+                return None, [LocalRow(row, field_to_index) for row in values]
+
+            query_job, results = run()
+            rows = list(results)
+            field_names = list(rows[0].keys()) if rows else []
+            payload = (field_names, [tuple(row.values()) for row in rows])
+            # Written next to the result and renamed, so a worker never reads a partial file
+            temporary_path = f"{result_path}.{os.getpid()}"
+            with open(temporary_path, 'wb') as file:
+                pickle.dump(payload, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary_path, result_path)
+            with self._lock:
+                self.ran += 1
+            return query_job, rows
+
+
+class CheckDurations:
+    """Durations of the checks in earlier runs, keyed by test node id; the longest are scheduled first."""
+
+    def __init__(self, path=DEFAULT_DURATIONS_PATH):
+        self.path = path
+        self._durations = {}
+        self._recorded = {}  # Durations measured in this run
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                self._durations = json.load(file)
+
+    def record(self, nodeid, seconds):
+        self._recorded[nodeid] = round(seconds, 3)
+
+    def order(self, items, longest_first=True, rank=None):
+        """
+        Sorts the items by rank(item), if given, then by duration in place. Longest-first, checks without a recorded
+        duration go first since they may be the longest; cheapest-first, they go last. The sort is stable and only
+        depends on the durations file, so every xdist worker collects the same order.
+        """
+        def key(item):
+            seconds = self._durations.get(item.nodeid, float("inf"))
+            return rank(item) if rank is not None else 0, -seconds if longest_first else seconds
+
+        items.sort(key=key)
+
+    def save(self):
+        """Merges the durations of this run into the file."""
+        if not self._recorded:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with file_lock(f"{self.path}.lock"):
+            durations = {}
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as file:
+                    durations = json.load(file)
+            durations.update(self._recorded)
+            with open(self.path, 'w') as file:
+                json.dump(durations, file, indent=4, sort_keys=True)
+
+
+def worker_results_dir(report_dir):
+    """Returns the Allure results directory of the current worker inside the session's results directory."""
+    return os.path.join(report_dir, WORKER_RESULTS_DIR, worker_id())
+
+
+def merge_worker_results(report_dir):
+    """Moves the Allure results written by every worker into the session's results directory."""
+    workers_dir = os.path.join(report_dir, WORKER_RESULTS_DIR)
+    if not os.path.isdir(workers_dir):
+        return 0
+    moved = 0
+    for worker in sorted(os.listdir(workers_dir)):
+        for name in os.listdir(os.path.join(workers_dir, worker)):
+            # Allure names every result and attachment file by a UUID, so files of different workers never collide
+            os.replace(os.path.join(workers_dir, worker, name), os.path.join(report_dir, name))
+            moved += 1
+    shutil.rmtree(workers_dir, ignore_errors=True)
+    return moved
+
+
+def activate(coordinator):
+    """Makes the check queries of this worker run through the coordinator."""
+    global _active_coordinator
+    _active_coordinator = coordinator
+
+
+def deactivate():
+    global _active_coordinator
+    _active_coordinator = None
+
+
+def active_coordinator():
+    """Returns the coordinator of the current worker, or None in a single-process run."""
+    return _active_coordinator
+
+
+def run_query(bq_client, query):
+    """
+    Runs a check query and returns (query_job, results), through the coordinator when the session is distributed
+    so that every query runs once over all workers. query_job is None when another worker already ran the query.
+    """
+    def run():
+        query_job = scheduling.submit(bq_client, query)
+        return query_job, scheduling.wait(query_job, query)
+
+    coordinator = _active_coordinator
+    return run() if coordinator is None else coordinator.run_once(query, run)
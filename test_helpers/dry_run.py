@@ -0,0 +1,101 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from test_helpers import templates
+
+
+# Maximum number of dry runs submitted at the same time; they are not billed and return in one round trip
+DEFAULT_MAX_CONCURRENT_DRY_RUNS = int(os.getenv("MAX_CONCURRENT_DRY_RUNS", "32"))
+# Bytes the check queries of a run may be estimated to process before the run is aborted; None for no ceiling
+DEFAULT_MAX_RUN_BYTES = int(os.getenv("MAX_RUN_BYTES")) if os.getenv("MAX_RUN_BYTES") else None
+
+
+def dry_run_config(env):
+    """Returns the job config of a dry run for the environment's backend."""
+    if env.is_local:
+        from test_helpers.local_backend import LocalQueryJobConfig
+        return LocalQueryJobConfig(dry_run=True)
+    from google.cloud import bigquery
+    return bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+
+
+class DryRunResult:
+    """Outcome of the dry run of one check query: its estimated bytes, or the error BigQuery rejected it with."""
+
+    def __init__(self, query, checks, estimated_bytes=None, error=None):
+        self.query = query
+        self.checks = checks  # Node ids of the tests running the query
+        self.estimated_bytes = estimated_bytes
+        self.error = error
+
+
+class DryRunReport:
+    """Results of the dry runs of all check queries of a session."""
+
+    def __init__(self, results, elapsed, max_run_bytes=None):
+        self.results = results
+        self.elapsed = elapsed
+        self.max_run_bytes = max_run_bytes
+
+    @property
+    def errors(self):
+        return [result for result in self.results if result.error is not None]
+
+    @property
+    def estimated_bytes(self):
+        return sum(result.estimated_bytes or 0 for result in self.results)
+
+    @property
+    def over_ceiling(self):
+        return self.max_run_bytes is not None and self.estimated_bytes > self.max_run_bytes
+
+    def failure_message(self):
+        """Returns why the run must not start, listing every invalid query, or None if it may start."""
+        lines = []
+        for result in self.errors:
+            lines.append(f"{', '.join(result.checks)}:\n    {result.error}")
+        if self.over_ceiling:
+            lines.append(f"The check queries are estimated to process {self.estimated_bytes} bytes, "
+                         f"over the ceiling of {self.max_run_bytes} bytes")
+        if not lines:
+            return None
+        return f"Dry run rejected {len(self.errors)} of {len(self.results)} check queries:\n" + "\n".join(lines)
+
+
+def collect_checks_by_query(items, env):
+    """Returns the node ids of the tests running each distinct check query, in collection order."""
+    checks_by_query = {}
+    for item in items:
+        for marker in item.iter_markers("check_query"):
+            query = marker.args[0](env)
+            if query is not None:
+                checks_by_query.setdefault(query, []).append(item.nodeid)
+    return checks_by_query
+
+
+def dry_run_queries(bq_client, env, checks_by_query, skip_estimate=(), max_run_bytes=DEFAULT_MAX_RUN_BYTES,
+                    max_concurrent=DEFAULT_MAX_CONCURRENT_DRY_RUNS):
+    """
+    Dry-runs every query concurrently, so the whole phase takes about one round trip. Queries in skip_estimate
+    are validated but not counted towards the estimate, e.g. because their results will be replayed from a cache.
+    """
+    job_config = dry_run_config(env)
+
+    def dry_run(query):
+        # A template query is compiled with its parameters, as it runs
+        config = (templates.job_config(env, query, dry_run=True, use_query_cache=False)
+                  if templates.parameters_of(query) else job_config)
+        try:
+            query_job = bq_client.query(query, job_config=config)
+        except Exception as e:
+            return DryRunResult(query, checks_by_query[query], error=str(e))
+        estimated_bytes = None if query in skip_estimate else query_job.total_bytes_processed
+        return DryRunResult(query, checks_by_query[query], estimated_bytes=estimated_bytes)
+
+    started = time.monotonic()
+    if not checks_by_query:
+        return DryRunReport([], 0.0, max_run_bytes)
+    with ThreadPoolExecutor(max_workers=min(max_concurrent, len(checks_by_query)),
+                            thread_name_prefix="check-dry-run") as executor:
+        results = list(executor.map(dry_run, checks_by_query))
+    return DryRunReport(results, time.monotonic() - started, max_run_bytes)
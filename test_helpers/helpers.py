@@ -1,7 +1,30 @@
+import os
+import sys
+import time
 import allure
 import json
 from datetime import date, datetime
-from google.cloud.exceptions import GoogleCloudError
+from test_helpers import distributed, prefetch, query_profile, result_cache, scheduling, templates
+
+
+# Maximum number of rows written to the Allure attachment of a columnar result (the rows themselves are not capped)
+STREAM_ATTACHMENT_ROW_CAP = int(os.getenv("STREAM_ATTACHMENT_ROW_CAP", "10000"))
+
+
+def default_serializer(obj):
+    """JSON serializer for objects not serializable by default json code"""
+    if isinstance(obj, (date, datetime)):
+        return obj.isoformat()
+    raise TypeError("Type %s not serializable" % type(obj))
+
+
+def is_google_cloud_error(error):
+    """
+    Checks whether the error is a GoogleCloudError without importing google-cloud for it:
+    such an error can only have been raised if a client already imported the module.
+    """
+    exceptions = sys.modules.get("google.cloud.exceptions")
+    return exceptions is not None and isinstance(error, exceptions.GoogleCloudError)
 
 
 def execute_query_and_log(bq_client, query, description="Executing query", include_query_in_message=False):
@@ -14,28 +37,61 @@ def execute_query_and_log(bq_client, query, description="Executing query", inclu
         try:
             # Logging the SQL query
             allure.attach(query, name="SQL Query", attachment_type=allure.attachment_type.TEXT)
+            templates.attach_parameters(query)
+
+            # Replay the result from the check result cache if none of the tables behind the query changed
+            cache = result_cache.active_cache()
+            cache_key = cache.key_for(bq_client, query) if cache is not None else None
+            cached_rows = cache.get(cache_key) if cache_key is not None else None
+
+            prefetched = prefetch.take_prefetched(query)
+            started = time.monotonic()
+            query_job = None
+            if cached_rows is not None:
+                allure.attach(f"Result replayed from the check result cache, key: {cache_key}", name="Result Cache",
+                              attachment_type=allure.attachment_type.TEXT)
+                results = cached_rows
+            elif prefetched is not None:
+                # Wait for the result submitted when the session started
+                query_job, results = scheduling.wait_future(prefetched, query)
+            else:
+                # Under pytest-xdist the query runs once for all workers
+                query_job, results = distributed.run_query(bq_client, query)
+
+            # Record what the query cost, attributed to the running check
+            stats = query_profile.QueryStats(query, query_job, wall_ms=round((time.monotonic() - started) * 1000),
+                                             result_cache_hit=cached_rows is not None)
+            if query_job is None and cached_rows is None:
+                attach_worker_reuse(stats)
+            query_profile.record(stats)
+            allure.attach(json.dumps(stats.to_dict(), indent=4, default=default_serializer), name="Query Cost",
+                          attachment_type=allure.attachment_type.JSON)
 
-            query_job = bq_client.query(query)  # Execute the query
-            results = query_job.result()  # Get query results
             results_list = list(results)  # Convert results to a list for multiple uses
+            if cache_key is not None and cached_rows is None:
+                cache.put(cache_key, results_list)
 
             # Additionally, log the query results in JSON format
             results_data = [dict(row.items()) for row in results_list]
 
-            def default_serializer(obj):
-                """JSON serializer for objects not serializable by default json code"""
-                if isinstance(obj, (date, datetime)):
-                    return obj.isoformat()
-                raise TypeError("Type %s not serializable" % type(obj))
-
             results_json = json.dumps(results_data, indent=4, default=default_serializer)
             allure.attach(results_json, name="SQL Results", attachment_type=allure.attachment_type.JSON)
 
             return iter(results_list)  # Return an iterator of the result list
 
-        except GoogleCloudError as e:
-            allure.attach(str(e), name="Query Error", attachment_type=allure.attachment_type.TEXT)
-            raise RuntimeError(f"Query execution failed: {e}")
+        except scheduling.CheckTimeout:
+            raise
         except Exception as e:
+            if is_google_cloud_error(e):
+                allure.attach(str(e), name="Query Error", attachment_type=allure.attachment_type.TEXT)
+                raise RuntimeError(f"Query execution failed: {e}")
             allure.attach(str(e), name="General Error", attachment_type=allure.attachment_type.TEXT)
             raise RuntimeError(f"An error occurred: {e}")
+
+
+def attach_worker_reuse(stats):
+    """Marks the stats of a query another xdist worker ran as shared, so its cost is not counted twice."""
+    stats.shared = True
+    allure.attach("Result read from the run of another pytest-xdist worker, no job ran in this worker",
+                  name="Shared Result", attachment_type=allure.attachment_type.TEXT)
+
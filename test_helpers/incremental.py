@@ -0,0 +1,190 @@
+import os
+import json
+import threading
+from datetime import date, datetime, timedelta, timezone
+import pytest
+from test_helpers import templates
+from test_helpers.client_pool import client_pool
+from test_helpers.distributed import file_lock
+
+
+# File keeping the per-check high-watermarks between runs
+DEFAULT_STATE_PATH = os.getenv("CHECK_WATERMARK_PATH",
+                               os.path.join(os.path.dirname(__file__), '..', '.check_state', 'watermarks.json'))
+# Number of days after which an incremental check is evaluated over the full history again
+DEFAULT_FULL_RECHECK_DAYS = int(os.getenv("FULL_RECHECK_DAYS", "7"))
+# Column the data is appended by; only rows newer than a check's watermark are evaluated incrementally
+WATERMARK_COLUMN = "install_date"
+
+# Incremental state of the current test session, None when every check scans the full history
+_active_checks = None
+
+
+def incremental_check(table_name, check_name):
+    """
+    Marks a test whose query evaluates only the rows of table_name inside the window of check_name,
+    so the check's watermark is advanced when the test passes.
+    """
+    return pytest.mark.incremental_check.with_args(table_name, check_name)
+
+
+class CheckWindow:
+    """
+    The range of watermark values a check evaluates in this run: [lower, upper], or everything for a full check.
+    The lower bound is inclusive because rows can still arrive for the watermark day after the check passed.
+    The bounds are sent as the query parameters @<name>_window_lower and @<name>_window_upper.
+    """
+
+    def __init__(self, lower=None, upper=None, full=True, name="check"):
+        self.lower = lower
+        self.upper = upper
+        self.full = full
+        self.name = name
+
+    @property
+    def predicate(self):
+        """SQL predicate selecting the rows of the window, with its bounds as query parameters."""
+        if self.full:
+            return "TRUE"
+        if self.upper is None:
+            return "FALSE"  # The table has no rows
+        if self.lower is None:
+            return f"{WATERMARK_COLUMN} <= @{self.name}_window_upper"
+        return f"{WATERMARK_COLUMN} >= @{self.name}_window_lower AND {WATERMARK_COLUMN} <= @{self.name}_window_upper"
+
+    def parameters(self):
+        """Query parameters of the predicate by name."""
+        if self.full or self.upper is None:
+            return {}
+        parameters = {f"{self.name}_window_upper": date.fromisoformat(self.upper)}
+        if self.lower is not None:
+            parameters[f"{self.name}_window_lower"] = date.fromisoformat(self.lower)
+        return parameters
+
+    def __repr__(self):
+        return f"CheckWindow(lower={self.lower!r}, upper={self.upper!r}, full={self.full!r}, name={self.name!r})"
+
+
+# Window of checks that are not run incrementally
+FULL_WINDOW = CheckWindow()
+
+
+class IncrementalChecks:
+    """
+    Stores a high-watermark on install_date per check and table, and hands out windows covering only the rows
+    appended since the check last passed, starting at the watermark day itself. A check is evaluated over the full
+    history when it has no watermark yet, when its last full evaluation is older than full_recheck_days, or when
+    force_full is set.
+    """
+
+    def __init__(self, path=DEFAULT_STATE_PATH, full_recheck_days=DEFAULT_FULL_RECHECK_DAYS, force_full=False):
+        self.path = path
+        self.full_recheck_days = full_recheck_days
+        self.force_full = force_full
+        self._windows = {}  # state key -> CheckWindow handed out in this run
+        self._upper_bounds = {}  # full table id -> newest watermark value at the start of the run
+        self._committed = set()  # State keys whose watermark moved in this run
+        self._lock = threading.Lock()
+        self._state = {}
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                self._state = json.load(file)
+
+    @staticmethod
+    def _state_key(full_table_id, check_name):
+        return f"{full_table_id}:{check_name}"
+
+    def _upper_bound(self, env, table_name):
+        """Returns the newest watermark value of the table, looked up once per run."""
+        full_table_id = env.get_full_table_id(table_name, override=False)
+        if full_table_id not in self._upper_bounds:
+            # Rows at or below the oldest stored watermark of the table cannot move the maximum
+            watermarks = [entry["watermark"] for key, entry in self._state.items()
+                          if key.startswith(f"{full_table_id}:") and entry.get("watermark")]
+            where = f"WHERE {WATERMARK_COLUMN} > @watermark" if watermarks else ""
+            # Read from the table overriding the view when it is materialized for the session
+            query = templates.register_compiled(
+                "upper_bound", f"SELECT MAX({WATERMARK_COLUMN}) AS max_value FROM {{{table_name}}} {where}"
+            ).render(env, **({"watermark": date.fromisoformat(min(watermarks))} if watermarks else {}))
+            max_value = next(iter(client_pool.get(env).query(query, job_config=templates.job_config(env, query))
+                                  .result())).max_value
+            if max_value is None and watermarks:
+                max_value = max(watermarks)  # Nothing was appended since the last run
+            self._upper_bounds[full_table_id] = str(max_value) if max_value is not None else None
+        return self._upper_bounds[full_table_id]
+
+    def _full_recheck_due(self, entry):
+        if self.force_full or not entry.get("watermark") or not entry.get("last_full_check"):
+            return True
+        last_full_check = datetime.fromisoformat(entry["last_full_check"])
+        return datetime.now(timezone.utc) - last_full_check >= timedelta(days=self.full_recheck_days)
+
+    def window(self, env, table_name, check_name):
+        """Returns the window the check evaluates in this run; the same window is returned for the whole run."""
+        # Watermarks are kept under the table's own id, also while it is overridden by a snapshot
+        full_table_id = env.get_full_table_id(table_name, override=False)
+        key = self._state_key(full_table_id, check_name)
+        with self._lock:
+            if key not in self._windows:
+                entry = self._state.get(key, {})
+                upper = self._upper_bound(env, table_name)
+                if self._full_recheck_due(entry):
+                    self._windows[key] = CheckWindow(upper=upper, full=True, name=check_name)
+                else:
+                    self._windows[key] = CheckWindow(lower=entry["watermark"], upper=upper, full=False,
+                                                     name=check_name)
+            return self._windows[key]
+
+    def commit(self, env, table_name, check_name):
+        """Advances the check's watermark to the upper bound of its window after the check passed."""
+        full_table_id = env.get_full_table_id(table_name, override=False)
+        key = self._state_key(full_table_id, check_name)
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or window.upper is None:
+                return
+            entry = self._state.setdefault(key, {})
+            entry["watermark"] = window.upper
+            self._committed.add(key)
+            if window.full:
+                entry["last_full_check"] = datetime.now(timezone.utc).isoformat()
+
+    def save(self):
+        """
+        Writes the watermarks moved in this run to disk, merged into the watermarks stored by the processes that saved
+        since this one started, such as the other workers of a pytest-xdist session.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with file_lock(f"{self.path}.lock"):
+            state = {}
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as file:
+                    state = json.load(file)
+            state.update({key: self._state[key] for key in self._committed})
+            with open(self.path, 'w') as file:
+                json.dump(state, file, indent=4, sort_keys=True)
+
+
+def activate(checks):
+    """Makes the checks' queries evaluate only their incremental windows."""
+    global _active_checks
+    _active_checks = checks
+
+
+def deactivate():
+    """Saves the watermarks and returns to full-history checks."""
+    global _active_checks
+    checks, _active_checks = _active_checks, None
+    if checks is not None:
+        checks.save()
+
+
+def active_checks():
+    """Returns the incremental state of the current session, or None in full mode."""
+    return _active_checks
+
+
+def window(env, table_name, check_name):
+    """Returns the window of the check in the current session; the full history unless incremental mode is on."""
+    checks = _active_checks
+    return checks.window(env, table_name, check_name) if checks is not None else FULL_WINDOW
@@ -0,0 +1,133 @@
+import os
+import uuid
+
+
+# Hours after which BigQuery deletes an intermediate table left behind by an interrupted session
+INTERMEDIATE_EXPIRATION_HOURS = int(os.getenv("INTERMEDIATE_EXPIRATION_HOURS", "24"))
+# Column of an intermediate holding the number of rows of its table behind each of its rows
+ROW_COUNT_COLUMN = "row_count"
+
+# Intermediates of the current session, None when every check reads its tables directly
+_active_intermediates = None
+
+
+class Intermediate:
+    """
+    A small result several checks derive from the same table: the distinct combinations of columns with the number
+    of rows carrying each, so that a check counting rows can be evaluated on it as well as on the table.
+    """
+
+    def __init__(self, name, table, columns):
+        self.name = name
+        self.table = table
+        self.columns = columns
+
+    def __repr__(self):
+        return f"Intermediate({self.name!r}, table={self.table!r}, columns={self.columns!r})"
+
+    @property
+    def sql(self):
+        """The query computing the intermediate, with a {table} placeholder for its table as in query templates."""
+        columns = ", ".join(self.columns)
+        return f"""
+        SELECT {columns}, COUNT(*) AS {ROW_COUNT_COLUMN}
+        FROM {{{self.table}}}
+        GROUP BY {columns}
+        """
+
+    def build_query(self, env):
+        """Returns the query computing the intermediate from its table."""
+        return self.sql.replace(f"{{{self.table}}}", f"`{env.get_full_table_id(self.table)}`")
+
+    def covers(self, table, columns):
+        """Checks whether rows of table reading only columns can be evaluated on the intermediate."""
+        return table == self.table and set(columns) <= set(self.columns)
+
+
+# (device_model, device_segment) pairs of v_agg_data, read by the segment checks of the view
+DEVICE_SEGMENT_PAIRS = Intermediate("device_segment_pairs", "v_agg_data", ["device_model", "device_segment"])
+# Intermediates that --share-intermediates computes once per session
+INTERMEDIATES = (DEVICE_SEGMENT_PAIRS,)
+
+
+def build_intermediate_statement(query, table_id, expiration_hours=INTERMEDIATE_EXPIRATION_HOURS):
+    """Returns the statement materializing an intermediate into a session table."""
+    return f"""
+CREATE TABLE `{table_id}`
+OPTIONS (expiration_timestamp = TIMESTAMP_ADD(CURRENT_TIMESTAMP(), INTERVAL {expiration_hours} HOUR))
+AS SELECT * FROM (
+{query}
+)
+"""
+
+
+class SharedIntermediates:
+    """
+    Computes every intermediate once per session into a table that expires on its own, and hands it out to the
+    checks reading it in place of their table; the tables are dropped when the session ends. Views are the
+    expensive case: the view is evaluated once for all checks reading the intermediate instead of once per check.
+    """
+
+    def __init__(self, bq_client, env, intermediates=INTERMEDIATES):
+        self.bq_client = bq_client
+        self.env = env
+        self.intermediates = intermediates
+        self.tables = {}  # intermediate name -> full id of its session table
+        self.sources = {}  # full id of a session table -> full id of the table it was computed from
+
+    def create(self):
+        """Creates one table per intermediate, after any snapshot of its table so that it reads the snapshot."""
+        # A random suffix keeps concurrent sessions on the same dataset from dropping each other's tables
+        suffix = uuid.uuid4().hex[:8]
+        for intermediate in self.intermediates:
+            table_id = f"{self.env.get_full_table_id(intermediate.name, override=False)}_{suffix}"
+            self.bq_client.query(build_intermediate_statement(intermediate.build_query(self.env), table_id)).result()
+            self.tables[intermediate.name] = table_id
+            self.sources[table_id] = self.env.get_full_table_id(intermediate.table, override=False)
+
+    def covering(self, table, columns):
+        """Returns the intermediate of this session a count over columns of table can read, or None."""
+        for intermediate in self.intermediates:
+            if intermediate.name in self.tables and intermediate.covers(table, columns):
+                return intermediate
+        return None
+
+    def drop(self):
+        for table_id in self.tables.values():
+            self.bq_client.query(f"DROP TABLE IF EXISTS `{table_id}`").result()
+        self.tables.clear()
+        self.sources.clear()
+
+
+def activate(shared):
+    """Makes the checks read the intermediates of the session instead of recomputing them."""
+    global _active_intermediates
+    _active_intermediates = shared
+
+
+def deactivate():
+    global _active_intermediates
+    _active_intermediates = None
+
+
+def active_intermediates():
+    """Returns the intermediates of the current session, or None if checks read their tables directly."""
+    return _active_intermediates
+
+
+def source(env, intermediate):
+    """
+    Returns the FROM source of an intermediate for a query template: its session table when it was computed for the
+    session, otherwise the query computing it with a {table} placeholder, so that a check reads the same columns
+    either way.
+    """
+    shared = _active_intermediates
+    if shared is not None and intermediate.name in shared.tables:
+        return f"`{shared.tables[intermediate.name]}`"
+    return f"({intermediate.sql})"
+
+
+def source_table(table_id):
+    """Returns the table a session intermediate was computed from, or table_id itself for any other table."""
+    shared = _active_intermediates
+    return shared.sources.get(table_id, table_id) if shared is not None else table_id
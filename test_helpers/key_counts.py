@@ -0,0 +1,175 @@
+import os
+import time
+import json
+import allure
+from test_helpers import query_profile, templates
+from test_helpers.helpers import default_serializer
+from test_helpers.incremental import WATERMARK_COLUMN
+
+
+# Table in the checked dataset keeping the key counts of every check, one row per check and partition
+KEY_COUNT_TABLE = os.getenv("CHECK_KEY_COUNT_TABLE", "check_key_counts")
+
+# Key count store of the current session, None when uniqueness is only checked by the exact queries
+_active_store = None
+
+
+def key_expression(columns):
+    """
+    A single STRING key of several columns; NULLs form one key like in GROUP BY. Values containing the separator
+    can make two keys collide, which only ever counts too few distinct keys, so the exact query then decides.
+    """
+    return " || '|' || ".join(f"IFNULL(CAST({column} AS STRING), '<null>')" for column in columns)
+
+
+class KeyCountComparison:
+    """
+    Exact number of distinct keys of a check compared with the number of keys expected if there are no duplicates.
+    They agree only when the two are equal: not a single duplicate is possible, at any table size.
+    """
+
+    def __init__(self, distinct_keys, expected):
+        self.distinct_keys = distinct_keys or 0
+        self.expected = expected or 0
+
+    @property
+    def duplicates(self):
+        return self.expected - self.distinct_keys
+
+    @property
+    def agrees(self):
+        return self.duplicates == 0
+
+    def to_dict(self):
+        return dict(vars(self), duplicates=self.duplicates, agrees=self.agrees)
+
+    def __str__(self):
+        return f"{self.distinct_keys} distinct keys for {self.expected} expected"
+
+
+class KeyCountStore:
+    """
+    Exact key counts of uniqueness checks. A check whose keys include install_date cannot have a key in two
+    partitions, so the distinct keys of its table are the sum of those of its partitions: the rows and distinct keys
+    of every partition are persisted in KEY_COUNT_TABLE, and a run only recounts the partitions inside the check's
+    incremental window. Any other check is counted with COUNT(DISTINCT) over its whole table in one aggregate, which
+    still spares the exact query the shuffle of every row into its key's group.
+    """
+
+    def __init__(self, bq_client, env):
+        self.bq_client = bq_client
+        self.env = env
+        self.table_id = env.get_full_table_id(KEY_COUNT_TABLE, override=False)
+        self._table_ready = False
+
+    def _run(self, query, description):
+        """Runs a statement maintaining the key counts; it is not cached, but its cost counts towards the check."""
+        with allure.step(description):
+            allure.attach(query, name="SQL Query", attachment_type=allure.attachment_type.TEXT)
+            templates.attach_parameters(query)
+            started = time.monotonic()
+            query_job = self.bq_client.query(query, job_config=templates.job_config(self.env, query))
+            results = list(query_job.result())
+            stats = query_profile.QueryStats(query, query_job, wall_ms=round((time.monotonic() - started) * 1000))
+            query_profile.record(stats)
+            allure.attach(json.dumps(stats.to_dict(), indent=4, default=default_serializer), name="Query Cost",
+                          attachment_type=allure.attachment_type.JSON)
+        return results
+
+    def _render(self, sql, **parameters):
+        """Renders a statement with {table} placeholders, the key count table's included, and query parameters."""
+        return templates.register_compiled("key_counts", sql).render(self.env, **parameters)
+
+    def ensure_table(self):
+        """Creates the key count table on the first use in the session."""
+        if self._table_ready:
+            return
+        self._run(f"""
+        CREATE TABLE IF NOT EXISTS `{self.table_id}` (
+            check_name STRING,
+            {WATERMARK_COLUMN} DATE,
+            distinct_keys INT64,
+            row_count INT64
+        )
+        """, f"Creating the key count table {KEY_COUNT_TABLE}")
+        self._table_ready = True
+
+    def _stored_partitions(self, check_name):
+        rows = self._run(self._render(f"SELECT COUNT(*) AS partitions FROM {{{KEY_COUNT_TABLE}}} "
+                                      f"WHERE check_name = @check_name", check_name=check_name),
+                         f"Counting the stored partitions of {check_name}")
+        return rows[0]["partitions"]
+
+    def count(self, check_name, table_name, columns, where="TRUE", window=None):
+        """
+        Returns the distinct keys of columns and the rows of table_name matching where. With the window of an
+        incremental check keyed by install_date, only the partitions inside the window are recounted, unless the
+        window is full or nothing is stored yet, and the others are read from the store.
+        """
+        key = key_expression(columns)
+        if window is None or WATERMARK_COLUMN not in columns:
+            rows = self._run(self._render(f"""
+            SELECT COUNT(DISTINCT {key}) AS distinct_keys, COUNT(*) AS row_count
+            FROM {{{table_name}}}
+            WHERE {where}
+            """), f"Counting the keys of {check_name} on {table_name}")
+            return rows[0]["distinct_keys"], rows[0]["row_count"]
+
+        self.ensure_table()
+        incremental = not window.full and self._stored_partitions(check_name)
+        recounted, parameters = (window.predicate, window.parameters()) if incremental else ("TRUE", {})
+        self._run(self._render(f"DELETE FROM {{{KEY_COUNT_TABLE}}} WHERE check_name = @check_name AND {recounted}",
+                               check_name=check_name, **parameters),
+                  f"Dropping the outdated key counts of {check_name}")
+        self._run(self._render(f"""
+        INSERT INTO {{{KEY_COUNT_TABLE}}} (check_name, {WATERMARK_COLUMN}, distinct_keys, row_count)
+        SELECT @check_name, {WATERMARK_COLUMN}, COUNT(DISTINCT {key}), COUNT(*)
+        FROM {{{table_name}}}
+        WHERE ({where}) AND {recounted}
+        GROUP BY {WATERMARK_COLUMN}
+        """, check_name=check_name, **parameters), f"Counting the keys of {check_name} on {table_name} per partition")
+        rows = self._run(self._render(f"""
+        SELECT SUM(distinct_keys) AS distinct_keys, SUM(row_count) AS row_count
+        FROM {{{KEY_COUNT_TABLE}}}
+        WHERE check_name = @check_name
+        """, check_name=check_name), f"Adding up the key counts of {check_name}")
+        return rows[0]["distinct_keys"], rows[0]["row_count"]
+
+    def compare_with_rows(self, check_name, table_name, columns, where="TRUE", window=None):
+        """Compares the distinct keys of a uniqueness check with the rows they cover."""
+        comparison = KeyCountComparison(*self.count(check_name, table_name, columns, where=where, window=window))
+        allure.attach(json.dumps(comparison.to_dict(), indent=4), name="Key Count Comparison",
+                      attachment_type=allure.attachment_type.JSON)
+        return comparison
+
+    def compare_keys(self, check_name, table_name, columns, expected_columns, where="TRUE"):
+        """
+        Compares the distinct values of columns with the distinct values of expected_columns, a superset of them:
+        they agree when every value of columns comes with a single value of the other expected columns.
+        """
+        rows = self._run(self._render(f"""
+        SELECT COUNT(DISTINCT {key_expression(columns)}) AS distinct_keys,
+            COUNT(DISTINCT {key_expression(expected_columns)}) AS expected
+        FROM {{{table_name}}}
+        WHERE {where}
+        """), f"Counting the keys of {check_name} on {table_name}")
+        comparison = KeyCountComparison(rows[0]["distinct_keys"], rows[0]["expected"])
+        allure.attach(json.dumps(comparison.to_dict(), indent=4), name="Key Count Comparison",
+                      attachment_type=allure.attachment_type.JSON)
+        return comparison
+
+
+def activate(store):
+    """Makes uniqueness checks declaring key counts compare the exact key counts of the store first."""
+    global _active_store
+    _active_store = store
+
+
+def deactivate():
+    global _active_store
+    _active_store = None
+
+
+def active_store():
+    """Returns the key count store of the current session, or None if uniqueness is only checked exactly."""
+    return _active_store
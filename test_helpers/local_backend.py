@@ -0,0 +1,429 @@
+import os
+import re
+import hashlib
+import sqlite3
+import threading
+import uuid
+from datetime import date, datetime, timezone
+
+
+# Default directory with the JSON sources that are loaded into the local backend
+DEFAULT_DATA_DIR = os.path.join(os.path.dirname(__file__), '..', 'data')
+
+# Number of rows fetched from SQLite per result page
+DEFAULT_PAGE_SIZE = 10000
+
+# BigQuery schema types mapped to SQLite column types
+SQLITE_TYPES = {
+    "INTEGER": "INTEGER",
+    "INT64": "INTEGER",
+    "FLOAT": "REAL",
+    "FLOAT64": "REAL",
+    "NUMERIC": "REAL",
+    "BOOLEAN": "INTEGER",
+    "BOOL": "INTEGER",
+    "STRING": "TEXT",
+    "DATE": "TEXT",
+    "DATETIME": "TEXT",
+    "TIMESTAMP": "TEXT",
+}
+
+# BigQuery-dialect constructs used by the checks and their SQLite equivalents
+_SAFE_CAST_PATTERN = re.compile(r"SAFE_CAST\(\s*([^()]+?)\s+AS\s+(\w+)\s*\)", re.IGNORECASE)
+_STRING_AGG_PATTERN = re.compile(r"\bSTRING_AGG\s*\(", re.IGNORECASE)
+_CURRENT_DATE_PATTERN = re.compile(r"\bCURRENT_DATE\s*\(\s*\)", re.IGNORECASE)
+_CAST_INT64_PATTERN = re.compile(r"\bAS\s+INT64\b", re.IGNORECASE)
+_COUNTIF_PATTERN = re.compile(r"\bCOUNTIF\s*\(", re.IGNORECASE)
+_RAND_PATTERN = re.compile(r"\bRAND\s*\(\s*\)", re.IGNORECASE)
+_CAST_STRING_PATTERN = re.compile(r"\bAS\s+STRING\s*\)", re.IGNORECASE)
+_CREATE_OR_REPLACE_VIEW_PATTERN = re.compile(r"^\s*CREATE\s+OR\s+REPLACE\s+VIEW\s+(`[^`]+`)", re.IGNORECASE)
+_CREATE_TABLE_PATTERN = re.compile(r"^\s*CREATE\s+TABLE\s+(`[^`]+`)", re.IGNORECASE)
+# The AS starting the SELECT of a CREATE TABLE ... AS statement, after any OPTIONS (...) clause
+_CREATE_TABLE_AS_PATTERN = re.compile(r"\bAS\s+(?=SELECT\b|WITH\b|\()", re.IGNORECASE)
+_DROP_TABLE_PATTERN = re.compile(r"^\s*DROP\s+TABLE\s+(?:IF\s+EXISTS\s+)?(`[^`]+`)", re.IGNORECASE)
+# A string literal, kept as is, an array query parameter in UNNEST(@name) or an @name query parameter
+_QUERY_PARAMETER_PATTERN = re.compile(
+    r"('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\")|\bUNNEST\s*\(\s*@(\w+)\s*\)|@(\w+)", re.IGNORECASE)
+
+
+def translate_bigquery_sql(query):
+    """
+    Translates the BigQuery-dialect constructs used by the checks into SQLite SQL.
+    Backtick-quoted table ids are kept as is: SQLite accepts backticks as identifier quotes,
+    so `project.dataset.table` resolves to a local table registered under exactly that name.
+    """
+    query = _SAFE_CAST_PATTERN.sub(lambda m: f"SAFE_CAST_{m.group(2).upper()}({m.group(1)})", query)
+    query = _STRING_AGG_PATTERN.sub("GROUP_CONCAT(", query)
+    query = _CURRENT_DATE_PATTERN.sub("DATE('now')", query)
+    query = _CAST_INT64_PATTERN.sub("AS INTEGER", query)
+    query = _CAST_STRING_PATTERN.sub("AS TEXT)", query)
+    # RAND() is uniform in [0, 1); SQLite's RANDOM() is a uniform signed 64-bit integer
+    query = _RAND_PATTERN.sub("((RANDOM() / 18446744073709551616.0) + 0.5)", query)
+    query = _translate_countif(query)
+    return query
+
+
+def _sql_literal(value):
+    """
+    Returns the SQLite literal of a query parameter value; dates are stored as ISO formatted text, and an array
+    becomes the parenthesized list of its elements, as IN UNNEST(@name) turns into IN (...).
+    """
+    if isinstance(value, (list, tuple)):
+        return f"({', '.join(_sql_literal(element) for element in value)})"
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, (date, datetime)):
+        value = value.isoformat()
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def bind_query_parameters(query, parameters):
+    """
+    Replaces the @name parameters of a query with the literals of their values. SQLite's own named parameters
+    would do for values, but the statement is translated and compiled as text, so the values are inlined.
+    """
+    values = {name: value for name, _, value in parameters}
+
+    def replace(match):
+        if match.group(1) is not None:
+            return match.group(1)
+        name = match.group(2) or match.group(3)
+        if name not in values:
+            raise ValueError(f"Query parameter @{name} has no value")
+        return _sql_literal(values[name])
+
+    return _QUERY_PARAMETER_PATTERN.sub(replace, query)
+
+
+def _translate_countif(query):
+    """
+    Rewrites COUNTIF(condition) into COUNT(CASE WHEN (condition) THEN 1 END), which like BigQuery returns 0 rather
+    than NULL when no rows are aggregated (a Python aggregate registered in SQLite returns NULL on empty input).
+    """
+    match = _COUNTIF_PATTERN.search(query)
+    while match:
+        # Find the parenthesis closing the COUNTIF call; the condition may contain nested calls
+        depth, position = 1, match.end()
+        while depth and position < len(query):
+            depth += {"(": 1, ")": -1}.get(query[position], 0)
+            position += 1
+        condition = query[match.end():position - 1]
+        replacement = f"COUNT(CASE WHEN ({condition}) THEN 1 END)"
+        query = query[:match.start()] + replacement + query[position:]
+        match = _COUNTIF_PATTERN.search(query, match.start() + len("COUNT("))
+    return query
+
+
+def _safe_cast_int64(value):
+    """SAFE_CAST(value AS INT64): returns NULL instead of failing on values that are not integers."""
+    if value is None:
+        return None
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return int(number) if number.is_integer() else None
+
+
+def _safe_cast_float64(value):
+    """SAFE_CAST(value AS FLOAT64)."""
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _safe_cast_string(value):
+    """SAFE_CAST(value AS STRING)."""
+    return str(value) if value is not None else None
+
+
+def _safe_cast_date(value):
+    """SAFE_CAST(value AS DATE): accepts only ISO formatted dates."""
+    try:
+        return date.fromisoformat(str(value)).isoformat() if value is not None else None
+    except ValueError:
+        return None
+
+
+def _farm_fingerprint(value):
+    """
+    FARM_FINGERPRINT(value) stand-in: a signed 64-bit hash of the value. It is not FarmHash, so rows land in other
+    hash shards than on BigQuery, but every run of the local backend assigns them the same way.
+    """
+    if value is None:
+        return None
+    return int.from_bytes(hashlib.blake2b(str(value).encode("utf-8"), digest_size=8).digest(), "big", signed=True)
+
+
+def _mod(dividend, divisor):
+    """MOD(X, Y) with BigQuery's integer result, which takes the sign of the dividend."""
+    if dividend is None or divisor is None:
+        return None
+    remainder = abs(dividend) % abs(divisor)
+    return -remainder if dividend < 0 else remainder
+
+
+class LocalRow:
+    """A result row mimicking google.cloud.bigquery.table.Row (attribute, key and index access)."""
+
+    __slots__ = ("_values", "_field_to_index")
+
+    def __init__(self, values, field_to_index):
+        self._values = tuple(values)
+        self._field_to_index = field_to_index
+
+    def values(self):
+        return self._values
+
+    def keys(self):
+        return self._field_to_index.keys()
+
+    def items(self):
+        for field, index in self._field_to_index.items():
+            yield field, self._values[index]
+
+    def get(self, key, default=None):
+        index = self._field_to_index.get(key)
+        return default if index is None else self._values[index]
+
+    def __getattr__(self, name):
+        index = self._field_to_index.get(name)
+        if index is None:
+            raise AttributeError(f"no row field {name!r}")
+        return self._values[index]
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            index = self._field_to_index.get(key)
+            if index is None:
+                raise KeyError(f"no row field {key!r}")
+            key = index
+        return self._values[key]
+
+    def __len__(self):
+        return len(self._values)
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __eq__(self, other):
+        if not isinstance(other, LocalRow):
+            return NotImplemented
+        return self._values == other._values and self._field_to_index == other._field_to_index
+
+    def __repr__(self):
+        return f"Row({self._values}, {self._field_to_index})"
+
+
+class LocalRowIterator:
+    """
+    Iterable result of a local query, exposing the parts of RowIterator used by the helpers.
+    Rows are fetched from the SQLite cursor one page at a time.
+    """
+
+    def __init__(self, cursor, lock, page_size=DEFAULT_PAGE_SIZE):
+        self._cursor = cursor
+        self._lock = lock
+        self.page_size = page_size
+        self.field_names = [column[0] for column in cursor.description or ()]
+        self._field_to_index = {name: index for index, name in enumerate(self.field_names)}
+
+    @property
+    def pages(self):
+        """Yields the result rows in pages of page_size rows."""
+        while True:
+            with self._lock:
+                values = self._cursor.fetchmany(self.page_size) if self._cursor.description else []
+            if not values:
+                return
+            yield [LocalRow(row, self._field_to_index) for row in values]
+
+    def __iter__(self):
+        for page in self.pages:
+            yield from page
+
+    def to_arrow(self, create_bqstorage_client=True):
+        """
+        Returns the remaining rows as a pyarrow Table. SQLite has no columnar output, so each page is transposed
+        into column arrays directly, without creating a row object per row.
+        """
+        import pyarrow
+
+        pages = []
+        while True:
+            with self._lock:
+                values = self._cursor.fetchmany(self.page_size) if self._cursor.description else []
+            if not values:
+                break
+            pages.append(pyarrow.table([pyarrow.array(column) for column in zip(*values)], names=self.field_names))
+        if not pages:
+            return pyarrow.table({name: pyarrow.array([], type=pyarrow.null()) for name in self.field_names})
+        # A column inferred differently between pages (e.g. all NULL on one page) gets the wider type
+        return pyarrow.concat_tables(pages, promote_options="permissive")
+
+
+class LocalQueryJobConfig:
+    """Options of a local query, mirroring the QueryJobConfig attributes the local backend honours."""
+
+    def __init__(self, dry_run=False, use_query_cache=True, query_parameters=()):
+        self.dry_run = dry_run  # Only compile the query against the local tables, without running it
+        self.use_query_cache = use_query_cache  # Accepted for compatibility; local queries are never cached
+        self.query_parameters = tuple(query_parameters)  # (name, type, value) of each @name parameter
+
+
+class LocalQueryJob:
+    """A completed local query exposing the QueryJob interface used by the helpers."""
+
+    def __init__(self, query, cursor, lock, started=None, dry_run=False):
+        self.job_id = f"local_{uuid.uuid4().hex}"
+        self.query = query
+        self.state = "DONE"
+        self.dry_run = dry_run
+        # Local queries are not queued; bytes processed and slot time are not reported
+        self.total_bytes_processed = None
+        self.created = self.started = started
+        self.ended = datetime.now(timezone.utc)
+        self._cursor = cursor
+        self._lock = lock
+
+    def done(self):
+        return True
+
+    def cancel(self):
+        """Local queries run to completion when submitted, so there is nothing left to cancel."""
+        return False
+
+    def result(self, timeout=None, page_size=None):
+        if self.dry_run:
+            raise RuntimeError("A dry-run job has no results")
+        return LocalRowIterator(self._cursor, self._lock, page_size=page_size or DEFAULT_PAGE_SIZE)
+
+    def to_arrow(self, create_bqstorage_client=True):
+        return self.result().to_arrow()
+
+
+class LocalTable:
+    """Metadata of a local table or view, exposing the Table attributes used by the helpers."""
+
+    def __init__(self, table_id, table_type, num_rows=None, modified=None, view_query=None):
+        self.full_table_id = table_id
+        self.table_id = table_id.split('.')[-1]
+        self.table_type = table_type
+        self.num_rows = num_rows
+        self.modified = modified
+        self.view_query = view_query
+
+
+class LocalBigQueryClient:
+    """
+    In-process stand-in for google.cloud.bigquery.Client backed by an in-memory SQLite database.
+    Tables are created from the schemas declared in src/definitions.py, filled from data/*.json,
+    and v_agg_data is created from the statement declared there.
+    """
+
+    def __init__(self, project, dataset_id, data_dir=None):
+        self.project = project
+        self.dataset_id = dataset_id
+        self.data_dir = data_dir or DEFAULT_DATA_DIR
+        self._lock = threading.Lock()
+        self._tables = {}  # full table id -> LocalTable
+        self._connection = sqlite3.connect(":memory:", check_same_thread=False)
+        self._register_functions()
+        self._load_tables()
+        self._create_views()
+        # Tables any backend loading the same data directory has, unlike the tables created later in the session
+        self.loaded_tables = frozenset(self._tables)
+
+    def _register_functions(self):
+        """Registers SQLite implementations of the BigQuery functions that have no native equivalent."""
+        self._connection.create_function("SAFE_CAST_INT64", 1, _safe_cast_int64, deterministic=True)
+        self._connection.create_function("SAFE_CAST_FLOAT64", 1, _safe_cast_float64, deterministic=True)
+        self._connection.create_function("SAFE_CAST_STRING", 1, _safe_cast_string, deterministic=True)
+        self._connection.create_function("SAFE_CAST_DATE", 1, _safe_cast_date, deterministic=True)
+        self._connection.create_function("FARM_FINGERPRINT", 1, _farm_fingerprint, deterministic=True)
+        self._connection.create_function("MOD", 2, _mod, deterministic=True)
+
+    def _load_tables(self):
+        """Creates every table declared in src/definitions.py and loads its JSON source."""
+        from src.definitions import json_files_schemas, iter_json_records
+
+        for json_file, (table_name, schema) in json_files_schemas.items():
+            table_id = f"{self.project}.{self.dataset_id}.{table_name}"
+            columns = ", ".join(f"`{field.name}` {SQLITE_TYPES.get(field.field_type, 'TEXT')}" for field in schema)
+            self._connection.execute(f"CREATE TABLE `{table_id}` ({columns})")
+
+            # The source is streamed record by record, so large files are not loaded into memory at once
+            json_filepath = os.path.join(self.data_dir, json_file)
+            field_names = [field.name for field in schema]
+            placeholders = ", ".join("?" for _ in field_names)
+            self._connection.executemany(
+                f"INSERT INTO `{table_id}` VALUES ({placeholders})",
+                ([record.get(name) for name in field_names] for record in iter_json_records(json_filepath)),
+            )
+            num_rows = self._connection.execute(f"SELECT COUNT(*) FROM `{table_id}`").fetchone()[0]
+            # The source file's modification time plays the role of the table's last_modified timestamp
+            modified = datetime.fromtimestamp(os.path.getmtime(json_filepath), tz=timezone.utc)
+            self._tables[table_id] = LocalTable(table_id, "TABLE", num_rows=num_rows, modified=modified)
+        self._connection.commit()
+
+    def _create_views(self):
+        """Creates v_agg_data from the same statement that is deployed to BigQuery."""
+        from src.definitions import build_view_query
+
+        self.query(build_view_query(self.project, self.dataset_id)).result()
+
+    def query(self, query, job_config=None):
+        """
+        Runs a BigQuery-dialect query and returns a completed job. With a dry-run job_config the query is only
+        compiled by SQLite, which raises for syntax errors and missing tables or columns like a BigQuery dry run.
+        The @name parameters of the job_config are bound into the query first.
+        """
+        if job_config is not None and job_config.query_parameters:
+            query = bind_query_parameters(query, job_config.query_parameters)
+        if job_config is not None and job_config.dry_run:
+            with self._lock:
+                self._connection.execute(f"EXPLAIN {translate_bigquery_sql(query)}")
+            return LocalQueryJob(query, None, self._lock, started=datetime.now(timezone.utc), dry_run=True)
+
+        view_match = _CREATE_OR_REPLACE_VIEW_PATTERN.match(query)
+        create_match = _CREATE_TABLE_PATTERN.match(query)
+        drop_match = _DROP_TABLE_PATTERN.match(query)
+        started = datetime.now(timezone.utc)
+        with self._lock:
+            if view_match:
+                statement = translate_bigquery_sql(query[view_match.end():]).strip().rstrip(';')
+                self._connection.execute(f"DROP VIEW IF EXISTS {view_match.group(1)}")
+                cursor = self._connection.execute(f"CREATE VIEW {view_match.group(1)} {statement}")
+                view_id = view_match.group(1).strip('`')
+                self._tables[view_id] = LocalTable(view_id, "VIEW", modified=datetime.now(timezone.utc),
+                                                   view_query=query[view_match.end():].strip().removeprefix('AS').strip())
+            elif create_match:
+                # Table options such as the expiration are BigQuery-only and dropped
+                select = query[_CREATE_TABLE_AS_PATTERN.search(query, create_match.end()).end():]
+                cursor = self._connection.execute(
+                    f"CREATE TABLE {create_match.group(1)} AS {translate_bigquery_sql(select).strip().rstrip(';')}")
+                table_id = create_match.group(1).strip('`')
+                num_rows = self._connection.execute(f"SELECT COUNT(*) FROM {create_match.group(1)}").fetchone()[0]
+                self._tables[table_id] = LocalTable(table_id, "TABLE", num_rows=num_rows,
+                                                    modified=datetime.now(timezone.utc))
+            elif drop_match:
+                cursor = self._connection.execute(query)
+                self._tables.pop(drop_match.group(1).strip('`'), None)
+            else:
+                cursor = self._connection.execute(translate_bigquery_sql(query))
+        return LocalQueryJob(query, cursor, self._lock, started=started)
+
+    def get_table(self, table):
+        """Returns the metadata of a local table or view given its full id."""
+        table_id = str(table)
+        if table_id not in self._tables:
+            raise KeyError(f"Not found: Table {table_id}")
+        return self._tables[table_id]
+
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,106 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from test_helpers import distributed
+
+
+# Maximum number of check queries running at the same time while prefetching
+DEFAULT_MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT_QUERIES", "8"))
+
+# Prefetcher whose results execute_query_and_log hands out, set for the duration of a test session
+_active_prefetcher = None
+
+
+def check_query(builder):
+    """
+    Marks a test with the function building its check query from an Environment,
+    so the query can be discovered at collection time and submitted before the test runs.
+    """
+    return pytest.mark.check_query.with_args(builder)
+
+
+def collect_check_queries(items, env):
+    """
+    Returns the distinct check queries of the collected test items, in collection order.
+    A builder returns None when its test runs no query that can be submitted ahead in this session.
+    """
+    queries = []
+    for item in items:
+        for marker in item.iter_markers("check_query"):
+            query = marker.args[0](env)
+            if query is not None and query not in queries:
+                queries.append(query)
+    return queries
+
+
+class QueryPrefetcher:
+    """
+    Submits check queries concurrently on a thread pool with at most max_in_flight queries running at once.
+    Each test then waits only for its own result, so the total wall time approaches the slowest query
+    rather than the sum of all of them.
+    """
+
+    def __init__(self, bq_client, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        self.bq_client = bq_client
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="check-prefetch")
+        self._futures = {}  # query text -> Future of the query's (QueryJob, RowIterator)
+        self._lock = threading.Lock()
+
+    def _run(self, query):
+        """
+        Runs one query to completion and returns its job, for the cost statistics, and its RowIterator.
+        Under pytest-xdist the job is None when another worker already ran the query, and the rows are a list.
+        """
+        return distributed.run_query(self.bq_client, query)
+
+    def submit(self, queries):
+        """Submits the queries that have not been submitted yet."""
+        with self._lock:
+            for query in queries:
+                if query not in self._futures:
+                    self._futures[query] = self._executor.submit(self._run, query)
+
+    def take(self, query):
+        """Removes and returns the future of a prefetched query, or None if the query was not prefetched."""
+        with self._lock:
+            return self._futures.pop(query, None)
+
+    def cancel(self, queries):
+        """Drops the prefetched results of queries no check will read; those that have not started never run."""
+        with self._lock:
+            for query in queries:
+                future = self._futures.pop(query, None)
+                if future is not None:
+                    future.cancel()
+
+    def shutdown(self):
+        """Cancels the queries that have not started and waits for the running ones."""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+def activate(prefetcher):
+    """Makes execute_query_and_log use the results of the prefetcher."""
+    global _active_prefetcher
+    _active_prefetcher = prefetcher
+
+
+def deactivate():
+    """Stops handing out prefetched results and shuts the active prefetcher down."""
+    global _active_prefetcher
+    prefetcher, _active_prefetcher = _active_prefetcher, None
+    if prefetcher is not None:
+        prefetcher.shutdown()
+
+
+def cancel_prefetched(queries):
+    """Drops the prefetched results of the queries from the active prefetcher, if any."""
+    prefetcher = _active_prefetcher
+    if prefetcher is not None:
+        prefetcher.cancel(queries)
+
+
+def take_prefetched(query):
+    """Returns the future of the query if the active prefetcher submitted it, otherwise None."""
+    prefetcher = _active_prefetcher
+    return prefetcher.take(query) if prefetcher is not None else None
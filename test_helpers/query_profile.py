@@ -0,0 +1,222 @@
+import os
+import json
+import threading
+import pytest
+from test_helpers.result_cache import referenced_tables
+
+
+# Bytes the queries of a check may process before it fails, unless the check declares its own budget; None for no limit
+DEFAULT_MAX_BYTES_PER_CHECK = int(os.getenv("CHECK_MAX_BYTES")) if os.getenv("CHECK_MAX_BYTES") else None
+# Number of most expensive checks listed at the top of the run profile
+DEFAULT_TOP_CHECKS = int(os.getenv("QUERY_PROFILE_TOP_CHECKS", "10"))
+
+# Profile the query costs of the current session are recorded in, None when profiling is off
+_active_profile = None
+# Check (test node id) running in the current thread and the stats of its last query
+_current_check = threading.local()
+
+
+def byte_budget(max_bytes):
+    """Marks a test whose queries may process at most max_bytes; the test fails once they process more."""
+    return pytest.mark.byte_budget.with_args(max_bytes)
+
+
+class ByteBudgetExceeded(AssertionError):
+    """Raised when the queries of a check processed more bytes than its budget."""
+
+
+def _milliseconds(start, end):
+    return round((end - start).total_seconds() * 1000) if start is not None and end is not None else None
+
+
+class QueryStats:
+    """Cost and latency of one check query, as reported by its QueryJob."""
+
+    def __init__(self, query, job=None, wall_ms=None, result_cache_hit=False):
+        self.tables = referenced_tables(query)
+        self.template = getattr(query, "template", None)  # Name of the query template the query was rendered from
+        self.shared = False  # Attributed to a check reusing the result of a query another check ran
+        self.wall_ms = wall_ms  # Time the check waited for the result, including the wait on a prefetched query
+        self.result_cache_hit = result_cache_hit  # Replayed from the check result cache, no job ran
+        self.job_id = getattr(job, "job_id", None)
+        self.bytes_processed = getattr(job, "total_bytes_processed", None)
+        self.bytes_billed = getattr(job, "total_bytes_billed", None)
+        self.slot_millis = getattr(job, "slot_millis", None)
+        self.cache_hit = getattr(job, "cache_hit", None)  # Served from the BigQuery query cache
+        created, started, ended = (getattr(job, name, None) for name in ("created", "started", "ended"))
+        self.queue_ms = _milliseconds(created, started)
+        self.execution_ms = _milliseconds(started, ended)
+        self.stages = [{
+            "name": stage.name,
+            "records_read": stage.records_read,
+            "records_written": stage.records_written,
+            "slot_ms": stage.slot_ms,
+            "wait_ms_avg": stage.wait_ms_avg,
+            "compute_ms_avg": stage.compute_ms_avg,
+            "shuffle_output_bytes": stage.shuffle_output_bytes,
+        } for stage in getattr(job, "query_plan", None) or []]
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    def shared_copy(self):
+        """Returns the stats attributed once more to another check reading the same result."""
+        stats = object.__new__(QueryStats)
+        stats.__dict__.update(vars(self), shared=True)
+        return stats
+
+
+def cache_hit_rate(queries):
+    """Share of the jobs of the queries served from the BigQuery query cache, None if no job reported it."""
+    jobs = [stats for stats in queries if stats.cache_hit is not None]
+    return sum(1 for stats in jobs if stats.cache_hit) / len(jobs) if jobs else None
+
+
+class CheckProfile:
+    """Queries run by one check and the budget they are held to."""
+
+    def __init__(self, check, max_bytes=None):
+        self.check = check
+        self.max_bytes = max_bytes
+        self.queries = []
+
+    @staticmethod
+    def _total(queries, attribute):
+        return sum(getattr(stats, attribute) or 0 for stats in queries)
+
+    @property
+    def bytes_processed(self):
+        return self._total(self.queries, "bytes_processed")
+
+    def budget_error(self):
+        """Returns the error failing the check if its queries processed more bytes than its budget, else None."""
+        if self.max_bytes is not None and self.bytes_processed > self.max_bytes:
+            return ByteBudgetExceeded(f"The queries of {self.check} processed {self.bytes_processed} bytes, "
+                                      f"over its budget of {self.max_bytes} bytes")
+        return None
+
+    def summary(self):
+        return {
+            "check": self.check,
+            "queries": len(self.queries),
+            "bytes_processed": self.bytes_processed,
+            "bytes_billed": self._total(self.queries, "bytes_billed"),
+            "slot_millis": self._total(self.queries, "slot_millis"),
+            "wall_ms": self._total(self.queries, "wall_ms"),
+            "max_bytes": self.max_bytes,
+        }
+
+
+class QueryProfile:
+    """
+    Collects the QueryStats of every check query of a session per check, and aggregates them into a run profile:
+    totals, the most expensive checks by bytes processed, totals per table read, and every query with its plan stages.
+    """
+
+    def __init__(self, top_checks=DEFAULT_TOP_CHECKS):
+        self.top_checks = top_checks
+        self._checks = {}  # check -> CheckProfile
+        self._lock = threading.Lock()
+
+    def check(self, check, max_bytes=None):
+        """Returns the profile of a check, created on first use."""
+        with self._lock:
+            if check not in self._checks:
+                self._checks[check] = CheckProfile(check, max_bytes)
+            return self._checks[check]
+
+    def record(self, check, stats):
+        self.check(check).queries.append(stats)
+
+    def to_dict(self):
+        checks = sorted(self._checks.values(), key=lambda profile: profile.bytes_processed, reverse=True)
+        # Shared results count towards every check reading them, but only once towards the totals
+        queries = [stats for profile in checks for stats in profile.queries if not stats.shared]
+        tables = {}
+        for stats in queries:
+            # A query reading several tables counts in full towards each of them
+            for table_id in stats.tables:
+                totals = tables.setdefault(table_id, {"queries": 0, "bytes_processed": 0, "slot_millis": 0})
+                totals["queries"] += 1
+                totals["bytes_processed"] += stats.bytes_processed or 0
+                totals["slot_millis"] += stats.slot_millis or 0
+        by_template = {}
+        for stats in queries:
+            if stats.template is not None:
+                by_template.setdefault(stats.template, []).append(stats)
+        return {
+            "totals": {
+                "checks": len(checks),
+                "queries": len(queries),
+                "bytes_processed": CheckProfile._total(queries, "bytes_processed"),
+                "bytes_billed": CheckProfile._total(queries, "bytes_billed"),
+                "slot_millis": CheckProfile._total(queries, "slot_millis"),
+                "bigquery_cache_hits": sum(1 for stats in queries if stats.cache_hit),
+                "result_cache_hits": sum(1 for stats in queries if stats.result_cache_hit),
+                "bigquery_cache_hit_rate": cache_hit_rate(queries),
+            },
+            "templates": {name: {
+                "queries": len(runs),
+                "bigquery_cache_hits": sum(1 for stats in runs if stats.cache_hit),
+                "bigquery_cache_hit_rate": cache_hit_rate(runs),
+            } for name, runs in sorted(by_template.items())},
+            "top_checks": [profile.summary() for profile in checks[:self.top_checks]],
+            "tables": dict(sorted(tables.items(), key=lambda item: item[1]["bytes_processed"], reverse=True)),
+            "checks": [dict(profile.summary(), queries=[stats.to_dict() for stats in profile.queries])
+                       for profile in checks],
+        }
+
+    def write(self, path):
+        """Writes the run profile as JSON."""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as file:
+            json.dump(self.to_dict(), file, indent=4)
+
+
+def activate(profile):
+    """Makes execute_query_and_log record the cost of every query in the profile."""
+    global _active_profile
+    _active_profile = profile
+
+
+def deactivate():
+    global _active_profile
+    _active_profile = None
+
+
+def active_profile():
+    """Returns the profile of the current session, or None if profiling is off."""
+    return _active_profile
+
+
+def start_check(check, max_bytes=None):
+    """Attributes the queries run by the current thread to check until finish_check."""
+    _current_check.check = check
+    _current_check.last_stats = None
+    if _active_profile is not None:
+        _active_profile.check(check, max_bytes)
+
+
+def finish_check():
+    """Stops attributing queries to the current check and returns its profile."""
+    check, _current_check.check = getattr(_current_check, "check", None), None
+    return _active_profile.check(check) if _active_profile is not None and check is not None else None
+
+
+def record(stats):
+    """Records the stats of a query under the running check."""
+    _current_check.last_stats = stats
+    check = getattr(_current_check, "check", None)
+    if _active_profile is not None and check is not None:
+        _active_profile.record(check, stats)
+
+
+def record_shared(stats):
+    """Records the stats of a query whose result another check already paid for under the running check."""
+    if stats is not None:
+        record(stats.shared_copy())
+
+
+def last_stats():
+    """Returns the stats of the last query recorded by the current thread."""
+    return getattr(_current_check, "last_stats", None)
@@ -0,0 +1,190 @@
+import os
+import re
+import json
+import time
+import pickle
+import sqlite3
+import hashlib
+import threading
+from datetime import date
+from test_helpers import templates
+from test_helpers.local_backend import LocalRow
+
+
+# Location and eviction limits of the on-disk cache of check results
+DEFAULT_CACHE_PATH = os.getenv("CHECK_CACHE_PATH",
+                               os.path.join(os.path.dirname(__file__), '..', '.check_cache', 'results.sqlite'))
+DEFAULT_MAX_AGE_SECONDS = int(os.getenv("CHECK_CACHE_MAX_AGE_HOURS", "168")) * 3600
+DEFAULT_MAX_BYTES = int(os.getenv("CHECK_CACHE_MAX_MB", "256")) * 1024 * 1024
+
+# Fully qualified table ids as written in the checks: `project.dataset.table`
+_TABLE_ID_PATTERN = re.compile(r"`([\w-]+\.\w+\.\w+)`")
+# Comments and string literals, matched together so that '--' inside a string is not taken for a comment
+_COMMENT_OR_STRING_PATTERN = re.compile(r"('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\")|--[^\n]*|/\*.*?\*/", re.DOTALL)
+# Queries whose result depends on the moment they run are never cached
+_VOLATILE_PATTERN = re.compile(r"\b(CURRENT_TIMESTAMP|CURRENT_DATETIME|CURRENT_TIME|RAND|GENERATE_UUID|SESSION_USER)\s*\(",
+                               re.IGNORECASE)
+_CURRENT_DATE_PATTERN = re.compile(r"\bCURRENT_DATE\s*\(", re.IGNORECASE)
+
+# Cache whose results execute_query_and_log replays, set for the duration of a test session
+_active_cache = None
+
+
+def normalize_sql(query):
+    """Removes comments and collapses whitespace so formatting changes do not change the cache key."""
+    without_comments = _COMMENT_OR_STRING_PATTERN.sub(lambda m: m.group(1) or " ", query)
+    return " ".join(without_comments.split()).rstrip(";")
+
+
+def referenced_tables(query):
+    """Returns the fully qualified table ids referenced by the query."""
+    return sorted(set(_TABLE_ID_PATTERN.findall(query)))
+
+
+class CheckResultCache:
+    """
+    On-disk cache of check results keyed by the normalized SQL text and the version of every table the query reads:
+    last_modified and row count of base tables, and for views the view definition plus the versions of the tables
+    behind it. Entries older than max_age_seconds are dropped, and the least recently used entries are evicted once
+    the cache grows beyond max_bytes.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_age_seconds=DEFAULT_MAX_AGE_SECONDS, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_age_seconds = max_age_seconds
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._table_versions = {}  # full table id -> version, looked up once per session
+        self._aliases = {}  # snapshot table id -> id of the view it materializes
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # The workers of a pytest-xdist session share the file, so writers wait for each other's transactions
+        self._connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                payload BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        self._connection.commit()
+
+    def _table_version(self, bq_client, table_id):
+        """Returns the version of a table, expanding views into the versions of the tables they read."""
+        if table_id not in self._table_versions:
+            table = bq_client.get_table(table_id)
+            if table.table_type == "VIEW":
+                version = {
+                    "view_query": normalize_sql(table.view_query),
+                    "tables": {ref: self._table_version(bq_client, ref)
+                               for ref in referenced_tables(table.view_query) if ref != table_id},
+                }
+            else:
+                version = {
+                    "modified": table.modified.isoformat() if table.modified else None,
+                    "num_rows": table.num_rows,
+                }
+            self._table_versions[table_id] = version
+        return self._table_versions[table_id]
+
+    def alias(self, snapshot_id, source_id):
+        """
+        Keys queries on a session table standing for another table, such as a snapshot of a view or an intermediate
+        computed from it, as if they read that table, so their results are shared with the runs of earlier sessions.
+        """
+        self._aliases[snapshot_id] = source_id
+
+    def key_for(self, bq_client, query):
+        """Returns the cache key of the query, or None if its result cannot be cached."""
+        parameters = templates.parameters_of(query)
+        for snapshot_id, source_id in self._aliases.items():
+            query = query.replace(f"`{snapshot_id}`", f"`{source_id}`")
+        normalized = normalize_sql(query)
+        if _VOLATILE_PATTERN.search(normalized):
+            return None
+
+        with self._lock:
+            tables = {table_id: self._table_version(bq_client, table_id) for table_id in referenced_tables(query)}
+        key_data = {"sql": normalized, "tables": tables}
+        if parameters:
+            key_data["parameters"] = [[name, type_, str(value)] for name, type_, value in parameters]
+        if _CURRENT_DATE_PATTERN.search(normalized):
+            # CURRENT_DATE() results stay valid for the rest of the day
+            key_data["current_date"] = date.today().isoformat()
+        return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Returns the cached rows for the key, or None on a miss."""
+        now = time.time()
+        with self._lock:
+            entry = self._connection.execute(
+                "SELECT payload, created_at FROM results WHERE key = ?", (key,)).fetchone()
+            if entry is None or now - entry[1] > self.max_age_seconds:
+                self.misses += 1
+                return None
+            self._connection.execute("UPDATE results SET accessed_at = ? WHERE key = ?", (now, key))
+            self._connection.commit()
+            self.hits += 1
+
+        field_names, values = pickle.loads(entry[0])
+        field_to_index = {name: index for index, name in enumerate(field_names)}
+        return [LocalRow(row, field_to_index) for row in values]
+
+    def put(self, key, rows):
+        """Stores the rows of a query result under the key and applies the eviction limits."""
+        field_names = list(rows[0].keys()) if rows else []
+        payload = pickle.dumps((field_names, [tuple(row.values()) for row in rows]), protocol=pickle.HIGHEST_PROTOCOL)
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO results (key, payload, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, payload, len(payload), now, now))
+            self._evict(now)
+            self._connection.commit()
+
+    def _evict(self, now):
+        """Drops expired entries, then the least recently used ones until the cache fits in max_bytes."""
+        self._connection.execute("DELETE FROM results WHERE created_at < ?", (now - self.max_age_seconds,))
+        total_size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total_size <= self.max_bytes:
+            return
+        for key, size in self._connection.execute(
+                "SELECT key, size FROM results ORDER BY accessed_at").fetchall():
+            self._connection.execute("DELETE FROM results WHERE key = ?", (key,))
+            total_size -= size
+            if total_size <= self.max_bytes:
+                break
+
+    def contains(self, bq_client, query):
+        """Checks whether a fresh result is cached for the query, without counting a hit or a miss."""
+        key = self.key_for(bq_client, query)
+        if key is None:
+            return False
+        with self._lock:
+            entry = self._connection.execute("SELECT created_at FROM results WHERE key = ?", (key,)).fetchone()
+        return entry is not None and time.time() - entry[0] <= self.max_age_seconds
+
+    def close(self):
+        self._connection.close()
+
+
+def activate(cache):
+    """Makes execute_query_and_log replay and store results through the cache."""
+    global _active_cache
+    _active_cache = cache
+
+
+def deactivate():
+    """Stops using the active cache and closes it."""
+    global _active_cache
+    cache, _active_cache = _active_cache, None
+    if cache is not None:
+        cache.close()
+
+
+def active_cache():
+    """Returns the cache of the current session, or None if caching is disabled."""
+    return _active_cache
@@ -0,0 +1,474 @@
+import json
+import threading
+import allure
+import pytest
+from src import rule_specs
+from test_helpers import (incremental, intermediates, key_counts, query_profile, sampling, sharding, templates,
+                          violations)
+from test_helpers.helpers import execute_query_and_log
+from test_helpers.incremental import incremental_check
+from test_helpers.prefetch import check_query
+from test_helpers.query_profile import byte_budget
+from test_helpers.scheduling import check_severity, check_timeout
+
+
+# Allure severity levels by their name in the rule files
+SEVERITIES = {level.value: level for level in allure.severity_level}
+
+
+def compiled_query(env, prefix, sql, rules):
+    """
+    Registers SQL compiled from rules as a query template, with {table} placeholders for the tables it reads, and
+    renders it with the bounds and incremental window bounds of the rules as query parameters.
+    """
+    parameters = {name: value for rule in rules for name, value in rule.query_parameters(env).items()}
+    return templates.register_compiled(prefix, sql).render(env, **parameters)
+
+
+class Rule(rule_specs.RuleSpec):
+    """
+    A declarative rule compiled for a test session. Every rule compiles to a count expression evaluated in the shared
+    scan of its table; its spec, bounds and summary are those of src/rule_specs.py.
+    """
+
+    def __init__(self, spec, story=None, source=None):
+        super().__init__(spec, story=story, source=source)
+        self.severity = SEVERITIES[self.severity_name]
+
+    def window(self, env):
+        """The rows of its table the rule evaluates in this session: its incremental window, or all of them."""
+        return incremental.window(env, self.table, self.name) if self.incremental else incremental.FULL_WINDOW
+
+    def query_parameters(self, env):
+        """Query parameters of the rule's bounds and of its incremental window by name."""
+        return {**self.parameters(), **self.window(env).parameters()}
+
+    def row_filter(self, env):
+        """Predicate selecting the rows the rule is evaluated on: its where filter and its incremental window."""
+        return f"({self.where or 'TRUE'}) AND {self.window(env).predicate}"
+
+    def window_predicate(self, env):
+        """The rule's incremental window predicate, or None when the rule needs every row of the table."""
+        window = self.window(env)
+        return None if window.full else window.predicate
+
+    def joins(self, env):
+        """LEFT JOIN clauses the rule adds to the shared scan of its table."""
+        return []
+
+    def window_columns(self, env):
+        """Analytic columns the rule adds to the rows of its table before they are scanned."""
+        return []
+
+    def counted_predicate(self, env):
+        """Predicate selecting the rows the rule counts."""
+        raise NotImplementedError
+
+    def count_expression(self, env):
+        return f"COUNTIF({self.counted_predicate(env)})"
+
+    def compiled_columns(self, env):
+        """Columns the rule adds to the compiled query of its table."""
+        return [f"{self.count_expression(env)} AS {self.name}"]
+
+    @property
+    def rows_column(self):
+        return f"{self.name}_rows"
+
+    @property
+    def confidence(self):
+        return (self.sample or {}).get("confidence", sampling.DEFAULT_CONFIDENCE)
+
+    def violations_query(self, env, shard_predicate="TRUE"):
+        """Query selecting every offending row (of one shard), summarized server-side only when the rule fails."""
+        return None
+
+    def apply_allure_metadata(self):
+        """Sets the Allure title, story, severity and description of the running test from the rule."""
+        allure.dynamic.title(self.name)
+        allure.dynamic.severity(self.severity)
+        if self.story:
+            allure.dynamic.story(self.story)
+        if self.description:
+            allure.dynamic.description(self.description)
+
+
+class ScalarRule(Rule, rule_specs.ScalarRuleSpec):
+    def counted_predicate(self, env):
+        return f"{self.row_filter(env)} AND ({self.failing_predicate()})"
+
+    def violations_query(self, env, shard_predicate="TRUE"):
+        return compiled_query(env, f"{self.name}_violations", f"""
+        SELECT *
+        FROM {{{self.table}}}
+        WHERE {self.row_filter(env)} AND ({self.failing_predicate()}) AND ({shard_predicate})
+        """, [self])
+
+
+class NotNullRule(ScalarRule, rule_specs.NotNullRuleSpec):
+    pass
+
+
+class PositiveRule(ScalarRule, rule_specs.PositiveRuleSpec):
+    pass
+
+
+class RangeRule(ScalarRule, rule_specs.RangeRuleSpec):
+    pass
+
+
+class AcceptedValuesRule(ScalarRule, rule_specs.AcceptedValuesRuleSpec):
+    pass
+
+
+class RejectedValuesRule(ScalarRule, rule_specs.RejectedValuesRuleSpec):
+    pass
+
+
+class RowCountRule(Rule, rule_specs.RowCountRuleSpec):
+    def counted_predicate(self, env):
+        return self.row_filter(env)
+
+
+class UniqueRule(Rule, rule_specs.UniqueRuleSpec):
+    @property
+    def _group_size_column(self):
+        return f"{self.name}_group_size"
+
+    def window_columns(self, env):
+        keys = ", ".join(self.spec["keys"])
+        return [f"COUNTIF({self.row_filter(env)}) OVER (PARTITION BY {keys}) AS {self._group_size_column}"]
+
+    def counted_predicate(self, env):
+        return f"{self.row_filter(env)} AND {self._group_size_column} > 1"
+
+    def violations_query(self, env, shard_predicate="TRUE"):
+        keys = ", ".join(self.spec["keys"])
+        return compiled_query(env, f"{self.name}_violations", f"""
+        SELECT {keys}, COUNT(*) AS cnt
+        FROM {{{self.table}}}
+        WHERE {self.row_filter(env)} AND ({shard_predicate})
+        GROUP BY {keys}
+        HAVING COUNT(*) > 1
+        """, [self])
+
+
+class ForeignKeyRule(Rule, rule_specs.ForeignKeyRuleSpec):
+    def _key(self, column):
+        return f"UPPER({column})" if self.spec.get("case_insensitive") else column
+
+    def _parent_join(self, env, child_alias):
+        alias = f"{self.name}_parent"
+        keys = [f"{alias}_key{index}" for index in range(len(self.parent_columns))]
+        parent_keys = ", ".join(f"{self._key(column)} AS {key}" for column, key in zip(self.parent_columns, keys))
+        condition = " AND ".join(f"{self._key(f'{child_alias}.{column}')} = {alias}.{key}"
+                                 for column, key in zip(self.columns, keys))
+        # DISTINCT keeps the join from multiplying the rows of the scanned table
+        join = f"LEFT JOIN (SELECT DISTINCT {parent_keys} FROM {{{self.parent_table}}}) AS {alias} ON {condition}"
+        return join, f"{alias}.{keys[0]} IS NULL"
+
+    def _failing_predicate(self, env, child_alias):
+        _, missing = self._parent_join(env, child_alias)
+        if self.spec.get("allow_null", True):
+            not_null = " AND ".join(f"{child_alias}.{column} IS NOT NULL" for column in self.columns)
+            return f"{not_null} AND {missing}"
+        return missing
+
+    def joins(self, env):
+        return [self._parent_join(env, "t")[0]]
+
+    def counted_predicate(self, env):
+        return f"{self.row_filter(env)} AND {self._failing_predicate(env, 't')}"
+
+    def violations_query(self, env, shard_predicate="TRUE"):
+        # Only the rows of the checked table are sharded; every shard is joined with the whole referenced table
+        return compiled_query(env, f"{self.name}_violations", f"""
+        SELECT t.*
+        FROM {{{self.table}}} AS t
+        {self._parent_join(env, 't')[0]}
+        WHERE {self.row_filter(env)} AND {self._failing_predicate(env, 't')} AND ({shard_predicate})
+        """, [self])
+
+
+# Rule classes by the type used in the rule files
+RULE_TYPES = {rule_class.type: rule_class for rule_class in
+              (NotNullRule, PositiveRule, RangeRule, AcceptedValuesRule, RejectedValuesRule, RowCountRule,
+               UniqueRule, ForeignKeyRule)}
+
+
+class TablePlan:
+    """All rules of one table compiled into a single query: one COUNTIF column per rule over one scan."""
+
+    def __init__(self, table, rules):
+        self.table = table
+        self.rules = rules
+
+    def shard_column(self):
+        """
+        Returns the column the plan's scan can be split by in sharding mode: the shard_by its rules declare, if they
+        agree and every rule's count over the table is the sum of its counts over the shards. None otherwise.
+        """
+        columns = {rule.shard_by for rule in self.rules if rule.shard_by}
+        if len(columns) != 1:
+            return None
+        column = columns.pop()
+        return column if all(rule.shardable(column) for rule in self.rules) else None
+
+    def build_query(self, env, shard_predicate=None):
+        window_columns = [column for rule in self.rules for column in rule.window_columns(env)]
+        joins = [join for rule in self.rules for join in rule.joins(env)]
+        columns = ",\n            ".join(column for rule in self.rules for column in rule.compiled_columns(env))
+
+        # Rules with analytic columns (uniqueness) read the table through a subquery adding those columns;
+        # a shard is selected inside it, since the partitions of the analytic columns never span two shards
+        source = f"{{{self.table}}}"
+        if window_columns:
+            shard_filter = f" WHERE {shard_predicate}" if shard_predicate else ""
+            source = f"(SELECT *, {', '.join(window_columns)} FROM {{{self.table}}}{shard_filter})"
+
+        # When every rule only needs its incremental window, scan just the rows inside the windows
+        window_predicates = [rule.window_predicate(env) for rule in self.rules]
+        conditions = []
+        if all(window_predicates):
+            conditions.append(" OR ".join(f"({predicate})" for predicate in dict.fromkeys(window_predicates)))
+        if shard_predicate and not window_columns:
+            conditions.append(shard_predicate)
+        where = ""
+        if conditions:
+            where = "WHERE " + (conditions[0] if len(conditions) == 1 else
+                                " AND ".join(f"({condition})" for condition in conditions))
+        joins_sql = "\n        ".join(joins)
+        return compiled_query(env, f"{self.table}_rules", f"""
+        -- Compiled rules of {self.table}: one COUNTIF column per rule, evaluated in a single scan
+        SELECT
+            {columns}
+        FROM {source} AS t
+        {joins_sql}
+        {where}
+        """, self.rules)
+
+
+class SampledTablePlan:
+    """The sampled rules of one table compiled into a single query over a sample of its rows."""
+
+    def __init__(self, table, rules, sample_percent):
+        self.table = table
+        self.rules = rules
+        self.sample_percent = sample_percent
+
+    def build_query(self, env):
+        tablesample, sample_filter = sampling.sample_clause(env, self.table, self.sample_percent)
+        columns = ",\n            ".join(
+            f"{rule.count_expression(env)} AS {rule.name},\n            COUNTIF({rule.row_filter(env)}) AS {rule.rows_column}"
+            for rule in self.rules)
+        return compiled_query(env, f"{self.table}_sampled_rules", f"""
+        -- Sampled rules of {self.table}: defects and rows of each rule in a {self.sample_percent}% sample
+        SELECT
+            {columns}
+        FROM {{{self.table}}} {tablesample} AS t
+        WHERE {sample_filter}
+        """, self.rules)
+
+
+class IntermediatePlan:
+    """
+    The rules of one table that only read the columns of a shared intermediate, compiled into a single query over
+    the intermediate: every row of the intermediate stands for row_count rows of the table, so it counts that often.
+    """
+
+    def __init__(self, intermediate, rules):
+        self.intermediate = intermediate
+        self.table = intermediate.table
+        self.rules = rules
+
+    @staticmethod
+    def count_expression(predicate):
+        return f"COALESCE(SUM(CASE WHEN {predicate} THEN {intermediates.ROW_COUNT_COLUMN} ELSE 0 END), 0)"
+
+    def build_query(self, env):
+        columns = [f"{self.count_expression(rule.counted_predicate(env))} AS {rule.name}" for rule in self.rules]
+        joins_sql = "\n        ".join(join for rule in self.rules for join in rule.joins(env))
+        columns_sql = ",\n            ".join(columns)
+        return compiled_query(env, f"{self.table}_rules_on_{self.intermediate.name}", f"""
+        -- Rules of {self.table} evaluated on the shared intermediate {self.intermediate.name}
+        SELECT
+            {columns_sql}
+        FROM {intermediates.source(env, self.intermediate)} AS t
+        {joins_sql}
+        """, self.rules)
+
+
+class RuleSet:
+    """
+    Rules loaded from the rule files, grouped by table into one TablePlan each.
+    Each plan's query runs once per session and serves the counts of all its rules. In sampling mode the rules
+    declaring a sample are left out of their table's plan and estimated from one SampledTablePlan per table instead;
+    a rule whose estimate is inconclusive is then counted by a plan of its own. In key count mode the uniqueness
+    rules declaring key counts are left out as well; they compare the exact number of their distinct keys with their
+    rows and are counted by a plan of their own only when the two differ. In sharding mode a plan whose rules declare a
+    shard_by column runs as concurrent shards of its table, and the counts of the shards are summed. With shared
+    intermediates the rules reading only the columns of an intermediate are counted from it by an IntermediatePlan.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.plans = {}
+        for rule in rules:
+            self.plans.setdefault(rule.table, TablePlan(rule.table, [])).rules.append(rule)
+        self._results = {}  # (full table id, plan key) -> ({column: value}, QueryStats of the compiled queries)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def sampled(rule):
+        """Whether the rule is estimated from a sample in this session."""
+        return rule.sample is not None and sampling.sample_percent() is not None
+
+    @staticmethod
+    def key_counted(rule):
+        """Whether the rule is first checked on the counts of its keys in this session."""
+        return rule.key_counts and key_counts.active_store() is not None
+
+    def intermediate(self, rule):
+        """Returns the shared intermediate the rule is counted from in this session, or None if it reads its table."""
+        shared = intermediates.active_intermediates()
+        if shared is None or not rule.groupable or self.sampled(rule) or self.key_counted(rule):
+            return None
+        # The incremental window of a rule filters on install_date, which an intermediate does not keep
+        if rule.incremental and incremental.active_checks() is not None:
+            return None
+        return shared.covering(rule.table, rule.read_columns())
+
+    def _plan(self, rule, escalated=False):
+        """Returns the key of the plan evaluating the rule in this session and the plan."""
+        table_rules = self.plans[rule.table].rules
+        intermediate = self.intermediate(rule)
+        if intermediate is not None:
+            return f"intermediate:{intermediate.name}", IntermediatePlan(
+                intermediate, [compiled for compiled in table_rules if self.intermediate(compiled) is intermediate])
+        if not self.sampled(rule) and not self.key_counted(rule):
+            return "full", TablePlan(rule.table, [compiled for compiled in table_rules
+                                                  if not self.sampled(compiled) and not self.key_counted(compiled)
+                                                  and self.intermediate(compiled) is None])
+        if escalated:
+            return f"full:{rule.name}", TablePlan(rule.table, [rule])
+        return "sample", SampledTablePlan(rule.table, [compiled for compiled in table_rules if self.sampled(compiled)],
+                                          sampling.sample_percent())
+
+    def sharded_column(self, rule, escalated=False):
+        """Returns the column the plan evaluating the rule is split by in this session, or None if it runs whole."""
+        plan = self._plan(rule, escalated)[1]
+        if sharding.active_runner() is None or not isinstance(plan, TablePlan):
+            return None
+        return plan.shard_column()
+
+    def query_builder(self, rule):
+        """
+        Returns a function building the compiled query evaluating the rule for an environment, or None for a rule
+        first checked on key counts, whose statements cannot run ahead, and for a rule whose plan runs in shards.
+        """
+        return lambda env: (None if self.key_counted(rule) or self.sharded_column(rule) else
+                            self._plan(rule)[1].build_query(env))
+
+    def params(self):
+        """Returns one pytest parameter per rule, marked with its check query, severity and incremental window."""
+        params = []
+        for rule in self.rules:
+            marks = [check_query(self.query_builder(rule)), check_severity(rule.severity)]
+            if rule.incremental:
+                marks.append(incremental_check(rule.table, rule.name))
+            if rule.max_bytes_processed is not None:
+                marks.append(byte_budget(rule.max_bytes_processed))
+            if rule.timeout_seconds is not None:
+                marks.append(check_timeout(rule.timeout_seconds))
+            params.append(pytest.param(rule, id=rule.name, marks=marks))
+        return params
+
+    def _evaluate(self, bq_client, env, rule, escalated=False):
+        """Returns the result row of the plan evaluating the rule as a dict; the plan runs on the first request."""
+        plan_key, plan = self._plan(rule, escalated)
+        key = (env.get_full_table_id(rule.table), plan_key)
+        with self._lock:
+            if key not in self._results:
+                kind = "sampled" if isinstance(plan, SampledTablePlan) else "compiled"
+                description = f"Evaluating {len(plan.rules)} {kind} rules on {rule.table}"
+                if isinstance(plan, IntermediatePlan):
+                    description += f" from the shared intermediate {plan.intermediate.name}"
+                shard_column = self.sharded_column(rule, escalated)
+                if shard_column is not None:
+                    runner = sharding.active_runner()
+                    result = runner.run(lambda predicate: plan.build_query(env, shard_predicate=predicate),
+                                        runner.predicates(rule.table, shard_column), description)
+                    self._results[key] = (result.summed(), result.stats, result)
+                else:
+                    results = execute_query_and_log(bq_client, plan.build_query(env), description,
+                                                    include_query_in_message=False)
+                    self._results[key] = (dict(next(results).items()), [query_profile.last_stats()], None)
+            else:
+                # The shared scan counts towards the cost and byte budget of every rule reading it
+                for stats in self._results[key][1]:
+                    query_profile.record_shared(stats)
+            return self._results[key][0], self._results[key][2]
+
+    def count(self, bq_client, env, rule):
+        """
+        Returns the rule's count; the compiled query of its table runs on the first request. A sampled or key counted
+        rule is counted by a plan of its own.
+        """
+        escalated = self.sampled(rule) or self.key_counted(rule)
+        values, sharded = self._evaluate(bq_client, env, rule, escalated=escalated)
+        count = values[rule.name]
+        plan = self._plan(rule, escalated)[1]
+        with allure.step(f"Reading the compiled result of {rule.name}"):
+            expression = (plan.count_expression(rule.counted_predicate(env)) if isinstance(plan, IntermediatePlan)
+                          else rule.count_expression(env))
+            parameters = "".join(f"\n@{name} = {value!r}" for name, value in rule.query_parameters(env).items())
+            counted = f"{expression}{parameters}\n\ncount: {count}"
+            if sharded is not None:
+                # Name the shards the rule's count came from
+                counted += "".join(f"\nshard {shard} ({predicate}): {value}"
+                                   for shard, predicate, value in sharded.shards_with(rule.name))
+            allure.attach(counted, name="Compiled Rule", attachment_type=allure.attachment_type.TEXT)
+        return count
+
+    def estimate(self, bq_client, env, rule):
+        """Returns the rule's defect rate estimated from the sampled query of its table."""
+        values, _ = self._evaluate(bq_client, env, rule)
+        estimate = sampling.DefectRateEstimate(values[rule.name], values[rule.rows_column], rule.max_defect_rate,
+                                               rule.confidence, sampling.sample_percent())
+        with allure.step(f"Estimating the defect rate of {rule.name} from a {estimate.sample_percent}% sample"):
+            allure.attach(json.dumps(estimate.to_dict(), indent=4), name="Defect Rate Estimate",
+                          attachment_type=allure.attachment_type.JSON)
+        return estimate
+
+    @staticmethod
+    def compare_key_counts(env, rule):
+        """Compares the exact number of distinct keys of the rule with the rows they cover."""
+        window = incremental.window(env, rule.table, rule.name) if rule.incremental else None
+        with allure.step(f"Comparing the distinct keys of {rule.name} with its rows"):
+            return key_counts.active_store().compare_with_rows(rule.name, rule.table, rule.spec["keys"],
+                                                               where=rule.where or "TRUE", window=window)
+
+    def failures(self, bq_client, env, rule):
+        """
+        Returns the ViolationSummary of a failed rule: its violations, broken down by the rule's group_by, and a
+        bounded set of example rows, all from one query (one per shard for a sharded rule). None for rules without
+        a violations query.
+        """
+        query = rule.violations_query(env)
+        if query is None:
+            return None
+        description = f"Summarizing the rows failing {rule.name}"
+        shard_column = self.sharded_column(rule, escalated=self.sampled(rule) or self.key_counted(rule))
+        if shard_column is not None:
+            runner = sharding.active_runner()
+            return violations.summarize_sharded_violations(
+                runner, bq_client, env, rule.name,
+                lambda predicate: rule.violations_query(env, predicate),
+                runner.predicates(rule.table, shard_column), rule.group_by, description,
+                groups_exact=shard_column in rule.group_by)
+        return violations.summarize_violations(bq_client, env, rule.name, query, rule.group_by, description)
+
+
+def load_rules(rules_dir=rule_specs.DEFAULT_RULES_DIR):
+    """Loads and compiles every *.json rule file of the directory."""
+    return RuleSet(rule_specs.load_rule_specs(rules_dir, RULE_TYPES))
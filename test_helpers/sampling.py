@@ -0,0 +1,87 @@
+import os
+import math
+from statistics import NormalDist
+
+
+# Percentage of a table's rows the sampled rules are estimated from
+DEFAULT_SAMPLE_PERCENT = float(os.getenv("CHECK_SAMPLE_PERCENT", "1"))
+# Confidence level of the defect-rate interval of rules that do not declare their own
+DEFAULT_CONFIDENCE = 0.95
+# Views cannot be sampled by storage block and are sampled row by row; a view materialized into a snapshot is a table
+VIEWS = ("v_agg_data",)
+
+# Sample percentage of the current session, None when sampling is off
+_active_percent = None
+
+
+def wilson_interval(defects, rows, confidence):
+    """Returns the Wilson score interval of the defect rate of a sample; (0, 1) for an empty sample."""
+    if not rows:
+        return 0.0, 1.0
+    z = NormalDist().inv_cdf(1 - (1 - confidence) / 2)
+    rate = defects / rows
+    denominator = 1 + z ** 2 / rows
+    center = (rate + z ** 2 / (2 * rows)) / denominator
+    margin = z * math.sqrt(rate * (1 - rate) / rows + z ** 2 / (4 * rows ** 2)) / denominator
+    return max(0.0, center - margin), min(1.0, center + margin)
+
+
+class DefectRateEstimate:
+    """
+    Defect rate of a rule estimated from a sample with its confidence interval. The estimate is conclusive when the
+    whole interval lies on one side of the rule's tolerated rate; otherwise the rule has to be evaluated on every row.
+    """
+
+    def __init__(self, defects, rows, max_defect_rate, confidence, sample_percent):
+        self.defects = defects
+        self.rows = rows
+        self.max_defect_rate = max_defect_rate
+        self.confidence = confidence
+        self.sample_percent = sample_percent
+        self.rate = defects / rows if rows else None
+        self.lower, self.upper = wilson_interval(defects, rows, confidence)
+
+    @property
+    def conclusive(self):
+        return bool(self.rows) and (self.upper <= self.max_defect_rate or self.lower > self.max_defect_rate)
+
+    @property
+    def passed(self):
+        return self.upper <= self.max_defect_rate
+
+    def to_dict(self):
+        return dict(vars(self), conclusive=self.conclusive, passed=self.passed if self.conclusive else None)
+
+    def __str__(self):
+        if not self.rows:
+            return f"no rows in the {self.sample_percent}% sample"
+        return (f"estimated defect rate {self.rate:.4%} ({self.confidence:.0%} interval {self.lower:.4%} to "
+                f"{self.upper:.4%}) from {self.rows} sampled rows, tolerated {self.max_defect_rate:.4%}")
+
+
+def sample_clause(env, table_name, sample_percent):
+    """
+    Returns the TABLESAMPLE clause following the table in FROM and the row filter of the sample. Base tables on
+    BigQuery are sampled by storage block, which also cuts the bytes read, but the rows of a block are correlated, so
+    the interval is only approximate. Views and the local backend are sampled row by row.
+    """
+    overridden = env.get_full_table_id(table_name) != env.get_full_table_id(table_name, override=False)
+    if not env.is_local and (table_name not in VIEWS or overridden):
+        return f"TABLESAMPLE SYSTEM ({sample_percent} PERCENT)", "TRUE"
+    return "", f"RAND() < {sample_percent / 100}"
+
+
+def activate(sample_percent=DEFAULT_SAMPLE_PERCENT):
+    """Makes the rules declaring a sample be estimated from sample_percent of their table's rows."""
+    global _active_percent
+    _active_percent = sample_percent
+
+
+def deactivate():
+    global _active_percent
+    _active_percent = None
+
+
+def sample_percent():
+    """Returns the sample percentage of the current session, or None if sampling is off."""
+    return _active_percent
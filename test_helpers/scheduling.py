@@ -0,0 +1,180 @@
+import os
+import time
+import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import allure
+import pytest
+from environment import Environment
+from test_helpers import intermediates, templates
+from test_helpers.result_cache import referenced_tables
+
+
+# Severity levels in the order their checks run, most severe first
+SEVERITY_ORDER = [allure.severity_level.BLOCKER, allure.severity_level.CRITICAL, allure.severity_level.NORMAL,
+                  allure.severity_level.MINOR, allure.severity_level.TRIVIAL]
+# Failures at these levels close the gate in fail-fast mode
+GATING_SEVERITIES = {allure.severity_level.BLOCKER, allure.severity_level.CRITICAL}
+# Seconds a check may wait for its queries before they are cancelled, unless the check declares its own; None for no limit
+DEFAULT_CHECK_TIMEOUT = float(os.getenv("CHECK_TIMEOUT_SECONDS")) if os.getenv("CHECK_TIMEOUT_SECONDS") else None
+
+# Gate of the current session, None unless critical failures skip the downstream checks
+_active_gate = None
+# Jobs submitted and not finished yet: id(job) -> (job, query)
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+# Deadline of the check running in the current thread
+_current_check = threading.local()
+
+
+def check_severity(level):
+    """Marks a test whose Allure severity is only set while it runs, such as a rule, with that severity."""
+    return pytest.mark.check_severity.with_args(level)
+
+
+def check_timeout(seconds):
+    """Marks a test whose queries are cancelled once the test waited seconds for them."""
+    return pytest.mark.check_timeout.with_args(seconds)
+
+
+class CheckTimeout(AssertionError):
+    """Raised when a check waited longer than its timeout for a query, after the query's job was cancelled."""
+
+
+def severity(item):
+    """Returns the severity of a test item from its check_severity mark or its @allure.severity, normal by default."""
+    marker = item.get_closest_marker("check_severity")
+    if marker is not None:
+        return allure.severity_level(marker.args[0])
+    for marker in item.iter_markers("allure_label"):
+        if marker.kwargs.get("label_type") == "severity":
+            return allure.severity_level(marker.args[0])
+    return allure.severity_level.NORMAL
+
+
+def severity_rank(item):
+    """Position of the item's severity in SEVERITY_ORDER, most severe first."""
+    return SEVERITY_ORDER.index(severity(item))
+
+
+def start_check(timeout=None):
+    """Sets the deadline of the queries the current thread waits for until finish_check."""
+    _current_check.deadline = time.monotonic() + timeout if timeout is not None else None
+
+
+def finish_check():
+    _current_check.deadline = None
+
+
+def remaining():
+    """Returns the seconds left before the running check times out, or None without a timeout."""
+    deadline = getattr(_current_check, "deadline", None)
+    return max(deadline - time.monotonic(), 0) if deadline is not None else None
+
+
+def submit(bq_client, query, **kwargs):
+    """Starts a query job, tracked until it finishes so that it can be cancelled on a timeout or a critical failure."""
+    if templates.parameters_of(query) and "job_config" not in kwargs:
+        kwargs["job_config"] = templates.job_config(Environment(), query)
+    query_job = bq_client.query(query, **kwargs)
+    with _in_flight_lock:
+        _in_flight[id(query_job)] = query_job, query
+    return query_job
+
+
+def cancel_jobs(queries=None):
+    """Cancels the running jobs of the queries, or every running job; returns the number of jobs cancelled."""
+    with _in_flight_lock:
+        jobs = [job for job, query in _in_flight.values() if queries is None or query in queries]
+    # QueryJob.cancel only requests the cancellation; the job stops billing once BigQuery processes it
+    return sum(1 for job in jobs if not job.done() and job.cancel())
+
+
+def _timed_out(query, timeout):
+    cancelled = cancel_jobs({query})
+    return CheckTimeout(f"Query still running after the check's timeout of {timeout:g} s, "
+                        f"{cancelled} job(s) cancelled:\n{query}")
+
+
+def wait(query_job, query):
+    """Waits for the result of a submitted job until the running check times out, then cancels the job."""
+    timeout = remaining()
+    try:
+        return query_job.result(timeout=timeout)
+    except FutureTimeoutError:
+        raise _timed_out(query, timeout)
+    finally:
+        with _in_flight_lock:
+            _in_flight.pop(id(query_job), None)
+
+
+def wait_future(future, query):
+    """Waits for a query submitted on another thread until the running check times out, then cancels its job."""
+    timeout = remaining()
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        raise _timed_out(query, timeout)
+
+
+class CriticalGate:
+    """
+    Fail-fast mode: once a BLOCKER or CRITICAL check fails, the checks reading a view have no chance to pass on
+    broken inputs, so the ones that have not run are skipped and the running jobs of their queries are cancelled.
+    Checks reading only tables keep running. Whether a check reads a view is decided from its check_query marks.
+    """
+
+    def __init__(self, bq_client, env):
+        self.bq_client = bq_client
+        self.env = env
+        self.failed_check = None  # Node id of the critical check that closed the gate
+        self._table_types = {}  # full table id -> table type
+
+    def _is_view(self, table_id):
+        # A shared intermediate stands for the table it was computed from, and a view snapshot for the view
+        table_id = Environment.overridden_table(intermediates.source_table(table_id))
+        if table_id not in self._table_types:
+            self._table_types[table_id] = self.bq_client.get_table(table_id).table_type
+        return self._table_types[table_id] == "VIEW"
+
+    def check_queries(self, item):
+        """Returns the check queries of an item that can be built ahead."""
+        queries = (marker.args[0](self.env) for marker in item.iter_markers("check_query"))
+        return [query for query in queries if query is not None]
+
+    def is_downstream(self, item):
+        """Checks whether the item reads a view, so it is skipped once the gate is closed."""
+        return any(self._is_view(table_id) for query in self.check_queries(item)
+                   for table_id in referenced_tables(query))
+
+    def close(self, nodeid, items):
+        """
+        Closes the gate after the critical check nodeid failed and cancels the running jobs of the downstream items.
+        Returns the queries of those items, whose prefetched results are no longer needed.
+        """
+        if self.failed_check is None:
+            self.failed_check = nodeid
+        queries = {query for item in items if self.is_downstream(item) for query in self.check_queries(item)}
+        cancel_jobs(queries)
+        return queries
+
+    def skip_reason(self, item):
+        """Returns why the item is skipped, or None if it runs."""
+        if self.failed_check is None or not self.is_downstream(item):
+            return None
+        return f"Skipped after the critical check {self.failed_check} failed"
+
+
+def activate(gate):
+    """Makes critical failures skip the downstream checks."""
+    global _active_gate
+    _active_gate = gate
+
+
+def deactivate():
+    global _active_gate
+    _active_gate = None
+
+
+def active_gate():
+    """Returns the gate of the current session, or None if every check runs regardless of failures."""
+    return _active_gate
@@ -0,0 +1,183 @@
+import os
+import time
+import json
+import multiprocessing
+from datetime import date, timedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import allure
+from test_helpers import query_profile, scheduling, templates
+from test_helpers.helpers import default_serializer
+from test_helpers.incremental import WATERMARK_COLUMN
+from test_helpers.local_backend import LocalQueryJobConfig
+from test_helpers.result_cache import referenced_tables
+from test_helpers.key_counts import key_expression
+
+
+# Number of shards a sharded check is split into
+DEFAULT_SHARDS = int(os.getenv("CHECK_SHARDS", "8"))
+# Maximum number of shards running at once; local shards run in as many worker processes
+DEFAULT_MAX_CONCURRENT_SHARDS = int(os.getenv("MAX_CONCURRENT_SHARDS", str(os.cpu_count() or 4)))
+
+# Shard runner of the current session, None when checks run as single queries
+_active_runner = None
+
+# Local backend of a shard worker process, loaded once per process
+_worker_client = None
+
+
+def hash_predicates(column, shards):
+    """Predicates splitting the rows by the fingerprint of column; NULLs hash like the string '<null>'."""
+    fingerprint = f"FARM_FINGERPRINT({key_expression([column])})"
+    return [f"ABS(MOD({fingerprint}, {shards})) = {shard}" for shard in range(shards)]
+
+
+def date_range_predicates(first, last, shards, column=WATERMARK_COLUMN):
+    """Predicates splitting [first, last] into up to shards consecutive date ranges; NULL dates go to the first."""
+    days = (last - first).days + 1
+    step = -(-days // shards)  # Ceiling division, so that the last range ends after last
+    bounds = [first + timedelta(days=step * shard) for shard in range(-(-days // step) + 1)]
+    predicates = [f"{column} >= '{lower}' AND {column} < '{upper}'" for lower, upper in zip(bounds, bounds[1:])]
+    predicates[0] = f"({predicates[0]}) OR {column} IS NULL"
+    return predicates
+
+
+class ShardedResult:
+    """The result rows of every shard of a check, with the predicate selecting each shard's rows."""
+
+    def __init__(self, predicates, shard_rows, stats):
+        self.predicates = predicates
+        self.shard_rows = shard_rows  # One list of row dicts per shard
+        self.stats = stats  # QueryStats of every shard
+
+    def summed(self):
+        """Merges single-row count results by summing every column over the shards; NULL counts as 0."""
+        totals = {}
+        for rows in self.shard_rows:
+            for column, value in rows[0].items():
+                totals[column] = totals.get(column, 0) + (value or 0)
+        return totals
+
+    def shards_with(self, column):
+        """Returns (shard number, predicate, value) for every shard whose single result row has a non-zero column."""
+        return [(shard, predicate, rows[0][column]) for shard, (predicate, rows)
+                in enumerate(zip(self.predicates, self.shard_rows)) if rows and rows[0].get(column)]
+
+
+def _init_worker(env):
+    """Loads the local backend of a shard worker process."""
+    global _worker_client
+    _worker_client = env.create_bq_client()
+
+
+def _run_in_worker(query):
+    started = time.monotonic()
+    job_config = LocalQueryJobConfig(query_parameters=templates.parameters_of(query))
+    rows = [dict(row.items()) for row in _worker_client.query(query, job_config=job_config).result()]
+    return rows, None, round((time.monotonic() - started) * 1000)
+
+
+class ShardRunner:
+    """
+    Runs the shard queries of a check concurrently. On BigQuery every shard is a job of the pooled client, so a huge
+    check scales with the available slots. The local backend serializes queries on its single SQLite connection, so
+    local shards run in worker processes, each loading the data directory into a backend of its own. Tables created
+    during the session (snapshots, intermediates, key counts) do not exist there, so the shards of a query reading one
+    run in this process on the session's backend instead.
+    """
+
+    def __init__(self, bq_client, env, shards=DEFAULT_SHARDS, max_concurrent=DEFAULT_MAX_CONCURRENT_SHARDS):
+        self.bq_client = bq_client
+        self.env = env
+        self.shards = shards
+        self._thread_executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix="check-shard")
+        self._process_executor = None
+        if env.is_local:
+            # Spawned rather than forked: the session already runs prefetch and client threads
+            self._process_executor = ProcessPoolExecutor(max_workers=min(max_concurrent, shards),
+                                                         initializer=_init_worker, initargs=(env,),
+                                                         mp_context=multiprocessing.get_context("spawn"))
+        self._bounds = {}  # full table id -> (first, last) install_date
+
+    def _run_job(self, query):
+        started = time.monotonic()
+        query_job = scheduling.submit(self.bq_client, query)
+        rows = [dict(row.items()) for row in scheduling.wait(query_job, query)]
+        return rows, query_job, round((time.monotonic() - started) * 1000)
+
+    def _date_bounds(self, table_name, column):
+        full_table_id = self.env.get_full_table_id(table_name)
+        if full_table_id not in self._bounds:
+            rows = list(self.bq_client.query(f"SELECT MIN({column}) AS first, MAX({column}) AS last "
+                                             f"FROM `{full_table_id}`").result())
+            first, last = rows[0]["first"], rows[0]["last"]
+            # The local backend stores dates as ISO strings
+            self._bounds[full_table_id] = tuple(date.fromisoformat(str(value)) if value is not None else None
+                                                for value in (first, last))
+        return self._bounds[full_table_id]
+
+    def predicates(self, table_name, column, alias=None):
+        """
+        Returns the predicates splitting the rows of table_name into the shards of a check: install_date ranges for
+        the watermark column, FARM_FINGERPRINT(column) MOD n for any other. alias qualifies the column in joins.
+        """
+        qualified = f"{alias}.{column}" if alias else column
+        if column != WATERMARK_COLUMN:
+            return hash_predicates(qualified, self.shards)
+        first, last = self._date_bounds(table_name, column)
+        if first is None:
+            return ["TRUE"]  # No dated rows: a single shard
+        return date_range_predicates(first, last, self.shards, qualified)
+
+    def run(self, build_query, predicates, description):
+        """
+        Runs build_query(predicate) for every shard predicate concurrently and returns the ShardedResult.
+        Each shard's query and cost are attached to its own Allure step, so a failure can be traced to its shard.
+        """
+        queries = [build_query(predicate) for predicate in predicates]
+        if self._in_worker_processes(queries):
+            executor, run = self._process_executor, _run_in_worker
+        else:
+            executor, run = self._thread_executor, self._run_job
+        with allure.step(f"{description} in {len(queries)} shards"):
+            futures = [executor.submit(run, query) for query in queries]
+            shard_rows, shard_stats = [], []
+            for shard, (predicate, query, future) in enumerate(zip(predicates, queries, futures)):
+                rows, query_job, wall_ms = scheduling.wait_future(future, query)
+                with allure.step(f"Shard {shard}: {predicate}"):
+                    allure.attach(query, name="SQL Query", attachment_type=allure.attachment_type.TEXT)
+                    templates.attach_parameters(query)
+                    stats = query_profile.QueryStats(query, query_job, wall_ms=wall_ms)
+                    query_profile.record(stats)
+                    allure.attach(json.dumps(rows, indent=4, default=default_serializer), name="SQL Results",
+                                  attachment_type=allure.attachment_type.JSON)
+                shard_rows.append(rows)
+                shard_stats.append(stats)
+        return ShardedResult(predicates, shard_rows, shard_stats)
+
+    def _in_worker_processes(self, queries):
+        """Whether the local worker processes have every table the queries read."""
+        if self._process_executor is None:
+            return False
+        return all(table_id in self.bq_client.loaded_tables for query in queries
+                   for table_id in referenced_tables(query))
+
+    def shutdown(self):
+        self._thread_executor.shutdown(wait=True, cancel_futures=True)
+        if self._process_executor is not None:
+            self._process_executor.shutdown(wait=True, cancel_futures=True)
+
+
+def activate(runner):
+    """Makes the checks marked as shardable run as concurrent shards on the runner."""
+    global _active_runner
+    _active_runner = runner
+
+
+def deactivate():
+    global _active_runner
+    _active_runner = None
+
+
+def active_runner():
+    """Returns the shard runner of the current session, or None if checks run as single queries."""
+    return _active_runner
@@ -0,0 +1,50 @@
+import os
+import uuid
+from environment import Environment
+
+
+# Views that --snapshot-views materializes for the test session
+SNAPSHOT_VIEWS = ("v_agg_data",)
+# Hours after which BigQuery deletes a snapshot left behind by an interrupted session
+SNAPSHOT_EXPIRATION_HOURS = int(os.getenv("SNAPSHOT_EXPIRATION_HOURS", "24"))
+
+
+def build_snapshot_query(view_id, snapshot_id, expiration_hours=SNAPSHOT_EXPIRATION_HOURS):
+    """Returns the statement materializing the view into the snapshot table."""
+    return f"""
+CREATE TABLE `{snapshot_id}`
+OPTIONS (expiration_timestamp = TIMESTAMP_ADD(CURRENT_TIMESTAMP(), INTERVAL {expiration_hours} HOUR))
+AS SELECT * FROM `{view_id}`
+"""
+
+
+class ViewSnapshots:
+    """
+    Materializes views into snapshot tables once per session and makes Environment.get_full_table_id resolve
+    each view to its snapshot, so the checks on a view read a plain table instead of re-running its joins.
+    The snapshots are dropped when the session ends.
+    """
+
+    def __init__(self, bq_client, env, views=SNAPSHOT_VIEWS):
+        self.bq_client = bq_client
+        self.env = env
+        self.views = views
+        self.snapshots = {}  # view id -> snapshot table id
+
+    def create(self):
+        """Creates one snapshot per view and overrides the view with it."""
+        # A random suffix keeps concurrent sessions on the same dataset from dropping each other's snapshots
+        suffix = uuid.uuid4().hex[:8]
+        for view_name in self.views:
+            view_id = self.env.get_full_table_id(view_name, override=False)
+            snapshot_id = f"{view_id}_snapshot_{suffix}"
+            self.bq_client.query(build_snapshot_query(view_id, snapshot_id)).result()
+            self.snapshots[view_id] = snapshot_id
+            Environment.override_table(view_id, snapshot_id)
+
+    def drop(self):
+        """Resolves the views to themselves again and drops their snapshots."""
+        Environment.clear_table_overrides()
+        for snapshot_id in self.snapshots.values():
+            self.bq_client.query(f"DROP TABLE IF EXISTS `{snapshot_id}`").result()
+        self.snapshots.clear()
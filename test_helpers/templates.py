@@ -0,0 +1,144 @@
+import re
+import json
+import hashlib
+from datetime import date, datetime
+import allure
+
+
+# Comments and runs of whitespace collapse to one space; string literals are matched first and kept as they are
+_CANONICAL_PATTERN = re.compile(r"('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\")|(?:\s|--[^\n]*|/\*.*?\*/)+", re.DOTALL)
+# Table placeholders of a template: {table_name}
+_TABLE_PLACEHOLDER_PATTERN = re.compile(r"\{(\w+)\}")
+
+# Templates by name, registered when the modules declaring them are imported
+_registry = {}
+
+
+def canonical_sql(sql):
+    """Removes comments and collapses whitespace outside string literals, so only a change of the SQL changes the text."""
+    return _CANONICAL_PATTERN.sub(lambda m: m.group(1) or " ", sql).strip().rstrip(";").strip()
+
+
+def parameter_type(value):
+    """Returns the BigQuery type of a query parameter value; a list or tuple is an ARRAY of one element type."""
+    if isinstance(value, (list, tuple)):
+        element_types = {parameter_type(element) for element in value}
+        if len(element_types) != 1:
+            raise TypeError(f"Array query parameters need elements of one type: {value!r}")
+        return f"ARRAY<{element_types.pop()}>"
+    if isinstance(value, bool):
+        return "BOOL"
+    if isinstance(value, int):
+        return "INT64"
+    if isinstance(value, float):
+        return "FLOAT64"
+    if isinstance(value, datetime):
+        return "DATETIME"
+    if isinstance(value, date):
+        return "DATE"
+    if isinstance(value, str):
+        return "STRING"
+    raise TypeError(f"Unsupported query parameter value: {value!r}")
+
+
+class TemplateQuery(str):
+    """
+    The text of a rendered template, carrying the template's name and its (name, type, value) parameters. It is
+    used as a query string everywhere, so it is prefetched, dry-run, cached and deduplicated like any other query;
+    scheduling.submit sends the parameters along with it.
+    """
+
+    def __new__(cls, text, template, parameters):
+        query = super().__new__(cls, text)
+        query.template = template
+        query.parameters = tuple(parameters)
+        return query
+
+    def __getnewargs__(self):
+        return str(self), self.template, self.parameters
+
+    def __eq__(self, other):
+        return str.__eq__(self, other) and self.parameters == getattr(other, "parameters", ())
+
+    def __hash__(self):
+        return hash((str(self), self.parameters))
+
+
+class QueryTemplate:
+    """
+    A check query kept as canonical text with {table} placeholders and @named parameters. The same template renders
+    the same text in every run whatever the formatting of its source, and values such as thresholds and dates are
+    sent as query parameters, so repeated runs hit the BigQuery result cache.
+    """
+
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = canonical_sql(sql)
+
+    def __repr__(self):
+        return f"QueryTemplate({self.name!r})"
+
+    def render(self, env, **parameters):
+        """Returns the TemplateQuery of the template for the environment's tables and the given parameter values."""
+        text = _TABLE_PLACEHOLDER_PATTERN.sub(lambda m: f"`{env.get_full_table_id(m.group(1))}`", self.sql)
+        # Arrays are kept as tuples, so that the query stays hashable
+        return TemplateQuery(text, self.name, [(name, parameter_type(value), tuple(value) if isinstance(value, list)
+                                                else value) for name, value in sorted(parameters.items())])
+
+
+def register(name, sql):
+    """Registers a query template under a name unique across the suite and returns it."""
+    template = QueryTemplate(name, sql)
+    if name in _registry and _registry[name].sql != template.sql:
+        raise ValueError(f"Query template {name} is already registered with another query")
+    _registry[name] = template
+    return template
+
+
+def register_compiled(prefix, sql):
+    """
+    Registers a query compiled from declarations, such as the scan of a table's rules, under prefix and a digest of
+    its canonical text: queries compiled alike share one template whatever the values of their parameters.
+    """
+    digest = hashlib.sha256(canonical_sql(sql).encode("utf-8")).hexdigest()[:12]
+    return register(f"{prefix}_{digest}", sql)
+
+
+def derive(query, sql, suffix):
+    """Returns SQL built around a template query, such as its violation summary, carrying the query's parameters."""
+    parameters = parameters_of(query)
+    if not parameters:
+        return sql
+    return TemplateQuery(sql, f"{query.template}_{suffix}", parameters)
+
+
+def registered():
+    """Returns the registered templates by name."""
+    return dict(_registry)
+
+
+def parameters_of(query):
+    """Returns the (name, type, value) parameters of a query, empty for a plain query string."""
+    return getattr(query, "parameters", ())
+
+
+def job_config(env, query, **options):
+    """Returns the job config running a query with its parameters on the environment's backend."""
+    parameters = parameters_of(query)
+    if env.is_local:
+        from test_helpers.local_backend import LocalQueryJobConfig
+        return LocalQueryJobConfig(query_parameters=parameters, **options)
+    from google.cloud import bigquery
+    return bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ArrayQueryParameter(name, type_[len("ARRAY<"):-1], list(value))
+                          if type_.startswith("ARRAY<") else bigquery.ScalarQueryParameter(name, type_, value)
+                          for name, type_, value in parameters],
+        **options)
+
+
+def attach_parameters(query):
+    """Attaches the parameters of a template query to Allure next to its SQL."""
+    parameters = parameters_of(query)
+    if parameters:
+        allure.attach(json.dumps({name: value for name, _, value in parameters}, indent=4, default=str),
+                      name="Query Parameters", attachment_type=allure.attachment_type.JSON)
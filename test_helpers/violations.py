@@ -0,0 +1,173 @@
+import os
+import allure
+from test_helpers import templates
+from test_helpers.helpers import execute_query_and_log
+
+
+# Maximum number of example rows, one per group when the violations are broken down, fetched for a failed check
+MAX_REPORTED_FAILURES = int(os.getenv("MAX_REPORTED_FAILURES", "100"))
+# Hours after which BigQuery deletes a quarantine table
+QUARANTINE_EXPIRATION_HOURS = int(os.getenv("QUARANTINE_EXPIRATION_HOURS", "168"))
+# Columns the summary query adds to the violating rows
+SUMMARY_COLUMNS = ("total_violations", "group_violations", "group_row", "violation_groups")
+
+# Whether the full violation sets of failing checks are written to quarantine tables in the current session
+_quarantine_active = False
+
+
+def summary_query(violations_query, group_by=(), max_groups=MAX_REPORTED_FAILURES):
+    """
+    Wraps a query selecting every violating row into one query returning at most max_groups rows: for the largest
+    groups of group_by one example row each, carrying the total number of violations, the number in its group and
+    the number of groups. Without group_by the first max_groups violating rows are returned as examples.
+    """
+    partition = f"PARTITION BY {', '.join(group_by)}" if group_by else ""
+    keep = "group_row = 1" if group_by else "TRUE"
+    return templates.derive(violations_query, f"""
+    -- Violation summary: total, violations per group and one example row per group, computed server-side
+    WITH violations AS (
+        {violations_query}
+    ),
+    ranked AS (
+        SELECT v.*,
+            COUNT(*) OVER () AS total_violations,
+            COUNT(*) OVER ({partition}) AS group_violations,
+            ROW_NUMBER() OVER ({partition}) AS group_row
+        FROM violations AS v
+    )
+    SELECT *
+    FROM (SELECT *, COUNTIF(group_row = 1) OVER () AS violation_groups FROM ranked)
+    WHERE {keep}
+    ORDER BY group_violations DESC
+    LIMIT {max_groups}
+    """, "summary")
+
+
+class ViolationSummary:
+    """Total number of violations of a check, the violations of its largest groups and a bounded set of examples."""
+
+    def __init__(self, rows, group_by=()):
+        self.group_by = list(group_by)
+        self.total = rows[0]["total_violations"] if rows else 0
+        self.groups = rows[0]["violation_groups"] if rows and group_by else None
+        self.breakdown = [({column: row[column] for column in self.group_by}, row["group_violations"])
+                          for row in rows] if group_by else []
+        self.examples = [{field: value for field, value in row.items() if field not in SUMMARY_COLUMNS}
+                         for row in rows]
+        self.quarantine_table = None  # Table holding every violating row, when quarantined
+        self.shard_totals = []  # (shard predicate, violations) of the shards with violations, for sharded checks
+
+    @classmethod
+    def merge(cls, summaries, predicates, max_groups=MAX_REPORTED_FAILURES, groups_exact=False):
+        """
+        Merges the summaries of the shards of a check. The total is exact; the violations of a group are summed over
+        the shards whose largest groups include it. The number of groups is only known when no group can span two
+        shards (groups_exact: the shard column is one of the group_by columns).
+        """
+        merged = cls([], summaries[0].group_by if summaries else ())
+        merged.total = sum(summary.total for summary in summaries)
+        merged.shard_totals = [(predicate, summary.total) for predicate, summary in zip(predicates, summaries)
+                               if summary]
+        if not merged.group_by:
+            merged.examples = [example for summary in summaries for example in summary.examples][:max_groups]
+            return merged
+        counts, examples = {}, {}
+        for summary in summaries:
+            for (group, count), example in zip(summary.breakdown, summary.examples):
+                key = tuple(group.values())
+                counts[key] = counts.get(key, 0) + count
+                examples.setdefault(key, (group, example))
+        largest = sorted(counts, key=counts.get, reverse=True)[:max_groups]
+        merged.breakdown = [(examples[key][0], counts[key]) for key in largest]
+        merged.examples = [examples[key][1] for key in largest]
+        if groups_exact:
+            merged.groups = sum(summary.groups or 0 for summary in summaries)
+        return merged
+
+    def __bool__(self):
+        return self.total > 0
+
+    def describe(self):
+        """Multi-line report of the violations for an assertion message."""
+        lines = [f"{self.total} violations" + (f" in {self.groups} groups" if self.groups is not None else "")]
+        if self.breakdown:
+            lines.append(f"Largest groups by {', '.join(self.group_by)}:")
+            lines.extend("  " + ", ".join(f"{column}: {value}" for column, value in group.items()) + f": {count}"
+                         for group, count in self.breakdown)
+        if self.examples:
+            lines.append(f"{len(self.examples)} example rows:")
+            lines.extend("  " + ", ".join(f"{field}: {value}" for field, value in example.items())
+                         for example in self.examples)
+        if self.shard_totals:
+            lines.append("Violations by shard:")
+            lines.extend(f"  {predicate}: {total}" for predicate, total in self.shard_totals)
+        if self.quarantine_table:
+            lines.append(f"All violating rows were written to {self.quarantine_table}")
+        return "\n".join(lines)
+
+
+def build_quarantine_statements(violations_query, quarantine_id, expiration_hours=QUARANTINE_EXPIRATION_HOURS):
+    """Returns the statements replacing the quarantine table with every violating row."""
+    return [
+        f"DROP TABLE IF EXISTS `{quarantine_id}`",
+        templates.derive(violations_query, f"""
+CREATE TABLE `{quarantine_id}`
+OPTIONS (expiration_timestamp = TIMESTAMP_ADD(CURRENT_TIMESTAMP(), INTERVAL {expiration_hours} HOUR))
+AS SELECT * FROM (
+{violations_query}
+)
+""", "quarantine"),
+    ]
+
+
+def summarize_violations(bq_client, env, check_name, violations_query, group_by=(), description=None,
+                         max_groups=MAX_REPORTED_FAILURES):
+    """
+    Runs the summary query of a check's violations and returns its ViolationSummary; only the summary rows are
+    downloaded. In quarantine mode a check with violations also writes all of them to quarantine_<check_name>.
+    """
+    results = execute_query_and_log(bq_client, summary_query(violations_query, group_by, max_groups),
+                                    description or f"Summarizing the violations of {check_name}",
+                                    include_query_in_message=False)
+    summary = ViolationSummary(list(results), group_by)
+    quarantine(bq_client, env, check_name, violations_query, summary)
+    return summary
+
+
+def summarize_sharded_violations(runner, bq_client, env, check_name, build_violations_query, predicates,
+                                 group_by=(), description=None, max_groups=MAX_REPORTED_FAILURES, groups_exact=False):
+    """
+    Runs the summary query of every shard of a check's violations on the shard runner and merges them, see
+    ViolationSummary.merge. build_violations_query(predicate) selects the violating rows of one shard; in quarantine
+    mode the violations of all shards are written with the unsharded query.
+    """
+    result = runner.run(lambda predicate: summary_query(build_violations_query(predicate), group_by, max_groups),
+                        predicates, description or f"Summarizing the violations of {check_name}")
+    summary = ViolationSummary.merge([ViolationSummary(rows, group_by) for rows in result.shard_rows], predicates,
+                                     max_groups=max_groups, groups_exact=groups_exact)
+    quarantine(bq_client, env, check_name, build_violations_query("TRUE"), summary)
+    return summary
+
+
+def quarantine(bq_client, env, check_name, violations_query, summary):
+    """In quarantine mode, writes every violating row of a check with violations to quarantine_<check_name>."""
+    if not summary or not _quarantine_active:
+        return
+    quarantine_id = env.get_full_table_id(f"quarantine_{check_name}", override=False)
+    with allure.step(f"Writing the {summary.total} violations of {check_name} to {quarantine_id}"):
+        for statement in build_quarantine_statements(violations_query, quarantine_id):
+            allure.attach(statement, name="SQL Query", attachment_type=allure.attachment_type.TEXT)
+            job_config = templates.job_config(env, statement) if templates.parameters_of(statement) else None
+            bq_client.query(statement, job_config=job_config).result()
+    summary.quarantine_table = quarantine_id
+
+
+def activate():
+    """Makes failing checks write their full violation sets to quarantine tables."""
+    global _quarantine_active
+    _quarantine_active = True
+
+
+def deactivate():
+    global _quarantine_active
+    _quarantine_active = False
@@ -1,7 +1,11 @@
 import os
 from dotenv import load_dotenv
+import allure
 import pytest
 from environment import Environment
+from test_helpers import (distributed, dry_run, incremental, intermediates, key_counts, prefetch, query_profile,
+                          result_cache, sampling, scheduling, sharding, snapshot, violations)
+from test_helpers.client_pool import client_pool
 
 
 # Determine which file to load environment variables from
@@ -10,10 +14,430 @@ dotenv_path = os.path.join(os.path.dirname(__file__), '..', 'docker.env') if os.
 load_dotenv(dotenv_path=dotenv_path)
 
 
-# Pytest fixture for creating a BigQuery client and providing configuration
-@pytest.fixture(scope="module")
-def setup():
+def pytest_addoption(parser):
+    group = parser.getgroup("data quality checks")
+    group.addoption("--no-prefetch-checks", action="store_true", default=False,
+                    help="Run each check query when its test runs instead of submitting all of them up front")
+    group.addoption("--max-in-flight-queries", type=int, default=prefetch.DEFAULT_MAX_IN_FLIGHT,
+                    help="Maximum number of check queries prefetched concurrently")
+    group.addoption("--no-check-cache", action="store_true", default=False,
+                    help="Run every check query instead of replaying results cached for unchanged tables")
+    group.addoption("--incremental-checks", action="store_true", default=False,
+                    help="Evaluate incremental checks only over the rows appended since they last passed")
+    group.addoption("--full-recheck", action="store_true", default=False,
+                    help="Evaluate incremental checks over the full history and reset their watermarks")
+    group.addoption("--full-recheck-days", type=int, default=incremental.DEFAULT_FULL_RECHECK_DAYS,
+                    help="Days after which incremental checks are evaluated over the full history again")
+    group.addoption("--snapshot-views", action="store_true", default=False,
+                    help="Materialize v_agg_data into a snapshot table once and run the view checks against it")
+    group.addoption("--share-intermediates", action="store_true", default=False,
+                    help="Compute the intermediates several checks derive from a view once into session tables")
+    group.addoption("--query-profile", default=os.getenv("QUERY_PROFILE_PATH"),
+                    help="Write the bytes, slot time and latency of every check query to this JSON file")
+    group.addoption("--max-bytes-per-check", type=int, default=query_profile.DEFAULT_MAX_BYTES_PER_CHECK,
+                    help="Fail checks whose queries process more bytes, unless they declare their own budget")
+    group.addoption("--sample-checks", action="store_true", default=False,
+                    help="Estimate the defect rate of rules declaring a sample from a sample of their table")
+    group.addoption("--sample-percent", type=float, default=sampling.DEFAULT_SAMPLE_PERCENT,
+                    help="Percentage of the table's rows sampled rules are estimated from")
+    group.addoption("--key-count-uniqueness", action="store_true", default=False,
+                    help="Check uniqueness on exact key counts first, recounting only the incremental window of checks "
+                         "keyed by install_date; the exact query runs only when the counts find a duplicate")
+    group.addoption("--no-dry-run", action="store_true", default=False,
+                    help="Start running the checks without dry-running all of their queries first")
+    group.addoption("--max-run-bytes", type=int, default=dry_run.DEFAULT_MAX_RUN_BYTES,
+                    help="Abort the run before any check runs if its queries are estimated to process more bytes")
+    group.addoption("--shard-checks", action="store_true", default=False,
+                    help="Split the scans of checks declaring a shard column into concurrent shards")
+    group.addoption("--shards", type=int, default=sharding.DEFAULT_SHARDS,
+                    help="Number of shards a sharded check is split into")
+    group.addoption("--max-concurrent-shards", type=int, default=sharding.DEFAULT_MAX_CONCURRENT_SHARDS,
+                    help="Maximum number of shards running at once (worker processes on the local backend)")
+    group.addoption("--quarantine-violations", action="store_true", default=False,
+                    help="Write every violating row of a failed check to a quarantine_<check> table in the dataset")
+    group.addoption("--no-severity-order", action="store_true", default=False,
+                    help="Run the checks in file order instead of the most severe and cheapest first")
+    group.addoption("--fail-fast-critical", action="store_true", default=False,
+                    help="Once a critical check fails, skip the checks reading views and cancel their running jobs")
+    group.addoption("--check-timeout", type=float, default=scheduling.DEFAULT_CHECK_TIMEOUT,
+                    help="Seconds a check may wait for its queries before their jobs are cancelled")
+    group.addoption("--label-dataset", action="store_true", default=False,
+                    help="Label every Allure result with the dataset it checked, for runs fanned out over datasets")
+
+
+# Stash keys under which the session's check result cache and query profile are kept for the terminal summary
+check_result_cache_key = pytest.StashKey()
+query_profile_key = pytest.StashKey()
+dry_run_report_key = pytest.StashKey()
+# Stash keys of the pytest-xdist coordination: the directory shared by the workers, check durations, query counts
+coordinator_dir_key = pytest.StashKey()
+check_durations_key = pytest.StashKey()
+coordinated_queries_key = pytest.StashKey()
+
+
+# Runs before the Allure plugin is configured, so that each xdist worker writes its results to a directory of its own
+@pytest.hookimpl(tryfirst=True)
+def pytest_configure(config):
+    config.addinivalue_line("markers", "check_query(builder): function building the test's check query from an Environment")
+    config.addinivalue_line("markers", "incremental_check(table_name, check_name): check evaluated over a watermark window")
+    config.addinivalue_line("markers", "byte_budget(max_bytes): maximum bytes the check's queries may process")
+    config.addinivalue_line("markers", "check_severity(level): severity of a check whose Allure severity is set at run time")
+    config.addinivalue_line("markers", "check_timeout(seconds): time the check may wait for its queries")
+
+    config.stash[check_durations_key] = distributed.CheckDurations()
+    report_dir = getattr(config.option, "allure_report_dir", None)
+    if distributed.worker_id() is not None and report_dir:
+        config.option.allure_report_dir = distributed.worker_results_dir(report_dir)
+    if distributed.is_controller(config):
+        config.stash[coordinator_dir_key] = distributed.QueryCoordinator.create_directory()
+        config.stash[coordinated_queries_key] = {"ran": 0, "reused": 0}
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_configure_node(node):
+    # Passes the coordinator directory from the controller to the xdist worker being started
+    node.workerinput["check_coordinator_dir"] = node.config.stash[coordinator_dir_key]
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_testnodedown(node, error):
+    counts = node.config.stash.get(coordinated_queries_key, None)
+    output = getattr(node, "workeroutput", {})
+    if counts is not None:
+        for name in counts:
+            counts[name] += output.get(f"coordinated_queries_{name}", 0)
+
+
+def pytest_collection_modifyitems(config, items):
+    # The most severe checks run first, the cheapest of them first, so that a failing batch fails early.
+    # Under pytest-xdist the longest checks are handed out first instead, so no worker is left running one at the end
+    by_severity = not config.getoption("--no-severity-order")
+    if by_severity or distributed.is_distributed(config):
+        config.stash[check_durations_key].order(items, longest_first=distributed.is_distributed(config),
+                                                rank=scheduling.severity_rank if by_severity else None)
+
+
+def pytest_runtest_setup(item):
+    gate = scheduling.active_gate()
+    reason = gate.skip_reason(item) if gate is not None else None
+    if reason is not None:
+        pytest.skip(reason)
+
+
+def pytest_sessionfinish(session):
+    # Durations are recorded by the process reporting the results: the controller under pytest-xdist
+    reporter = session.config.pluginmanager.get_plugin("terminalreporter")
+    if distributed.worker_id() is not None or reporter is None:
+        return
+    durations = session.config.stash[check_durations_key]
+    for reports in reporter.stats.values():
+        for report in reports:
+            if getattr(report, "when", None) == "call":
+                durations.record(report.nodeid, report.duration)
+    durations.save()
+
+
+def pytest_unconfigure(config):
+    directory = config.stash.get(coordinator_dir_key, None)
+    if directory is not None:
+        distributed.QueryCoordinator.remove_directory(directory)
+        report_dir = getattr(config.option, "allure_report_dir", None)
+        if report_dir:
+            distributed.merge_worker_results(report_dir)
+
+
+# Session-wide pool of BigQuery clients, closed when the session ends
+@pytest.fixture(scope="session")
+def bq_client_pool():
+    yield client_pool
+    client_pool.close()
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    report = config.stash.get(dry_run_report_key, None)
+    if report is not None:
+        terminalreporter.write_line(f"dry run: {len(report.results)} check queries validated in {report.elapsed:.2f} s, "
+                                    f"{report.estimated_bytes} bytes estimated")
+    cache = config.stash.get(check_result_cache_key, None)
+    if cache is not None:
+        terminalreporter.write_line(f"check result cache: {cache.hits} hits, {cache.misses} misses")
+    counts = config.stash.get(coordinated_queries_key, None)
+    if counts is not None:
+        terminalreporter.write_line(f"xdist workers: {counts['ran']} check queries run, "
+                                    f"{counts['reused']} results reused from another worker")
+    profile = config.stash.get(query_profile_key, None)
+    if profile is not None:
+        totals = profile.to_dict()["totals"]
+        terminalreporter.write_line(f"check queries: {totals['queries']} run, {totals['bytes_processed']} bytes processed, "
+                                    f"{totals['slot_millis']} slot ms")
+        if totals["bigquery_cache_hit_rate"] is not None:
+            terminalreporter.write_line(f"BigQuery cache: {totals['bigquery_cache_hits']} hits, "
+                                        f"{totals['bigquery_cache_hit_rate']:.0%} of the jobs run")
+
+
+# Session-wide profile of the cost and latency of every check query, written out when the session ends
+@pytest.fixture(scope="session", autouse=True)
+def check_query_profile(request):
+    profile = query_profile.QueryProfile()
+    request.config.stash[query_profile_key] = profile
+    query_profile.activate(profile)
+    yield profile
+    query_profile.deactivate()
+    path = request.config.getoption("--query-profile")
+    if path:
+        # Every xdist worker writes the profile of the checks it ran: profile.gw0.json, profile.gw1.json, ...
+        profile.write(distributed.worker_path(path))
+
+
+# Coordinator deduplicating the check queries of the xdist workers, set up before any query runs
+@pytest.fixture(scope="session", autouse=True)
+def query_coordinator(request):
+    workerinput = getattr(request.config, "workerinput", None)
+    if workerinput is None:
+        yield None
+        return
+
+    coordinator = distributed.QueryCoordinator(workerinput["check_coordinator_dir"])
+    distributed.activate(coordinator)
+    yield coordinator
+    distributed.deactivate()
+    request.config.workeroutput["coordinated_queries_ran"] = coordinator.ran
+    request.config.workeroutput["coordinated_queries_reused"] = coordinator.reused
+
+
+# Session-wide cache of check results keyed by the SQL text and the versions of the tables it reads
+@pytest.fixture(scope="session", autouse=True)
+def check_result_cache(request):
+    if request.config.getoption("--no-check-cache"):
+        yield None
+        return
+
+    cache = result_cache.CheckResultCache()
+    request.config.stash[check_result_cache_key] = cache
+    result_cache.activate(cache)
+    yield cache
+    result_cache.deactivate()
+
+
+# Session-wide watermarks of the incremental checks, saved when the session ends
+@pytest.fixture(scope="session", autouse=True)
+def incremental_checks(request, bq_client_pool):
+    if not request.config.getoption("--incremental-checks"):
+        yield None
+        return
+
+    checks = incremental.IncrementalChecks(full_recheck_days=request.config.getoption("--full-recheck-days"),
+                                           force_full=request.config.getoption("--full-recheck"))
+    incremental.activate(checks)
+    yield checks
+    incremental.deactivate()
+
+
+# Session-wide snapshot tables of the views, dropped when the session ends
+@pytest.fixture(scope="session", autouse=True)
+def view_snapshots(request, bq_client_pool, check_result_cache):
+    if not request.config.getoption("--snapshot-views"):
+        yield None
+        return
+
+    env = Environment()
+    snapshots = snapshot.ViewSnapshots(bq_client_pool.get(env), env)
+    snapshots.create()
+    if check_result_cache is not None:
+        for view_id, snapshot_id in snapshots.snapshots.items():
+            check_result_cache.alias(snapshot_id, view_id)
+    yield snapshots
+    snapshots.drop()
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_call(item):
+    marker = item.get_closest_marker("byte_budget")
+    max_bytes = marker.args[0] if marker is not None else item.config.getoption("--max-bytes-per-check")
+    query_profile.start_check(item.nodeid, max_bytes)
+    marker = item.get_closest_marker("check_timeout")
+    scheduling.start_check(marker.args[0] if marker is not None else item.config.getoption("--check-timeout"))
+    outcome = yield
+    scheduling.finish_check()
+    profile = query_profile.finish_check()
+    # A check that passed still fails when its queries scanned more than its budget
+    budget_error = profile.budget_error() if profile is not None else None
+    if budget_error is not None and outcome.excinfo is None:
+        outcome.force_exception(budget_error)
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_makereport(item, call):
+    outcome = yield
+    report = outcome.get_result()
+    checks = incremental.active_checks()
+    marker = item.get_closest_marker("incremental_check")
+    # A check's watermark only moves forward once its window has been verified
+    if checks is not None and marker is not None and report.when == "call" and report.passed:
+        checks.commit(Environment(), *marker.args)
+    gate = scheduling.active_gate()
+    # A critical failure stops the downstream checks that have not run, including their prefetched queries
+    critical = scheduling.severity(item) in scheduling.GATING_SEVERITIES
+    if gate is not None and report.when == "call" and report.failed and critical:
+        items = item.session.items
+        prefetch.cancel_prefetched(gate.close(item.nodeid, items[items.index(item) + 1:]))
+
+
+# Session-wide intermediate tables shared by the checks deriving them, dropped when the session ends
+@pytest.fixture(scope="session", autouse=True)
+def shared_intermediates(request, bq_client_pool, check_result_cache, view_snapshots):
+    if not request.config.getoption("--share-intermediates"):
+        yield None
+        return
+
+    env = Environment()
+    shared = intermediates.SharedIntermediates(bq_client_pool.get(env), env)
+    shared.create()
+    if check_result_cache is not None:
+        for table_id, source_id in shared.sources.items():
+            check_result_cache.alias(table_id, source_id)
+    intermediates.activate(shared)
+    yield shared
+    intermediates.deactivate()
+    shared.drop()
+
+
+# Session-wide sampling mode, decided before the check queries are built
+@pytest.fixture(scope="session", autouse=True)
+def check_sampling(request):
+    if not request.config.getoption("--sample-checks"):
+        yield None
+        return
+
+    sample_percent = request.config.getoption("--sample-percent")
+    sampling.activate(sample_percent)
+    yield sample_percent
+    sampling.deactivate()
+
+
+# Session-wide store of the uniqueness key counts, decided before the check queries are built
+@pytest.fixture(scope="session", autouse=True)
+def uniqueness_key_counts(request, bq_client_pool):
+    if not request.config.getoption("--key-count-uniqueness"):
+        yield None
+        return
+
+    env = Environment()
+    store = key_counts.KeyCountStore(bq_client_pool.get(env), env)
+    key_counts.activate(store)
+    yield store
+    key_counts.deactivate()
+
+
+# Session-wide shard runner, decided before the check queries are built
+@pytest.fixture(scope="session", autouse=True)
+def check_sharding(request, bq_client_pool):
+    if not request.config.getoption("--shard-checks"):
+        yield None
+        return
+
+    env = Environment()
+    runner = sharding.ShardRunner(bq_client_pool.get(env), env, shards=request.config.getoption("--shards"),
+                                  max_concurrent=request.config.getoption("--max-concurrent-shards"))
+    sharding.activate(runner)
+    yield runner
+    sharding.deactivate()
+    runner.shutdown()
+
+
+# Session-wide quarantine mode of the violations of failed checks
+@pytest.fixture(scope="session", autouse=True)
+def violation_quarantine(request):
+    if not request.config.getoption("--quarantine-violations"):
+        yield False
+        return
+
+    violations.activate()
+    yield True
+    violations.deactivate()
+
+
+# Session-wide fail-fast gate, closed by the first critical failure
+@pytest.fixture(scope="session", autouse=True)
+def critical_gate(request, bq_client_pool):
+    if not request.config.getoption("--fail-fast-critical"):
+        yield None
+        return
+
+    env = Environment()
+    gate = scheduling.CriticalGate(bq_client_pool.get(env), env)
+    scheduling.activate(gate)
+    yield gate
+    scheduling.deactivate()
+
+
+# Session-wide dry run of the check queries of all selected tests, aborting the run before any check is billed
+@pytest.fixture(scope="session", autouse=True)
+def check_dry_run(request, bq_client_pool, check_result_cache, incremental_checks, view_snapshots, shared_intermediates,
+                  check_sampling, uniqueness_key_counts, check_sharding):
+    if request.config.getoption("--no-dry-run"):
+        yield None
+        return
+
+    env = Environment()
+    bq_client = bq_client_pool.get(env)
+    checks_by_query = dry_run.collect_checks_by_query(request.session.items, env)
+    # Queries replayed from the cache are still validated, but will not process any bytes
+    cached = {query for query in checks_by_query
+              if check_result_cache is not None and check_result_cache.contains(bq_client, query)}
+    report = dry_run.dry_run_queries(bq_client, env, checks_by_query, skip_estimate=cached,
+                                     max_run_bytes=request.config.getoption("--max-run-bytes"))
+    request.config.stash[dry_run_report_key] = report
+    message = report.failure_message()
+    if message is not None:
+        pytest.exit(message, returncode=pytest.ExitCode.TESTS_FAILED)
+    yield report
+
+
+# Session-wide fixture submitting the check queries of all selected tests concurrently before they run
+@pytest.fixture(scope="session", autouse=True)
+def check_prefetcher(request, bq_client_pool, query_coordinator, check_result_cache, incremental_checks, view_snapshots,
+                     shared_intermediates, check_sampling, uniqueness_key_counts, check_sharding, check_dry_run):
+    # Under xdist one worker prefetches for all; the others run their queries on demand through the coordinator,
+    # which hands them the prefetched rows or waits for the query the prefetching worker is running
+    if request.config.getoption("--no-prefetch-checks") or not distributed.prefetches():
+        yield None
+        return
+
+    env = Environment()
+    bq_client = bq_client_pool.get(env)
+    queries = prefetch.collect_check_queries(request.session.items, env)
+    if check_result_cache is not None:
+        # Queries whose results will be replayed from the cache do not need to run at all
+        queries = [query for query in queries if not check_result_cache.contains(bq_client, query)]
+    if not queries:
+        yield None
+        return
+
+    prefetcher = prefetch.QueryPrefetcher(bq_client,
+                                          max_in_flight=request.config.getoption("--max-in-flight-queries"))
+    prefetcher.submit(queries)
+    prefetch.activate(prefetcher)
+    yield prefetcher
+    prefetch.deactivate()
+
+
+# Pytest fixture providing the pooled BigQuery client and configuration, shared by all test modules
+@pytest.fixture(scope="session")
+def setup(bq_client_pool):
     env = Environment()  # Initialize our configuration
-    bq_client = env.create_bq_client()  # Create a BigQuery client
+    bq_client = bq_client_pool.get(env)  # Get the session's BigQuery client
     # Return the configuration instance along with the BigQuery client
     return bq_client, env
+
+
+# Under src/fan_out.py the sessions of all datasets write to one Allure results directory. The dataset parameter
+# keeps the same check in two datasets apart, and the parent suite groups the checks of a dataset in the report
+@pytest.fixture(autouse=True)
+def dataset_label(request):
+    if request.config.getoption("--label-dataset"):
+        env = Environment()
+        dataset = f"{env.gcp_project_id}.{env.bigquery_dataset_id}"
+        allure.dynamic.parameter("dataset", dataset)
+        allure.dynamic.label("dataset", dataset)
+        allure.dynamic.parent_suite(dataset)
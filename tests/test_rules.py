@@ -0,0 +1,39 @@
+import allure
+import pytest
+from test_helpers.rules import load_rules
+
+
+# Rules declared in tests/rules/*.json, compiled into one query per table
+rule_set = load_rules()
+
+
+# One test item per rule; title, story, severity and description come from the rule file
+@pytest.mark.parametrize("rule", rule_set.params())
+def test_rule(setup, rule):
+    """Evaluates one declarative rule from the compiled query of its table."""
+    bq_client, env = setup
+    rule.apply_allure_metadata()
+
+    # In sampling mode the rule is decided by its sample unless the estimate is too close to the tolerated rate
+    estimate = rule_set.estimate(bq_client, env, rule) if rule_set.sampled(rule) else None
+    if estimate is not None and estimate.conclusive:
+        failures = None if estimate.passed else rule_set.failures(bq_client, env, rule)
+        with allure.step(f"Verifying {rule.summary()} on a sample, {estimate}"):
+            assert estimate.passed, rule.sample_failure_message(estimate, failures)
+        return
+
+    # In key count mode a uniqueness rule passes when it has exactly as many distinct keys as rows
+    comparison = rule_set.compare_key_counts(env, rule) if rule_set.key_counted(rule) else None
+    if comparison is not None and comparison.agrees:
+        with allure.step(f"Verified {rule.summary()} from key counts, {comparison}"):
+            pass
+        return
+
+    # Read the rule's count from the shared scan of its table; a full evaluation tolerates no defects
+    count = rule_set.count(bq_client, env, rule)
+
+    # The offending rows are only listed when the rule fails
+    passed = rule.passed(count)
+    failures = None if passed else rule_set.failures(bq_client, env, rule)
+    with allure.step(f"Verifying {rule.summary()}, actual count: {count}"):
+        assert passed, rule.failure_message(count, failures)